@@ -0,0 +1,158 @@
+"""Benchmark and regression check for the plain-text math to LaTeX converter.
+
+Compares convert_math_to_latex (one pass of the precompiled LATEX_LEXER) against
+the previous multi-pass implementation on long multi-equation answers, after
+checking the new converter against the golden corpus in latex_golden.json and
+against the old one on randomly generated replies without `$` signs.
+
+Usage:
+    python bench_latex.py [--iterations 200] [--fuzz 2000]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import StreamingLatexConverter, convert_math_to_latex  # noqa: E402
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "latex_golden.json")
+
+def legacy_convert_math_to_latex(text: str) -> str:
+    """The converter as it was before LATEX_LEXER: ~20 passes over the whole reply"""
+    if text.count('$') > 5:
+        return text
+    result = text
+    result = result.replace('²', '^{2}')
+    result = result.replace('³', '^{3}')
+    result = result.replace('±', '\\pm')
+    trig_functions = ['sin', 'cos', 'tan', 'sec', 'csc', 'cot', 'arcsin', 'arccos', 'arctan']
+    for func in trig_functions:
+        result = re.sub(rf'\b{func}\b', rf'\\{func}', result)
+    new_lines = []
+    for line in result.split('\n'):
+        if '=' in line and any(char in line for char in ['/', '(', ')', '+', '-', '*', '^']):
+            if ':' in line:
+                parts = line.split(':', 1)
+                new_lines.append(parts[0] + ':\n$$' + parts[1].strip() + '$$')
+            else:
+                new_lines.append('$$' + line.strip() + '$$')
+        else:
+            new_lines.append(line)
+    result = '\n'.join(new_lines)
+    result = re.sub(r'\b(\d+)\s*/\s*(\d+)\b', r'$\\frac{\1}{\2}$', result)
+    result = re.sub(r'\$\$(.*?)\(([^)]+)\)\s*/\s*\(([^)]+)\)(.*?)\$\$',
+                    r'$$\1\\frac{\2}{\3}\4$$', result)
+
+    def replace_fractions_in_math(match):
+        content = re.sub(r'([^/\s]+)\s*/\s*([^/\s]+)', r'\\frac{\1}{\2}', match.group(1))
+        return '$$' + content + '$$'
+
+    return re.sub(r'\$\$(.+?)\$\$', replace_fractions_in_math, result)
+
+def stream_convert(text: str, step: int) -> str:
+    converter = StreamingLatexConverter()
+    parts = [converter.feed(text[i:i + step]) for i in range(0, len(text), step)]
+    return "".join(parts) + converter.flush()
+
+PROSE = [
+    "Let's work through this step by step.",
+    "First, recall the identity for the derivative.",
+    "So the slope of the tangent line is 3/4 at that point.",
+    "Notice that sin and cos are both periodic.",
+    "The answer is ±2, since both roots satisfy the equation.",
+    "Great question! The area grows with r² and the volume with r³.",
+    "Cost: 5 dollars per item",
+]
+EQUATIONS = [
+    "Quadratic formula: x = (-b ± sqrt(b² - 4ac)) / (2a)",
+    "tan(x) = sin(x) / cos(x)",
+    "Area: A = πr²",
+    "Volume: V = 4/3 πr³",
+    "y = 2x + 1",
+    "Derivative: d/dx sin(x) = cos(x)",
+    "(a + b) / (c - d) = 1/2",
+    "E = mc²",
+    "arctan(1) = π / 4",
+    "Speed: v = d / t",
+]
+FRAGMENTS = ["x", "=", "/", " / ", "(", ")", "+", "-", "*", "^", "²", "³", "±", ":", " ", "\n",
+             "sin", "cosine", "tan", "arcsin", "1", "23", "4", "a", "b_1", "é", "\t"]
+
+def long_answer(rng: random.Random, lines: int) -> str:
+    return "\n".join(rng.choice(EQUATIONS if rng.random() < 0.4 else PROSE) for _ in range(lines))
+
+def fuzz_text(rng: random.Random) -> str:
+    return "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 40)))
+
+def check_golden() -> int:
+    with open(GOLDEN_PATH, encoding="utf-8") as f:
+        cases = json.load(f)
+    failures = 0
+    for case in cases:
+        for label, got in (("batch", convert_math_to_latex(case["input"])),
+                           ("stream", stream_convert(case["input"], 3))):
+            if got != case["expected"]:
+                failures += 1
+                print(f"golden {label} mismatch [{case['name']}]\n  expected: {case['expected']!r}\n  got:      {got!r}")
+    print(f"golden corpus: {len(cases) - failures}/{len(cases)} ok" if not failures else f"golden corpus: {failures} mismatches")
+    return failures
+
+def differential_samples(samples: int, seed: int):
+    """(text, stream step) pairs the new converter must handle exactly like the legacy one"""
+    rng = random.Random(seed)
+    for _ in range(samples):
+        text = fuzz_text(rng)
+        if re.search(r'\d\s*\n\s*/|/\s*\n\s*\d', text):
+            continue  # Fractions no longer span line breaks
+        yield text, rng.randint(1, 7)
+
+def check_differential(samples: int, seed: int) -> int:
+    """Replies without `$` and without fractions split across lines must convert exactly as before"""
+    failures = checked = 0
+    for text, step in differential_samples(samples, seed):
+        checked += 1
+        expected = legacy_convert_math_to_latex(text)
+        if convert_math_to_latex(text) != expected or stream_convert(text, step) != expected:
+            failures += 1
+            if failures <= 5:
+                print(f"differential mismatch: {text!r}\n  legacy: {expected!r}\n  new:    {convert_math_to_latex(text)!r}")
+    print(f"differential: {checked - failures}/{checked} match the legacy converter")
+    return failures
+
+def bench(fn, texts, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for text in texts:
+            fn(text)
+    return (time.perf_counter() - start) / (iterations * len(texts)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--fuzz", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=16)
+    args = parser.parse_args()
+
+    failures = check_golden() + check_differential(args.fuzz, args.seed)
+
+    rng = random.Random(args.seed)
+    workloads = {
+        "short (5 lines)": [long_answer(rng, 5) for _ in range(50)],
+        "long (60 lines)": [long_answer(rng, 60) for _ in range(20)],
+        "very long (400 lines)": [long_answer(rng, 400) for _ in range(5)],
+    }
+    print(f"\n{'workload':<24}{'legacy us/op':>14}{'lexer us/op':>14}{'speedup':>10}")
+    for name, texts in workloads.items():
+        legacy = bench(legacy_convert_math_to_latex, texts, args.iterations)
+        lexer = bench(convert_math_to_latex, texts, args.iterations)
+        print(f"{name:<24}{legacy:>14.1f}{lexer:>14.1f}{legacy / lexer:>9.1f}x")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
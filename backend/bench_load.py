@@ -0,0 +1,301 @@
+"""Load test for every endpoint against the local Groq stand-in (fake_groq.py).
+
+Starts fake_groq.py and the backend (uvicorn, GROQ_BASE_URL pointed at the fake) on free
+ports, then drives each scenario at a fixed concurrency for a fixed time. For each it
+reports throughput, p50/p95/p99 latency, errors and the backend's event loop lag (from
+the kindminds_event_loop_lag_seconds histogram on /metrics). Request bodies are unique and
+sent with X-Cache-Bypass so caching and coalescing don't hide the work.
+
+Save a baseline once, then compare later runs against it; a blocking call added to a
+handler shows up as higher loop lag and p95 and fails the comparison:
+
+    python bench_load.py --save load_baseline.json
+    python bench_load.py --compare load_baseline.json
+
+Usage:
+    python bench_load.py [--scenarios chat,quiz] [--concurrency 16] [--duration 10]
+                         [--workers 1] [--latency-ms 300] [--tokens-per-second 400]
+                         [--error-rate 0] [--rate-limit-rate 0] [--backend-url URL]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STUDY_TEXT = (
+    "Photosynthesis converts light energy into chemical energy. The light-dependent reactions take "
+    "place in the thylakoid membranes and produce ATP and NADPH. The Calvin cycle uses them to fix "
+    "carbon dioxide into sugars in the stroma. Limiting factors include light intensity, carbon "
+    "dioxide concentration and temperature. "
+)
+LAG_METRIC = "kindminds_event_loop_lag_seconds"
+REQUEST_NUMBERS = itertools.count()  # Shared by all scenarios so no two requests repeat a body
+
+def chat_body(n: int, chat_type: str = "academic") -> dict:
+    return {"messages": [{"role": "user", "content": f"How do I differentiate tan(x)? (request {n})"}],
+            "chat_type": chat_type}
+
+# name -> (path, body factory, kind); kind is "json", "stream" (read to the end) or "job" (submit and poll)
+SCENARIOS = {
+    "chat": ("/api/chat", chat_body, "json"),
+    "chat_stream": ("/api/chat/stream", chat_body, "stream"),
+    "chat_turn": ("/api/chat/turn", lambda n: chat_body(n, "mindfulness"), "json"),
+    "reframe": ("/api/tools/reframe", lambda n: {"thought": f"I always fail my exams ({n})"}, "json"),
+    "sentiment": ("/api/tools/sentiment",
+                  lambda n: {"text": f"I guess the exam went okay but I am not sure about it {n}"}, "json"),
+    "sentiment_batch": ("/api/tools/sentiment/batch",
+                        lambda n: {"texts": [f"Not sure how I feel about week {n}, part {i}" for i in range(20)]},
+                        "json"),
+    "flashcards": ("/api/tools/flashcards", lambda n: {"content": f"{STUDY_TEXT} ({n})"}, "json"),
+    "flashcards_stream": ("/api/tools/flashcards/stream", lambda n: {"content": f"{STUDY_TEXT} ({n})"}, "stream"),
+    "quiz": ("/api/tools/quiz", lambda n: {"content": f"{STUDY_TEXT} ({n})", "num_questions": 5}, "json"),
+    "quiz_stream": ("/api/tools/quiz/stream",
+                    lambda n: {"content": f"{STUDY_TEXT} ({n})", "num_questions": 5}, "stream"),
+    "quiz_large": ("/api/tools/quiz", lambda n: {"content": f"{STUDY_TEXT * 200} ({n})", "num_questions": 8}, "json"),
+    "scan_problem": ("/api/tools/scan-problem",
+                     lambda n: {"prompt": f"Differentiate sin(x²) with respect to x ({n})"}, "json"),
+    "jobs_quiz": ("/api/jobs/quiz", lambda n: {"content": f"{STUDY_TEXT} ({n})", "num_questions": 5}, "job"),
+}
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(samples: list, fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def lag_histogram(metrics_text: str) -> dict:
+    """{upper bound: cumulative count} plus "_sum" from the loop lag histogram"""
+    histogram = {}
+    for line in metrics_text.splitlines():
+        match = re.match(rf'{LAG_METRIC}_bucket\{{le="([^"]+)"\}} (\S+)', line)
+        if match:
+            histogram[float(match.group(1))] = float(match.group(2))
+        elif line.startswith(f"{LAG_METRIC}_sum"):
+            histogram["_sum"] = float(line.split()[-1])
+    return histogram
+
+def lag_summary(before: dict, after: dict) -> dict:
+    """Mean and bucket-bound p50/p99 of the lag samples taken between two scrapes"""
+    bounds = sorted(key for key in after if key != "_sum")
+    deltas = [after[bound] - before.get(bound, 0) for bound in bounds]
+    count = deltas[-1] if deltas else 0
+    if not count:
+        return {"lag_mean_ms": 0.0, "lag_p50_ms": 0.0, "lag_p99_ms": 0.0}
+
+    def quantile(fraction):
+        for bound, cumulative in zip(bounds, deltas):
+            if cumulative >= fraction * count:
+                return bound * 1000
+        return bounds[-1] * 1000
+
+    mean = (after.get("_sum", 0) - before.get("_sum", 0)) / count
+    return {"lag_mean_ms": round(mean * 1000, 2), "lag_p50_ms": quantile(0.5), "lag_p99_ms": quantile(0.99)}
+
+async def run_job(client: httpx.AsyncClient, path: str, body: dict) -> int:
+    response = await client.post(path, json=body)
+    if response.status_code != 202:
+        return response.status_code
+    job_id = response.json()["job_id"]
+    while True:
+        await asyncio.sleep(0.05)
+        job = (await client.get(f"/api/jobs/{job_id}")).json()
+        if job["status"] in ("succeeded", "failed", "cancelled"):
+            return 200 if job["status"] == "succeeded" else 500
+
+async def run_scenario(client: httpx.AsyncClient, name: str, concurrency: int, duration: float) -> dict:
+    path, make_body, kind = SCENARIOS[name]
+    latencies, errors = [], {}
+    lag_before = lag_histogram((await client.get("/metrics")).text)
+    deadline = time.perf_counter() + duration
+
+    async def one_request():
+        body = make_body(next(REQUEST_NUMBERS))
+        started = time.perf_counter()
+        try:
+            if kind == "job":
+                status = await run_job(client, path, body)
+            elif kind == "stream":
+                async with client.stream("POST", path, json=body) as response:
+                    async for _ in response.aiter_raw():
+                        pass
+                    status = response.status_code
+            else:
+                status = (await client.post(path, json=body)).status_code
+        except httpx.HTTPError as exc:
+            status = type(exc).__name__
+        if status in (200, 202):
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            await one_request()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    lag_after = lag_histogram((await client.get("/metrics")).text)
+    return {
+        "requests": len(latencies) + sum(errors.values()),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "errors": errors,
+        **lag_summary(lag_before, lag_after),
+    }
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+def start_servers(args, state_dir: str) -> tuple:
+    fake_port, backend_port = free_port(), free_port()
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(HERE, "fake_groq.py"), "--port", str(fake_port),
+        "--latency-ms", str(args.latency_ms), "--tokens-per-second", str(args.tokens_per_second),
+        "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate), "--seed", "19",
+    ])
+    env = {
+        **os.environ,
+        "GROQ_API_KEY": "load-test",
+        "GROQ_BASE_URL": f"http://127.0.0.1:{fake_port}",
+        "LOG_LEVEL": "WARNING",
+        # Keep the test's shared state away from a real deployment's files
+        "SINGLE_FLIGHT_DB": os.path.join(state_dir, "singleflight.db"),
+        "DOCUMENT_STORE_DB": os.path.join(state_dir, "documents.db"),
+        "JOB_STORE_DB": os.path.join(state_dir, "jobs.db"),
+        "METRICS_DB": os.path.join(state_dir, "metrics.db"),
+        "METRICS_FLUSH_SECONDS": "0",
+    }
+    env.pop("RESULT_CACHE_DB", None)
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(backend_port),
+         "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"],
+        cwd=HERE, env=env,
+    )
+    try:
+        wait_until_up(f"http://127.0.0.1:{fake_port}/stats", fake)
+        wait_until_up(f"http://127.0.0.1:{backend_port}/", backend)
+    except RuntimeError:
+        stop_servers(fake, backend)
+        raise
+    return fake, backend, f"http://127.0.0.1:{backend_port}"
+
+def stop_servers(*processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Regressions of this run against a saved one, as printable lines"""
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']} -> {current['p95_ms']} ms")
+        if current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base['throughput_rps']} -> {current['throughput_rps']} req/s")
+        # Lag is measured in histogram buckets; only a move past 10 ms is a real regression
+        if current["lag_p99_ms"] > max(10.0, base["lag_p99_ms"] * (1 + tolerance)):
+            regressions.append(f"{name}: event loop lag p99 {base['lag_p99_ms']} -> {current['lag_p99_ms']} ms")
+        if sum(current["errors"].values()) > sum(base["errors"].values()) + max(1, tolerance * current["requests"]):
+            regressions.append(f"{name}: errors {base['errors']} -> {current['errors']}")
+    return regressions
+
+async def run_all(base_url: str, names: list, concurrency: int, duration: float) -> dict:
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    headers = {"X-Cache-Bypass": "1"}
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits, headers=headers) as client:
+        results = {}
+        for name in names:
+            results[name] = await run_scenario(client, name, concurrency, duration)
+            print_row(name, results[name])
+        return results
+
+def print_row(name: str, result: dict):
+    errors = sum(result["errors"].values())
+    print(f"{name:<20}{result['throughput_rps']:>9.1f}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+          f"{result['p99_ms']:>10.1f}{errors:>8}{result['lag_mean_ms']:>10.2f}{result['lag_p99_ms']:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per scenario")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the backend")
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-second", type=float, default=400)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--backend-url", help="Test an already running backend instead of starting one")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Fail if results regress against this saved JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    print(f"\n{'scenario':<20}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}"
+          f"{'lag ms':>10}{'lag p99':>10}")
+    with tempfile.TemporaryDirectory() as state_dir:
+        processes = ()
+        base_url = args.backend_url
+        if base_url is None:
+            fake, backend, base_url = start_servers(args, state_dir)
+            processes = (fake, backend)
+        try:
+            results = asyncio.run(run_all(base_url, names, args.concurrency, args.duration))
+        finally:
+            stop_servers(*processes)
+
+    config = {key: getattr(args, key) for key in
+              ("concurrency", "duration", "workers", "latency_ms", "tokens_per_second", "error_rate", "rate_limit_rate")}
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+        print(f"\nSaved to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print(f"\nNote: baseline was recorded with {baseline.get('config')}")
+        regressions = compare(results, baseline, args.tolerance)
+        print("\nRegressions:\n  " + "\n  ".join(regressions) if regressions else "\nNo regressions against the baseline")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Micro-benchmark for the local sentiment heuristic.
+
+Compares score_sentiment_locally (one tokenizing pass through LexiconMatcher)
+against the previous approach (one re.search per crisis pattern plus a substring
+scan per lexicon entry) on short chat messages and long journal-style entries.
+First checks that known crisis texts hit the crisis tier and that texts without
+positive evidence are never answered locally; exits 1 if one of them regresses.
+
+Usage:
+    python bench_sentiment.py [--iterations 2000]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import (  # noqa: E402
+    HIGH_NEGATIVE_WORDS,
+    MILD_NEGATIVE_WORDS,
+    MODERATE_NEGATIVE_WORDS,
+    POSITIVE_WORDS,
+    local_sentiment_verdict,
+    score_sentiment_locally,
+)
+
+FILLER = (
+    "today I went to the library and worked on my chemistry notes for a while "
+    "then had lunch with a friend and talked about the upcoming exams "
+    "the weather was cloudy and the bus was late again so I listened to music "
+).split()
+CUES = [
+    "stressed", "tired", "grateful", "hopeful", "overwhelmed", "calm", "confused",
+    "let down", "burned out", "progress", "relief", "worried", "proud",
+]
+
+# The crisis regexes as they were before CRISIS_PHRASES
+LEGACY_CRISIS_PATTERNS = [
+    r"harm\s+(myself|self)",
+    r"hurt\s+(myself|self)",
+    r"kill\s+(myself|self)",
+    r"suicide|suicidal",
+    r"end\s+(it\s+all|my\s+life|everything)",
+    r"want\s+to\s+die",
+    r"don'?t\s+want\s+to\s+live",
+    r"better\s+off\s+dead",
+    r"no\s+point\s+in\s+living",
+]
+
+# Must short-circuit to the crisis tier
+CRISIS_TEXTS = [
+    "im going to jump off a bridge tonight",
+    "I bought pills to overdose",
+    "I cut myself again",
+    "I want to disappear forever",
+    "my life is meaningless",
+    "kms",
+    "I just want to unalive myself",
+    "there's no reason to live anymore",
+]
+# No positive evidence (or not enough of it): must go to the LLM, never a local "neutral"
+LLM_TEXTS = [
+    "ok see you tomorrow",
+    "I don't know what to do",
+    "I feel empty but grateful",
+    "everything is so heavy lately",
+    "nobody would notice if I was gone",
+]
+
+def check_safety() -> int:
+    failures = 0
+    for text in CRISIS_TEXTS:
+        verdict, _ = local_sentiment_verdict(text)
+        if verdict is None or verdict.tier != "crisis":
+            failures += 1
+            print(f"not flagged as crisis: {text!r} -> {verdict}")
+    for text in LLM_TEXTS:
+        verdict, _ = local_sentiment_verdict(text)
+        if verdict is not None:
+            failures += 1
+            print(f"answered locally instead of by the LLM: {text!r} -> {verdict}")
+    total = len(CRISIS_TEXTS) + len(LLM_TEXTS)
+    print(f"safety cases: {total - failures}/{total} ok\n")
+    return failures
+
+def legacy_scan(text: str) -> tuple:
+    """The original per-request scan: ~70 full-text searches per message"""
+    lower_text = text.lower()
+    if any(re.search(pattern, lower_text) for pattern in LEGACY_CRISIS_PATTERNS):
+        return (True, 0, 0, 0, 0)
+    return (
+        False,
+        sum(1 for phrase in HIGH_NEGATIVE_WORDS if phrase in lower_text),
+        sum(1 for word in MODERATE_NEGATIVE_WORDS if word in lower_text),
+        sum(1 for word in MILD_NEGATIVE_WORDS if word in lower_text),
+        sum(1 for word in POSITIVE_WORDS if word in lower_text),
+    )
+
+def make_entry(rng: random.Random, words: int) -> str:
+    out = []
+    while len(out) < words:
+        out.extend(rng.sample(FILLER, 8))
+        out.append(rng.choice(CUES))
+    return " ".join(out[:words]) + "."
+
+def time_per_call(fn, texts, iterations: int) -> float:
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(texts[i % len(texts)])
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    failures = check_safety()
+    rng = random.Random(42)
+    corpora = {
+        "chat (12 words)": [make_entry(rng, 12) for _ in range(50)],
+        "journal (400 words)": [make_entry(rng, 400) for _ in range(50)],
+        "journal (2000 words)": [make_entry(rng, 2000) for _ in range(20)],
+    }
+
+    print(f"{'input':<22}{'legacy us/msg':>16}{'compiled us/msg':>18}{'speedup':>10}")
+    for name, texts in corpora.items():
+        legacy = time_per_call(legacy_scan, texts, args.iterations)
+        compiled = time_per_call(score_sentiment_locally, texts, args.iterations)
+        print(f"{name:<22}{legacy:>16.1f}{compiled:>18.1f}{legacy / compiled:>9.1f}x")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Benchmark response serialization for quiz and flashcard payloads.
+
+Compares the previous path, where the handler returned a pydantic model and FastAPI
+validated it again against response_model before encoding it with the stdlib json
+module, with payload_response (one pydantic serialization, no re-validation). Also
+reports bytes on the wire for identity, gzip and, if installed, brotli.
+
+Usage:
+    python bench_serialization.py [--iterations 2000] [--questions 10]
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import APIRoute, serialize_response  # noqa: E402
+
+from main import (  # noqa: E402
+    RESPONSE_BROTLI_QUALITY, RESPONSE_COMPRESSION_MIN_BYTES, RESPONSE_GZIP_LEVEL, FlashcardsResponse, QuizOption,
+    QuizQuestion, QuizResponse, app, brotli, orjson, payload_response, sanitize_flashcards,
+)
+
+def sample_quiz(questions: int) -> QuizResponse:
+    """A quiz shaped like a real generation: four options, LaTeX and a sentence or two of explanation"""
+    return QuizResponse(title="Calculus I – Derivatives and Limits", questions=[
+        QuizQuestion(
+            question=f"Question {index + 1}: what is $\\frac{{d}}{{dx}} \\sin(x^{{{index + 2}}})$ at $x = 0$?",
+            options=[
+                QuizOption(text=f"${letter}x^{{{index + 1}}} \\cos(x^{{{index + 2}}})$", is_correct=letter == "B")
+                for letter in ("1", "2", "3", "4")
+            ],
+            explanation=(
+                "Apply the chain rule: differentiate the outer sine to get the cosine, then multiply "
+                f"by the derivative of the inner power, {index + 2}x^{index + 1}. At x = 0 the product vanishes."
+            ),
+        )
+        for index in range(questions)
+    ])
+
+def sample_flashcards(cards: int) -> FlashcardsResponse:
+    return FlashcardsResponse(title="Cell Biology", cards=sanitize_flashcards([
+        {"question": f"What does organelle number {index + 1} do in a eukaryotic cell?",
+         "answer": "It packages proteins into vesicles and sends them to their destination in the cell."}
+        for index in range(cards)
+    ]))
+
+def response_field(path: str):
+    route = next(route for route in app.routes if isinstance(route, APIRoute) and route.path == path)
+    return route.response_field
+
+LOOP = asyncio.new_event_loop()
+
+def legacy_render(field, model) -> bytes:
+    """What FastAPI did with a returned model: validate it against response_model, then json.dumps"""
+    content = LOOP.run_until_complete(serialize_response(field=field, response_content=model, is_coroutine=True))
+    return JSONResponse(content).body
+
+def bench(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--questions", type=int, default=10)
+    args = parser.parse_args()
+
+    workloads = {
+        f"quiz ({args.questions} questions)": ("/api/tools/quiz", sample_quiz(args.questions)),
+        "flashcards (12 cards)": ("/api/tools/flashcards", sample_flashcards(12)),
+    }
+    failures = 0
+    print(f"{'payload':<26}{'legacy us/op':>14}{'new us/op':>12}{'speedup':>10}")
+    sizes = {}
+    for name, (path, model) in workloads.items():
+        field = response_field(path)
+        legacy_body = legacy_render(field, model)
+        new_body = payload_response(model).body
+        if json.loads(legacy_body) != json.loads(new_body):
+            failures += 1
+            print(f"{name}: new body differs from the legacy one")
+        legacy = bench(lambda: legacy_render(field, model), args.iterations)
+        new = bench(lambda: payload_response(model).body, args.iterations)
+        print(f"{name:<26}{legacy:>14.1f}{new:>12.1f}{legacy / new:>9.1f}x")
+        sizes[name] = new_body
+
+    print(f"\n{'payload':<26}{'identity B':>12}{'gzip B':>10}{'gzip us':>10}{'br B':>8}{'br us':>8}")
+    for name, body in sizes.items():
+        gzipped = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+        gzip_us = bench(lambda: gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0), args.iterations)
+        if brotli is not None:
+            br_size = len(brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY))
+            br_us = bench(lambda: brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY), args.iterations)
+            br = f"{br_size:>8}{br_us:>8.1f}"
+        else:
+            br = f"{'n/a':>8}{'':>8}"
+        print(f"{name:<26}{len(body):>12}{len(gzipped):>10}{gzip_us:>10.1f}{br}")
+    print(f"\nencoder: {'orjson' if orjson is not None else 'stdlib json'} (pydantic serializer for models), "
+          f"compression from {RESPONSE_COMPRESSION_MIN_BYTES} bytes")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Local stand-in for the Groq chat completions API, for load tests without spending quota.
+
+Serves POST /openai/v1/chat/completions (streaming and non-streaming) with canned
+replies chosen from the system prompt: quiz, flashcards, scan-problem and sentiment
+(single and batch) get valid JSON, summaries and chat get plain text with some math.
+Replies longer than max_tokens are cut off, and in JSON mode a cut-off reply is
+answered with Groq's 400 json_validate_failed error. Latency, token rate and injected
+5xx / 429 errors are configurable.
+
+Usage:
+    python fake_groq.py [--port 8900] [--latency-ms 300] [--tokens-per-second 400]
+                        [--error-rate 0] [--rate-limit-rate 0]
+
+Then start the backend with GROQ_BASE_URL=http://127.0.0.1:8900 (bench_load.py does this).
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CHAT_REPLY = (
+    "Great question! Let's work through it step by step.\n"
+    "First, recall the identity for the tangent function.\n"
+    "tan(x) = sin(x) / cos(x)\n"
+    "So the slope at that point is 3/4, and the area grows with r².\n"
+    "Quadratic formula: x = (-b ± sqrt(b² - 4ac)) / (2a)\n"
+    "Let me know if you'd like another example."
+)
+REFRAME_REPLY = (
+    "It makes sense to feel this way after a hard week, and one difficult exam does not define "
+    "your ability. You can review what went wrong and plan one small next step for tomorrow."
+)
+SUMMARY_REPLY = "The user is preparing for exams, asked about trigonometric identities and felt stressed about time."
+
+def quiz_reply(count: int) -> dict:
+    return {
+        "title": "Practice Quiz",
+        "questions": [
+            {
+                "question": f"Which statement about concept {index + 1} is correct?",
+                "options": [
+                    {"text": f"Statement {index + 1}{letter}", "is_correct": letter == "B"}
+                    for letter in "ABCD"
+                ],
+                "explanation": f"Statement {index + 1}B follows from the definition in the material.",
+            }
+            for index in range(count)
+        ],
+    }
+
+def flashcards_reply(count: int) -> dict:
+    return {
+        "title": "Study Set",
+        "cards": [
+            {"question": f"What is key term number {index + 1}?", "answer": f"Definition of term {index + 1}."}
+            for index in range(count)
+        ],
+    }
+
+def canned_reply(messages: list) -> str:
+    """The reply text for a request, picked by what its system prompt asks for"""
+    system = next((message["content"] for message in messages if message.get("role") == "system"), "")
+    user = messages[-1]["content"] if messages else ""
+    lowered = system.lower()
+    if "sentiment analysis expert" in lowered:
+        if "numbered texts" not in lowered:
+            return json.dumps({"sentiment": "negative", "score": -0.35})
+        ids = [int(number) for number in re.findall(r"^Text (\d+):", user, re.MULTILINE)]
+        return json.dumps({"results": [
+            {"id": number, "sentiment": "negative", "score": -0.3} for number in ids
+        ]})
+    if "quiz questions" in lowered:
+        count = re.search(r"Generate (\d+)", system)
+        return json.dumps(quiz_reply(int(count.group(1)) if count else 5))
+    if "builds flashcards" in lowered:
+        count = re.search(r"Return (\d+) high-quality", system)
+        return json.dumps(flashcards_reply(int(count.group(1)) if count else 6))
+    if "analyses academic problems" in lowered:
+        return json.dumps({
+            "summary": "The problem asks for the derivative of a composite function.",
+            "key_points": ["Identify the inner and outer functions", "Apply the chain rule"],
+            "recommended_steps": ["Write u = g(x)", "Differentiate f(u) and multiply by g'(x)"],
+        })
+    if "summarize conversations" in lowered:
+        return SUMMARY_REPLY
+    if "cognitive behavioral" in lowered:
+        return REFRAME_REPLY
+    return CHAT_REPLY
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+def error_response(status: int, kind: str, message: str, headers: dict = None) -> JSONResponse:
+    return JSONResponse({"error": {"message": message, "type": kind}}, status_code=status, headers=headers)
+
+def create_app(latency_ms: float, jitter_ms: float, tokens_per_second: float,
+               error_rate: float, rate_limit_rate: float, retry_after: float) -> FastAPI:
+    app = FastAPI()
+    stats = {"requests": 0, "streams": 0, "errors": 0, "rate_limited": 0}
+
+    async def first_byte_delay():
+        await asyncio.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000)
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        roll = random.random()
+        if roll < rate_limit_rate:
+            stats["rate_limited"] += 1
+            return error_response(429, "rate_limit_exceeded", "Rate limit reached (injected)",
+                                  {"retry-after": str(retry_after)})
+        if roll < rate_limit_rate + error_rate:
+            stats["errors"] += 1
+            await first_byte_delay()
+            return error_response(500, "internal_server_error", "Injected upstream failure")
+
+        model = body.get("model", "llama-3.3-70b-versatile")
+        text = canned_reply(body.get("messages", []))
+        finish_reason = "stop"
+        max_tokens = body.get("max_tokens")
+        if max_tokens and count_tokens(text) > max_tokens:
+            text, finish_reason = text[:max_tokens * 4], "length"
+            json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+            if json_mode and not body.get("stream"):
+                await first_byte_delay()
+                return JSONResponse({"error": {
+                    "message": "Failed to generate JSON. Please adjust your prompt. See 'failed_generation' for more details.",
+                    "type": "invalid_request_error", "code": "json_validate_failed", "failed_generation": text,
+                }}, status_code=400)
+        prompt_tokens = sum(count_tokens(str(message.get("content", ""))) for message in body.get("messages", []))
+        completion_tokens = count_tokens(text)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await first_byte_delay()
+            if tokens_per_second > 0:
+                await asyncio.sleep(completion_tokens / tokens_per_second)
+            return {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": finish_reason,
+                             "message": {"role": "assistant", "content": text}}],
+                "usage": usage,
+            }
+
+        stats["streams"] += 1
+
+        def frame(delta: dict, finish_reason=None, x_groq=None) -> str:
+            chunk = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            if x_groq is not None:
+                chunk["x_groq"] = x_groq
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        async def event_source():
+            await first_byte_delay()
+            yield frame({"role": "assistant", "content": ""})
+            # Emit about 20 ms worth of tokens per chunk
+            step = max(4, int(tokens_per_second * 0.02) * 4) if tokens_per_second > 0 else len(text)
+            for start in range(0, len(text), step):
+                piece = text[start:start + step]
+                if tokens_per_second > 0:
+                    await asyncio.sleep(count_tokens(piece) / tokens_per_second)
+                yield frame({"content": piece})
+            yield frame({}, finish_reason, {"id": completion_id, "usage": usage})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_source(), media_type="text/event-stream")
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=300, help="Time to first byte")
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--tokens-per-second", type=float, default=400, help="Generation speed (0 = instant)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    random.seed(args.seed)
+    app = create_app(args.latency_ms, args.jitter_ms, args.tokens_per_second,
+                     args.error_rate, args.rate_limit_rate, args.retry_after)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
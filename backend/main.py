@@ -1,19 +1,1327 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Response, UploadFile, File, Form, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.datastructures import Headers, MutableHeaders
+from pydantic import BaseModel, field_validator, model_validator
 from typing import List, Optional
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from collections import OrderedDict, deque
+import asyncio
+import atexit
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import logging
+import logging.handlers
+import math
 import os
+import queue
+import random
 import re
 import json
-from groq import Groq
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from groq import AsyncGroq, APIConnectionError, BadRequestError, InternalServerError, RateLimitError
+from groq.types.chat import ChatCompletion
 from dotenv import load_dotenv
 import httpx
-import json
+
+try:
+    import numpy as np
+except ImportError:  # Optional: the semantic cache falls back to an inverted index
+    np = None
+
+try:
+    import orjson
+except ImportError:  # Optional: responses fall back to the stdlib json encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Optional: large responses are then compressed with gzip only
+    brotli = None
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI()
+# Structured logging. Records are handed to a background thread through a bounded queue, so
+# logging never blocks the event loop on stdout, and user text is redacted before it is written.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Per-area levels, e.g. "sentiment=DEBUG,chat=WARNING" (areas: chat, sentiment, jobs)
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # "json" or "text"
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1"))  # Share of requests whose debug events are kept
+LOG_REDACT = os.getenv("LOG_REDACT", "true").lower() in ("1", "true", "yes")
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))  # Records beyond this are dropped rather than waited on
+
+# Fields that may carry request bodies or model output
+REDACTED_LOG_FIELDS = frozenset({"text", "content", "messages", "prompt", "thought", "raw"})
+# API keys and bearer tokens, scrubbed from the whole line (upstream errors can echo request headers)
+SECRET_LOG_PATTERN = re.compile(r"gsk_[A-Za-z0-9]+|\b[Bb]earer\s+[A-Za-z0-9._~+/=-]+")
+
+# Per-request log context, set by RequestContextMiddleware
+log_request_id: ContextVar[Optional[str]] = ContextVar("log_request_id", default=None)
+log_debug_sampled: ContextVar[Optional[bool]] = ContextVar("log_debug_sampled", default=None)
+
+class LogContextFilter(logging.Filter):
+    """Tag records with the request id and drop debug records of requests not sampled.
+
+    Runs in the caller before the record is queued, so the per-request decision made by
+    the middleware applies; outside a request each debug record is sampled on its own.
+    """
+
+    def __init__(self, debug_sample_rate: float):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = log_request_id.get()
+        if record.levelno >= logging.INFO or self.debug_sample_rate >= 1:
+            return True
+        sampled = log_debug_sampled.get()
+        return random.random() < self.debug_sample_rate if sampled is None else sampled
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread and drops records when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # Same process: no need to pre-format for pickling
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class StructuredFormatter(logging.Formatter):
+    """One JSON object (or one key=value line) per record, with `extra` fields included.
+
+    Fields in REDACTED_LOG_FIELDS are replaced by their length and a short hash, which is
+    enough to tell whether two log lines are about the same text without storing it, and
+    anything that looks like an API key is masked wherever it appears.
+    """
+
+    RESERVED = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+    def __init__(self, as_json: bool, redact: bool):
+        super().__init__()
+        self.as_json = as_json
+        self.redact = redact
+
+    @staticmethod
+    def redacted(value) -> str:
+        text = value if isinstance(value, str) else json.dumps(value, default=str, ensure_ascii=False)
+        return f"<redacted len={len(text)} sha256={hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]}>"
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                entry[key] = self.redacted(value) if self.redact and key in REDACTED_LOG_FIELDS else value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if self.as_json:
+            line = json.dumps(entry, default=str, ensure_ascii=False)
+        else:
+            head = f"{entry.pop('ts')} {entry.pop('level')} [{entry.pop('logger')}] {entry.pop('event')}"
+            exc = entry.pop("exc", None)
+            fields = " ".join(f"{key}={value}" for key, value in entry.items())
+            line = " ".join(part for part in (head, fields) if part) + (f"\n{exc}" if exc else "")
+        return SECRET_LOG_PATTERN.sub("<redacted key>", line) if self.redact else line
+
+def configure_logging() -> NonBlockingQueueHandler:
+    """Send the "kindminds" loggers through a queue to stdout and apply LOG_LEVEL / LOG_LEVELS"""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(as_json=LOG_FORMAT == "json", redact=LOG_REDACT))
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_MAX))
+    handler.addFilter(LogContextFilter(LOG_DEBUG_SAMPLE_RATE))
+    listener = logging.handlers.QueueListener(handler.queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)  # Drains the queue on shutdown
+
+    root = logging.getLogger("kindminds")
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+    root.propagate = False
+    for override in filter(None, (part.strip() for part in LOG_LEVELS.split(","))):
+        area, _, level = override.partition("=")
+        logging.getLogger(f"kindminds.{area.strip()}").setLevel(level.strip().upper())
+    return handler
+
+log_handler = configure_logging()
+chat_log = logging.getLogger("kindminds.chat")
+sentiment_log = logging.getLogger("kindminds.sentiment")
+jobs_log = logging.getLogger("kindminds.jobs")
+tools_log = logging.getLogger("kindminds.tools")
+overload_log = logging.getLogger("kindminds.overload")
+
+# Initialize Groq client
+groq_api_key = os.getenv("GROQ_API_KEY")
+if not groq_api_key:
+    raise ValueError("GROQ_API_KEY not found in environment variables. Please check your .env file.")
+
+# Upstream connection settings - one pooled async client is shared by every endpoint,
+# so a single worker can keep many generations in flight without blocking the event loop
+GROQ_MAX_CONNECTIONS = int(os.getenv("GROQ_MAX_CONNECTIONS", "100"))
+GROQ_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("GROQ_MAX_KEEPALIVE_CONNECTIONS", "20"))
+GROQ_CONNECT_TIMEOUT = float(os.getenv("GROQ_CONNECT_TIMEOUT", "5"))
+GROQ_MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", "2"))
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL")  # Point at another OpenAI-compatible server, e.g. fake_groq.py
+
+# Per-endpoint read timeouts (seconds) for a single upstream generation
+UPSTREAM_TIMEOUTS = {
+    "chat": float(os.getenv("GROQ_TIMEOUT_CHAT", "60")),
+    "reframe": float(os.getenv("GROQ_TIMEOUT_REFRAME", "30")),
+    "flashcards": float(os.getenv("GROQ_TIMEOUT_FLASHCARDS", "90")),
+    "quiz": float(os.getenv("GROQ_TIMEOUT_QUIZ", "120")),
+    "scan_problem": float(os.getenv("GROQ_TIMEOUT_SCAN_PROBLEM", "60")),
+    "sentiment": float(os.getenv("GROQ_TIMEOUT_SENTIMENT", "10")),
+    "sentiment_batch": float(os.getenv("GROQ_TIMEOUT_SENTIMENT_BATCH", "60")),
+}
+
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=GROQ_MAX_CONNECTIONS,
+        max_keepalive_connections=GROQ_MAX_KEEPALIVE_CONNECTIONS,
+    ),
+    timeout=httpx.Timeout(max(UPSTREAM_TIMEOUTS.values()), connect=GROQ_CONNECT_TIMEOUT),
+)
+
+# Retries (up to GROQ_MAX_RETRIES) are done by the upstream scheduler below, so a 429 pauses every lane
+client = AsyncGroq(api_key=groq_api_key, base_url=GROQ_BASE_URL, http_client=http_client, max_retries=0)
+
+# Single-flight: identical concurrent upstream calls share one generation
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() in ("1", "true", "yes")
+# SQLite file used to coordinate leaders across workers; empty (the default) for per-worker coalescing only
+SINGLE_FLIGHT_DB = os.getenv("SINGLE_FLIGHT_DB", "")
+# Endpoints that take the cross-worker lease; cheaper calls only coalesce within a worker, which costs nothing
+SINGLE_FLIGHT_LEASE_ENDPOINTS = {
+    name.strip() for name in os.getenv("SINGLE_FLIGHT_LEASE_ENDPOINTS", "quiz,flashcards").split(",") if name.strip()
+}
+SINGLE_FLIGHT_POLL_SECONDS = float(os.getenv("SINGLE_FLIGHT_POLL_SECONDS", "0.1"))
+# How long a finished result stays readable for callers that were already waiting on it (not a cache)
+SINGLE_FLIGHT_RESULT_TTL_SECONDS = float(os.getenv("SINGLE_FLIGHT_RESULT_TTL_SECONDS", "1"))
+
+class SingleFlight:
+    """Coalesce identical in-flight calls.
+
+    Within a worker, callers with the same key await one shared task; the task is only
+    cancelled once every caller waiting on it has gone away, so a disconnecting first
+    caller does not abort the generation for the others. Across workers, a SQLite row
+    acts as a lease: the worker that claims it runs the call and publishes the result,
+    the others poll for it and take over if the leader fails or its lease expires. The
+    lease costs a few SQLite writes per call, so callers opt in with `cross_worker`. Only
+    calls still in flight are shared: a caller arriving after the result was published
+    starts a new generation, so a client's X-Cache-Bypass is never answered from here.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, poll_interval: float = 0.1, result_ttl: float = 1):
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self._inflight = {}  # key -> {"task": Task, "waiters": int}
+        self.stats = {"leader_calls": 0, "local_joins": 0, "remote_joins": 0, "cancelled": 0}
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS flights (key TEXT PRIMARY KEY, payload TEXT, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    async def run(self, key: str, factory, lease_seconds: float, serialize, deserialize, cross_worker: bool = True):
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.create_task(
+                self._lead_or_follow(key, factory, lease_seconds, serialize, deserialize, cross_worker)
+            )
+            entry = self._inflight[key] = {"task": task, "waiters": 0}
+            task.add_done_callback(lambda _: self._inflight.get(key) is entry and self._inflight.pop(key))
+        else:
+            self.stats["local_joins"] += 1
+
+        entry["waiters"] += 1
+        try:
+            return await asyncio.shield(entry["task"])
+        finally:
+            entry["waiters"] -= 1
+            if entry["waiters"] == 0 and not entry["task"].done():
+                # The last interested caller is gone (e.g. client disconnected)
+                self.stats["cancelled"] += 1
+                entry["task"].cancel()
+
+    def _claim(self, key: str, lease_seconds: float) -> bool:
+        with self._db_lock:
+            now = time.time()
+            self._db.execute("DELETE FROM flights WHERE expires_at <= ?", (now,))
+            # A published result belongs to a finished flight, kept only for its followers' next poll
+            self._db.execute("DELETE FROM flights WHERE key = ? AND payload IS NOT NULL", (key,))
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO flights (key, payload, expires_at) VALUES (?, NULL, ?)", (key, now + lease_seconds)
+            )
+            self._db.commit()
+            return cursor.rowcount == 1
+
+    def _publish(self, key: str, payload: str):
+        with self._db_lock:
+            self._db.execute(
+                "UPDATE flights SET payload = ?, expires_at = ? WHERE key = ?",
+                (payload, time.time() + self.result_ttl, key),
+            )
+            self._db.commit()
+
+    def _release(self, key: str):
+        with self._db_lock:
+            self._db.execute("DELETE FROM flights WHERE key = ? AND payload IS NULL", (key,))
+            self._db.commit()
+
+    def _poll(self, key: str):
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT payload FROM flights WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+
+    async def _lead_or_follow(self, key, factory, lease_seconds, serialize, deserialize, cross_worker):
+        if self._db is None or not cross_worker:
+            self.stats["leader_calls"] += 1
+            return await factory()
+
+        followed = False
+        while True:
+            if await asyncio.to_thread(self._claim, key, lease_seconds):
+                self.stats["leader_calls"] += 1
+                try:
+                    result = await factory()
+                except BaseException:
+                    await asyncio.shield(asyncio.to_thread(self._release, key))
+                    raise
+                await asyncio.to_thread(self._publish, key, serialize(result))
+                return result
+
+            # Another worker is running this call; wait for its result or for the lease to lapse
+            if not followed:
+                self.stats["remote_joins"] += 1
+                followed = True
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                row = await asyncio.to_thread(self._poll, key)
+                if row is None:
+                    break  # Leader failed or lease expired; try to take over
+                if row[0] is not None:
+                    return deserialize(row[0])
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "in_flight": len(self._inflight), "cross_worker": self._db is not None}
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+single_flight = SingleFlight(
+    db_path=SINGLE_FLIGHT_DB or None,
+    poll_interval=SINGLE_FLIGHT_POLL_SECONDS,
+    result_ttl=SINGLE_FLIGHT_RESULT_TTL_SECONDS,
+)
+
+# Upstream scheduler: priority lanes and rate budgets shared by every endpoint in this worker.
+# Lower numbers are dispatched first, so bulk quiz/flashcard generations cannot starve sentiment checks.
+UPSTREAM_PRIORITIES = {
+    "sentiment": 0,
+    "chat": 1,
+    "reframe": 2,
+    "scan_problem": 3,
+    "flashcards": 4,
+    "quiz": 4,
+    "sentiment_batch": 5,  # Offline re-analysis yields to every interactive call
+}
+# Longest a call may wait for a slot before the request fails with a 503 and a Retry-After hint
+UPSTREAM_QUEUE_DEADLINES = {
+    "chat": float(os.getenv("UPSTREAM_QUEUE_DEADLINE_CHAT", "20")),
+    "reframe": float(os.getenv("UPSTREAM_QUEUE_DEADLINE_REFRAME", "20")),
+    "flashcards": float(os.getenv("UPSTREAM_QUEUE_DEADLINE_FLASHCARDS", "30")),
+    "quiz": float(os.getenv("UPSTREAM_QUEUE_DEADLINE_QUIZ", "30")),
+    "scan_problem": float(os.getenv("UPSTREAM_QUEUE_DEADLINE_SCAN_PROBLEM", "30")),
+    "sentiment": float(os.getenv("UPSTREAM_QUEUE_DEADLINE_SENTIMENT", "5")),
+    "sentiment_batch": float(os.getenv("UPSTREAM_QUEUE_DEADLINE_SENTIMENT_BATCH", "60")),
+}
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "32"))
+# Provider budgets for this worker (divide the account's limits by the number of workers); 0 disables a bucket
+GROQ_RPM_LIMIT = float(os.getenv("GROQ_RPM_LIMIT", "0"))
+GROQ_TPM_LIMIT = float(os.getenv("GROQ_TPM_LIMIT", "0"))
+
+class UpstreamBusyError(HTTPException):
+    """The upstream queue could not admit a call in time; maps to 503 with a retry hint"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(
+            status_code=503,
+            detail="The AI service is busy right now. Please try again shortly.",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute and holds at most one minute's worth"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available (0 if they are available now)"""
+        if self.capacity <= 0:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60 / self.capacity
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self.level -= min(amount, self.capacity)
+
+    def refund(self, amount: float):
+        if self.capacity > 0 and amount > 0:
+            self.level = min(self.capacity, self.level + amount)
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Seconds the provider asked us to wait, from Retry-After(-Ms) headers"""
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name) if headers is not None else None
+        if value:
+            try:
+                return max(0.0, float(value) * scale)
+            except ValueError:
+                continue
+    return None
+
+def retry_backoff(attempt: int) -> float:
+    """Jittered exponential backoff for retries without a provider hint"""
+    return min(8.0, 0.5 * 2 ** attempt) * (0.5 + random.random() / 2)
+
+class UpstreamScheduler:
+    """Admit upstream calls by priority under a concurrency cap and RPM/TPM token buckets.
+
+    Waiting calls sit in one priority queue; the head is dispatched as soon as a slot is
+    free and both buckets can cover it. A 429 pauses dispatch for every lane until the
+    provider's Retry-After has passed, then the call is re-queued. Calls that cannot be
+    admitted within their lane's deadline fail fast with UpstreamBusyError.
+    """
+
+    def __init__(self, priorities: dict, deadlines: dict, max_concurrency: int,
+                 requests_per_minute: float, tokens_per_minute: float, max_retries: int):
+        self.priorities = priorities
+        self.deadlines = deadlines
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._queue = []  # heap of (priority, seq, waiter)
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._timer = None
+        self.lanes = {
+            endpoint: {"queued": 0, "in_flight": 0, "admitted": 0, "rejected": 0, "rate_limited": 0,
+                       "waits": deque(maxlen=500)}
+            for endpoint in priorities
+        }
+
+    async def call(self, endpoint: str, factory, cost: float, on_admit=None):
+        """Run `factory()` once admitted, retrying rate limits and transient upstream errors.
+
+        `on_admit()` is called each time the call leaves the queue, just before it goes upstream.
+        """
+        lane = self.lanes[endpoint]
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(endpoint, cost)
+            if on_admit is not None:
+                on_admit()
+            try:
+                result = await factory()
+            except RateLimitError as exc:
+                lane["rate_limited"] += 1
+                # A rejected call used none of the provider's budget, so hand back what it was charged
+                self.requests.refund(1)
+                self.tokens.refund(cost)
+                wait = retry_after_seconds(exc.response.headers)
+                wait = retry_backoff(attempt) if wait is None else wait
+                self._paused_until = max(self._paused_until, time.monotonic() + wait)
+                if attempt == self.max_retries:
+                    raise UpstreamBusyError(wait) from exc
+                continue  # Re-queued; dispatch stays paused until the provider's Retry-After
+            except (APIConnectionError, InternalServerError):
+                if attempt == self.max_retries:
+                    raise
+            else:
+                # The bucket was charged for max_tokens; give back what the generation did not use
+                usage = getattr(result, "usage", None)
+                if usage is not None and getattr(usage, "total_tokens", None):
+                    self.tokens.refund(cost - usage.total_tokens)
+                return result
+            finally:
+                self._release(endpoint)
+            # Back off without holding a slot; the retry queues for a new one
+            await asyncio.sleep(retry_backoff(attempt))
+
+    async def _acquire(self, endpoint: str, cost: float):
+        lane = self.lanes[endpoint]
+        deadline = self.deadlines[endpoint]
+        started = time.monotonic()
+        paused_for = self._paused_until - started
+        if paused_for > deadline:
+            lane["rejected"] += 1
+            raise UpstreamBusyError(paused_for)
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = {"endpoint": endpoint, "cost": cost, "future": future}
+        heapq.heappush(self._queue, (self.priorities[endpoint], next(self._seq), waiter))
+        lane["queued"] += 1
+        self._dispatch()
+        try:
+            await asyncio.wait_for(future, timeout=deadline)
+        except asyncio.TimeoutError:
+            lane["rejected"] += 1
+            raise UpstreamBusyError(max(self._paused_until - time.monotonic(), self._estimated_wait()))
+        except BaseException:
+            # Cancelled (e.g. client went away) just after being admitted: hand the slot back
+            if future.done() and not future.cancelled():
+                self._release(endpoint)
+            raise
+        finally:
+            lane["queued"] -= 1
+        lane["waits"].append(time.monotonic() - started)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue and self._in_flight < self.max_concurrency:
+            waiter = self._queue[0][2]
+            if waiter["future"].done():
+                heapq.heappop(self._queue)  # Timed out or cancelled while queued
+                continue
+            now = time.monotonic()
+            delay = max(
+                self._paused_until - now,
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(waiter["cost"], now),
+            )
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            self.requests.take(1)
+            self.tokens.take(waiter["cost"])
+            self._in_flight += 1
+            lane = self.lanes[waiter["endpoint"]]
+            lane["in_flight"] += 1
+            lane["admitted"] += 1
+            waiter["future"].set_result(None)
+
+    def _release(self, endpoint: str):
+        self._in_flight -= 1
+        self.lanes[endpoint]["in_flight"] -= 1
+        if self._queue:
+            self._dispatch()
+
+    def _estimated_wait(self) -> float:
+        waits = [wait for lane in self.lanes.values() for wait in lane["waits"]]
+        return sum(waits) / len(waits) if waits else 1.0
+
+    def snapshot(self) -> dict:
+        lanes = {}
+        for endpoint, lane in self.lanes.items():
+            waits = sorted(lane["waits"])
+            lanes[endpoint] = {
+                "priority": self.priorities[endpoint],
+                "queued": lane["queued"],
+                "in_flight": lane["in_flight"],
+                "admitted": lane["admitted"],
+                "rejected": lane["rejected"],
+                "rate_limited": lane["rate_limited"],
+                "wait_avg_ms": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+                "wait_p95_ms": round(1000 * waits[int(0.95 * (len(waits) - 1))], 1) if waits else 0.0,
+                "wait_max_ms": round(1000 * waits[-1], 1) if waits else 0.0,
+            }
+        now = time.monotonic()
+        return {
+            "queue_depth": sum(lane["queued"] for lane in self.lanes.values()),
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "paused_for_seconds": round(max(0.0, self._paused_until - now), 2),
+            "requests_available": round(self.requests.level, 1) if self.requests.capacity > 0 else None,
+            "tokens_available": round(self.tokens.level) if self.tokens.capacity > 0 else None,
+            "lanes": lanes,
+        }
+
+upstream_scheduler = UpstreamScheduler(
+    priorities=UPSTREAM_PRIORITIES,
+    deadlines=UPSTREAM_QUEUE_DEADLINES,
+    max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+    requests_per_minute=GROQ_RPM_LIMIT,
+    tokens_per_minute=GROQ_TPM_LIMIT,
+    max_retries=GROQ_MAX_RETRIES,
+)
+
+# Model routing: each endpoint has a primary model, a faster fallback and a latency budget
+DEFAULT_PRIMARY_MODEL = os.getenv("MODEL_PRIMARY", "llama-3.3-70b-versatile")
+DEFAULT_FALLBACK_MODEL = os.getenv("MODEL_FALLBACK", "llama-3.1-8b-instant")
+MODEL_DOWNGRADE_MIN_SAMPLES = int(os.getenv("MODEL_DOWNGRADE_MIN_SAMPLES", "20"))
+MODEL_DOWNGRADE_ERRORS = int(os.getenv("MODEL_DOWNGRADE_ERRORS", "3"))  # Consecutive primary failures
+MODEL_DOWNGRADE_COOLDOWN_SECONDS = float(os.getenv("MODEL_DOWNGRADE_COOLDOWN_SECONDS", "60"))
+
+def model_route(endpoint: str, latency_budget: float, hedge_delay: float) -> dict:
+    """Route for one endpoint; MODEL_*_<ENDPOINT> variables override the defaults"""
+    name = endpoint.upper()
+    return {
+        "primary": os.getenv(f"MODEL_PRIMARY_{name}", DEFAULT_PRIMARY_MODEL),
+        "fallback": os.getenv(f"MODEL_FALLBACK_{name}", DEFAULT_FALLBACK_MODEL) or None,  # Empty disables fallback
+        "latency_budget": float(os.getenv(f"MODEL_LATENCY_BUDGET_{name}", str(latency_budget))),  # p95 seconds
+        "hedge_delay": float(os.getenv(f"MODEL_HEDGE_DELAY_{name}", str(hedge_delay))),  # 0 disables hedging
+    }
+
+MODEL_ROUTES = {
+    "chat": model_route("chat", latency_budget=8, hedge_delay=0),
+    "reframe": model_route("reframe", latency_budget=4, hedge_delay=2.5),
+    "flashcards": model_route("flashcards", latency_budget=20, hedge_delay=0),
+    "quiz": model_route("quiz", latency_budget=30, hedge_delay=0),
+    "scan_problem": model_route("scan_problem", latency_budget=12, hedge_delay=0),
+    "sentiment": model_route("sentiment", latency_budget=1.5, hedge_delay=0.8),
+    "sentiment_batch": model_route("sentiment_batch", latency_budget=20, hedge_delay=0),
+}
+
+# Models that served the current request, reported in the X-Served-Model header
+served_models: ContextVar[Optional[list]] = ContextVar("served_models", default=None)
+
+def record_served_model(model: Optional[str]):
+    models = served_models.get()
+    if model and models is not None and model not in models:
+        models.append(model)
+
+# Request instrumentation: phase timings, upstream token usage and fallback paths of the
+# current request, reported in the Server-Timing header and aggregated on /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# SQLite file the workers merge their metrics through; set to an empty string for per-worker metrics only
+METRICS_DB = os.getenv("METRICS_DB", os.path.join(tempfile.gettempdir(), "kindminds_metrics.db"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("EVENT_LOOP_LAG_INTERVAL_SECONDS", "0.1"))
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class RequestTimings:
+    """Where one request spent its time.
+
+    Phases: prompt_build, upstream_wait (until the completion, or the stream's first
+    byte, comes back), time_to_first_token (streams only), parse and postprocess. Spans of
+    a phase may overlap (parallel chunk calls, the speculative chat call); the phase's
+    duration is the wall time during which at least one of them was open.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.tokens = {"prompt": 0, "completion": 0}
+        self.paths = []  # Fallbacks taken, e.g. "model_fallback", "json_repair"
+        self._open = {}  # phase -> (open spans, start of the first)
+
+    def enter(self, phase: str):
+        spans, start = self._open.get(phase, (0, None))
+        self._open[phase] = (spans + 1, start if spans else time.perf_counter())
+
+    def exit(self, phase: str):
+        spans, start = self._open.pop(phase)
+        if spans > 1:
+            self._open[phase] = (spans - 1, start)
+        else:
+            self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - start
+
+    def mark(self, phase: str, since: float):
+        """Record a one-off duration (e.g. time to first token); only the first one counts"""
+        self.phases.setdefault(phase, time.perf_counter() - since)
+
+    def add_usage(self, usage):
+        self.tokens["prompt"] += getattr(usage, "prompt_tokens", 0) or 0
+        self.tokens["completion"] += getattr(usage, "completion_tokens", 0) or 0
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        entries = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in self.phases.items()]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        if self.tokens["prompt"] or self.tokens["completion"]:
+            entries.append(f'tokens;desc="prompt={self.tokens["prompt"]} completion={self.tokens["completion"]}"')
+        if self.paths:
+            entries.append(f'fallback;desc="{" ".join(self.paths)}"')
+        return ", ".join(entries)
+
+request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+@contextmanager
+def timed_phase(phase: str):
+    """Count the enclosed block towards `phase` of the current request (no-op outside one)"""
+    timings = request_timings.get()
+    if timings is None:
+        yield
+        return
+    timings.enter(phase)
+    try:
+        yield
+    finally:
+        timings.exit(phase)
+
+def record_usage(usage):
+    timings = request_timings.get()
+    if timings is not None and usage is not None:
+        timings.add_usage(usage)
+
+def record_fallback(path: str):
+    timings = request_timings.get()
+    if timings is not None and path not in timings.paths:
+        timings.paths.append(path)
+
+class MetricsRegistry:
+    """Prometheus-style counters and histograms, merged across uvicorn workers.
+
+    Each worker aggregates in memory and every `flush_interval` seconds writes its totals
+    as one row of a shared SQLite table, keyed by a random per-process id; /metrics adds
+    up all rows. Rows of workers that have exited are kept so counters never go down.
+    """
+
+    FAMILIES = {
+        "kindminds_requests_total": ("counter", "Requests served, by route and status code"),
+        "kindminds_request_duration_seconds": ("histogram", "Request latency, by route"),
+        "kindminds_phase_duration_seconds": ("histogram", "Time spent in each request phase, by route"),
+        "kindminds_upstream_tokens_total": ("counter", "Upstream tokens reported in completion usage, by route"),
+        "kindminds_fallbacks_total": ("counter", "Requests that took a fallback path, by route and path"),
+        "kindminds_event_loop_lag_seconds": ("histogram", "How late the event loop woke up from a timed sleep"),
+        "kindminds_overload_level_seconds_total": ("counter", "Time workers spent at each degradation level"),
+        "kindminds_structured_outputs_total": (
+            "counter", "JSON generations by endpoint and how they were parsed (parsed, repaired, salvaged, failed)"
+        ),
+        "kindminds_topups_total": ("counter", "Top-up calls for replies with too few items, by endpoint and outcome"),
+    }
+
+    def __init__(self, buckets: tuple, db_path: Optional[str] = None, flush_interval: float = 5):
+        self.buckets = buckets
+        self.flush_interval = flush_interval
+        self.worker_id = uuid.uuid4().hex
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self._last_flush = time.monotonic()
+        self._flushing = False
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS metrics (worker TEXT PRIMARY KEY, payload TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def inc(self, name: str, labels: tuple, amount: float = 1):
+        self._counters[(name, labels)] = self._counters.get((name, labels), 0) + amount
+
+    def observe(self, name: str, labels: tuple, value: float):
+        values = self._histograms.get((name, labels))
+        if values is None:
+            values = self._histograms[(name, labels)] = [0] * (len(self.buckets) + 1) + [0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        values[index] += 1
+        values[-1] += value
+
+    def record_request(self, route: str, status: int, timings: RequestTimings):
+        self.inc("kindminds_requests_total", (("route", route), ("status", str(status))))
+        self.observe("kindminds_request_duration_seconds", (("route", route),), timings.elapsed())
+        for phase, seconds in timings.phases.items():
+            self.observe("kindminds_phase_duration_seconds", (("route", route), ("phase", phase)), seconds)
+        for kind, count in timings.tokens.items():
+            if count:
+                self.inc("kindminds_upstream_tokens_total", (("route", route), ("kind", kind)), count)
+        for path in timings.paths:
+            self.inc("kindminds_fallbacks_total", (("route", route), ("path", path)))
+        if self._db is not None and not self._flushing and time.monotonic() - self._last_flush >= self.flush_interval:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    def _payload(self) -> str:
+        return json.dumps({
+            "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+            "histograms": [[name, labels, values] for (name, labels), values in self._histograms.items()],
+        })
+
+    def _db_write(self, payload: str):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO metrics (worker, payload, updated_at) VALUES (?, ?, ?)",
+                (self.worker_id, payload, time.time()),
+            )
+            self._db.commit()
+
+    def _db_read(self) -> List[str]:
+        with self._db_lock:
+            return [row[0] for row in self._db.execute("SELECT payload FROM metrics")]
+
+    async def flush(self):
+        if self._db is None:
+            return
+        self._flushing = True
+        try:
+            self._last_flush = time.monotonic()
+            await asyncio.to_thread(self._db_write, self._payload())
+        finally:
+            self._flushing = False
+
+    async def collect(self) -> tuple:
+        """(counters, histograms) summed over every worker"""
+        if self._db is None:
+            return dict(self._counters), {key: list(values) for key, values in self._histograms.items()}
+        await self.flush()
+        counters, histograms = {}, {}
+        for payload in await asyncio.to_thread(self._db_read):
+            data = json.loads(payload)
+            for name, labels, value in data["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in data["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                if len(values) != len(self.buckets) + 2:
+                    continue  # Written with a different bucket layout
+                merged = histograms.setdefault(key, [0] * len(values))
+                histograms[key] = [a + b for a, b in zip(merged, values)]
+        return counters, histograms
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = []
+        for key, value in labels + extra:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    async def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        counters, histograms = await self.collect()
+        lines = []
+        for family, (kind, help_text) in self.FAMILIES.items():
+            lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"]
+            if kind == "counter":
+                for (name, labels), value in sorted(counters.items()):
+                    if name == family:
+                        lines.append(f"{family}{self._labels(labels)} {value:g}")
+                continue
+            for (name, labels), values in sorted(histograms.items()):
+                if name != family:
+                    continue
+                cumulative = 0
+                for bound, count in zip([f"{bound:g}" for bound in self.buckets] + ["+Inf"], values):
+                    cumulative += count
+                    lines.append(f"{family}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{family}_sum{self._labels(labels)} {values[-1]:.6f}")
+                lines.append(f"{family}_count{self._labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if self._db is not None:
+            self._db_write(self._payload())
+            self._db.close()
+            self._db = None
+
+metrics = MetricsRegistry(
+    buckets=METRICS_BUCKETS,
+    db_path=(METRICS_DB or None) if METRICS_ENABLED else None,
+    flush_interval=METRICS_FLUSH_SECONDS,
+)
+
+async def monitor_event_loop_lag(interval: float):
+    """Sample event loop lag; a blocking call in any handler delays every wake-up behind it"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        metrics.observe("kindminds_event_loop_lag_seconds", (), max(0.0, loop.time() - expected))
+
+# Overload control: as in-flight requests or upstream latency climb, each worker steps through
+# degradation levels instead of letting requests pile up until the proxy times them out
+OVERLOAD_CONTROL_ENABLED = os.getenv("OVERLOAD_CONTROL_ENABLED", "true").lower() in ("1", "true", "yes")
+OVERLOAD_LEVELS = ("normal", "short_replies", "local_sentiment", "queued_only", "shedding")
+# Thresholds for levels 1-4: in-flight HTTP requests on this worker, smoothed upstream latency in seconds
+OVERLOAD_IN_FLIGHT_THRESHOLDS = [int(v) for v in os.getenv("OVERLOAD_IN_FLIGHT_THRESHOLDS", "48,64,96,128").split(",")]
+OVERLOAD_LATENCY_THRESHOLDS = [float(v) for v in os.getenv("OVERLOAD_LATENCY_THRESHOLDS", "6,10,20,40").split(",")]
+OVERLOAD_COOLDOWN_SECONDS = float(os.getenv("OVERLOAD_COOLDOWN_SECONDS", "15"))  # Calm time before stepping down a level
+OVERLOAD_RETRY_AFTER_SECONDS = float(os.getenv("OVERLOAD_RETRY_AFTER_SECONDS", "30"))
+# Level 1: max_tokens caps for the interactive text endpoints
+OVERLOAD_MAX_TOKENS = {
+    "chat": int(os.getenv("OVERLOAD_MAX_TOKENS_CHAT", "512")),
+    "reframe": int(os.getenv("OVERLOAD_MAX_TOKENS_REFRAME", "200")),
+}
+# Level 4: endpoints whose upstream priority is this or lower (a higher number) are rejected
+OVERLOAD_SHED_PRIORITY = int(os.getenv("OVERLOAD_SHED_PRIORITY", "2"))
+
+overload_level: ContextVar[Optional[int]] = ContextVar("overload_level", default=None)
+
+class OverloadController:
+    """This worker's degradation level, from in-flight requests and upstream latency.
+
+    Upstream latency (scheduler wait plus the call, to the first byte for streams) is an
+    exponentially weighted average that decays back to zero while no calls complete. The
+    level rises as soon as either signal crosses a threshold and falls one step at a time,
+    once both have stayed below the current level's thresholds for the cooldown.
+    """
+
+    def __init__(self, in_flight_thresholds: list, latency_thresholds: list, cooldown: float):
+        self.in_flight_thresholds = in_flight_thresholds
+        self.latency_thresholds = latency_thresholds
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.level = 0
+        self._latency = 0.0
+        self._latency_at = time.monotonic()
+        self._calm_since = None
+        self._accounted_at = time.monotonic()
+        self.stats = {"level_changes": 0, "shed": 0, "queued": 0}
+
+    def observe_latency(self, seconds: float):
+        self._latency = self.latency() * 0.8 + seconds * 0.2
+        self._latency_at = time.monotonic()
+
+    def latency(self) -> float:
+        # Halve the average every cooldown period without new samples
+        return self._latency * 0.5 ** ((time.monotonic() - self._latency_at) / self.cooldown)
+
+    def _pressure(self) -> int:
+        latency = self.latency()
+        return max(
+            sum(self.in_flight >= threshold for threshold in self.in_flight_thresholds),
+            sum(latency >= threshold for threshold in self.latency_thresholds),
+        )
+
+    def update(self) -> int:
+        """Re-evaluate the level; called at the start of each request"""
+        now = time.monotonic()
+        metrics.inc("kindminds_overload_level_seconds_total", (("level", OVERLOAD_LEVELS[self.level]),),
+                    now - self._accounted_at)
+        self._accounted_at = now
+        pressure = self._pressure()
+        level = self.level
+        if pressure > level:
+            level, self._calm_since = pressure, None
+        elif pressure < level:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.cooldown:
+                level, self._calm_since = level - 1, now
+        else:
+            self._calm_since = None
+        if level != self.level:
+            self.stats["level_changes"] += 1
+            log_fn = overload_log.warning if level > self.level else overload_log.info
+            log_fn("overload level changed", extra={
+                "from": OVERLOAD_LEVELS[self.level], "to": OVERLOAD_LEVELS[level],
+                "in_flight": self.in_flight, "upstream_latency": round(self.latency(), 2),
+            })
+            self.level = level
+        return level
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "enabled": OVERLOAD_CONTROL_ENABLED,
+            "level": self.level,
+            "mode": OVERLOAD_LEVELS[self.level],
+            "in_flight": self.in_flight,
+            "upstream_latency_seconds": round(self.latency(), 3),
+            "in_flight_thresholds": self.in_flight_thresholds,
+            "latency_thresholds": self.latency_thresholds,
+        }
+
+overload = OverloadController(OVERLOAD_IN_FLIGHT_THRESHOLDS, OVERLOAD_LATENCY_THRESHOLDS, OVERLOAD_COOLDOWN_SECONDS)
+
+def current_overload_level() -> int:
+    """The level the current request started at; background work (jobs, sockets) sees the live level"""
+    if not OVERLOAD_CONTROL_ENABLED:
+        return 0
+    level = overload_level.get()
+    return overload.level if level is None else level
+
+def shed_if_overloaded(endpoint: str):
+    """Reject low-priority work with a 503 and Retry-After while the worker is shedding load"""
+    if current_overload_level() >= 4 and UPSTREAM_PRIORITIES[endpoint] >= OVERLOAD_SHED_PRIORITY:
+        overload.stats["shed"] += 1
+        record_fallback("overload_shed")
+        raise HTTPException(
+            status_code=503,
+            detail="The service is overloaded right now. Please try again shortly.",
+            headers={"Retry-After": str(math.ceil(OVERLOAD_RETRY_AFTER_SECONDS))},
+        )
+
+class ModelRouter:
+    """Pick the model for each upstream call and fall back when the primary is slow or failing.
+
+    Non-streaming calls on routes with a hedge delay start the fallback model if the
+    primary has not answered by then, and take whichever finishes first. A route is
+    downgraded to its fallback for a cooldown period when the primary's recent p95 latency
+    exceeds the budget or it fails several times in a row; afterwards the primary is tried
+    again with fresh statistics. Latency and the hedge delay both count from the moment the
+    scheduler admits the call, so time spent queued for a slot is not blamed on the model.
+    """
+
+    def __init__(self, routes: dict, min_samples: int, max_errors: int, cooldown: float):
+        self.routes = routes
+        self.min_samples = min_samples
+        self.max_errors = max_errors
+        self.cooldown = cooldown
+        self._downgraded_until = {endpoint: 0.0 for endpoint in routes}
+        self._latencies = {endpoint: deque(maxlen=100) for endpoint in routes}
+        self._errors = {endpoint: 0 for endpoint in routes}
+        self.stats = {
+            endpoint: {"served": {}, "primary_errors": 0, "fallbacks": 0, "hedges": 0, "hedge_wins": 0, "downgrades": 0}
+            for endpoint in routes
+        }
+
+    def downgraded(self, endpoint: str) -> bool:
+        return time.monotonic() < self._downgraded_until[endpoint]
+
+    def _p95(self, endpoint: str) -> Optional[float]:
+        samples = sorted(self._latencies[endpoint])
+        return samples[int(0.95 * (len(samples) - 1))] if samples else None
+
+    def _downgrade(self, endpoint: str):
+        self._downgraded_until[endpoint] = time.monotonic() + self.cooldown
+        self._latencies[endpoint].clear()
+        self._errors[endpoint] = 0
+        self.stats[endpoint]["downgrades"] += 1
+
+    def _observe(self, endpoint: str, model: str, elapsed: Optional[float], failed: bool = False):
+        route = self.routes[endpoint]
+        if model != route["primary"]:
+            return
+        if failed:
+            self.stats[endpoint]["primary_errors"] += 1
+            self._errors[endpoint] += 1
+            if self.route_fallback(endpoint) and self._errors[endpoint] >= self.max_errors:
+                self._downgrade(endpoint)
+            return
+        self._errors[endpoint] = 0
+        if elapsed is None:
+            return
+        self._latencies[endpoint].append(elapsed)
+        if (self.route_fallback(endpoint) and len(self._latencies[endpoint]) >= self.min_samples
+                and self._p95(endpoint) > route["latency_budget"]):
+            self._downgrade(endpoint)
+
+    def route_fallback(self, endpoint: str) -> Optional[str]:
+        route = self.routes[endpoint]
+        return route["fallback"] if route["fallback"] != route["primary"] else None
+
+    async def _timed(self, endpoint: str, model: str, attempt, measure: bool,
+                     admitted: Optional[asyncio.Event] = None):
+        admitted_at = None
+
+        def on_admit():
+            nonlocal admitted_at
+            admitted_at = time.monotonic()  # A retry is re-admitted; time only its own upstream call
+            if admitted is not None:
+                admitted.set()
+
+        try:
+            result = await attempt(model, on_admit)
+        except asyncio.CancelledError:
+            # Lost a hedge race: the primary took at least this long
+            if measure and admitted_at is not None:
+                self._observe(endpoint, model, time.monotonic() - admitted_at)
+            raise
+        except HTTPException:
+            raise  # Queue rejection, not a model problem
+        except Exception:
+            self._observe(endpoint, model, None, failed=True)
+            raise
+        self._observe(endpoint, model, time.monotonic() - admitted_at if measure and admitted_at is not None else None)
+        stats = self.stats[endpoint]["served"]
+        stats[model] = stats.get(model, 0) + 1
+        return result
+
+    async def run(self, endpoint: str, attempt, stream: bool = False):
+        """Run `attempt(model, on_admit)` on the routed model(s); returns (result, model)"""
+        route = self.routes[endpoint]
+        primary, fallback = route["primary"], self.route_fallback(endpoint)
+        measure = not stream  # Stream latency is time to first byte, not comparable to the budget
+
+        if fallback and self.downgraded(endpoint):
+            record_fallback("model_downgraded")
+            return await self._timed(endpoint, fallback, attempt, measure), fallback
+
+        if not fallback or stream or route["hedge_delay"] <= 0:
+            try:
+                return await self._timed(endpoint, primary, attempt, measure), primary
+            except HTTPException:
+                raise
+            except Exception:
+                if not fallback:
+                    raise
+            self.stats[endpoint]["fallbacks"] += 1
+            record_fallback("model_fallback")
+            return await self._timed(endpoint, fallback, attempt, measure), fallback
+
+        # Hedged: give the primary a head start, then race the fallback against it
+        admitted = asyncio.Event()
+        primary_task = asyncio.create_task(self._timed(endpoint, primary, attempt, measure, admitted))
+        try:
+            # The head start counts from admission: a fallback started earlier would queue behind it
+            admission = asyncio.create_task(admitted.wait())
+            try:
+                await asyncio.wait({primary_task, admission}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                admission.cancel()
+            done, _ = await asyncio.wait({primary_task}, timeout=route["hedge_delay"])
+            if done and primary_task.exception() is None:
+                return primary_task.result(), primary
+            if done and isinstance(primary_task.exception(), HTTPException):
+                raise primary_task.exception()  # Queue rejection or shed, not a model problem
+            if not done:
+                self.stats[endpoint]["hedges"] += 1
+                record_fallback("model_hedged")
+            else:
+                self.stats[endpoint]["fallbacks"] += 1
+                record_fallback("model_fallback")
+            fallback_task = asyncio.create_task(self._timed(endpoint, fallback, attempt, measure))
+            try:
+                pending = {primary_task, fallback_task} - done
+                while pending:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished:
+                        if task.exception() is None:
+                            if task is fallback_task and not done:
+                                self.stats[endpoint]["hedge_wins"] += 1
+                            return task.result(), primary if task is primary_task else fallback
+                # Both failed: surface the fallback's error
+                raise fallback_task.exception()
+            finally:
+                fallback_task.cancel()
+        finally:
+            primary_task.cancel()
+
+    def snapshot(self) -> dict:
+        snapshot = {}
+        for endpoint, route in self.routes.items():
+            p95 = self._p95(endpoint)
+            snapshot[endpoint] = {
+                **route,
+                "downgraded": self.downgraded(endpoint),
+                "primary_p95_seconds": round(p95, 3) if p95 is not None else None,
+                "primary_samples": len(self._latencies[endpoint]),
+                **self.stats[endpoint],
+            }
+        return snapshot
+
+model_router = ModelRouter(
+    routes=MODEL_ROUTES,
+    min_samples=MODEL_DOWNGRADE_MIN_SAMPLES,
+    max_errors=MODEL_DOWNGRADE_ERRORS,
+    cooldown=MODEL_DOWNGRADE_COOLDOWN_SECONDS,
+)
+
+def failed_json_generation(exc: BadRequestError) -> Optional[str]:
+    """The raw output of a JSON-mode generation Groq rejected as invalid JSON, if that is what `exc` is"""
+    body = exc.body if isinstance(exc.body, dict) else {}
+    error = body.get("error", body)
+    if isinstance(error, dict) and error.get("code") == "json_validate_failed":
+        return error.get("failed_generation")
+    return None
+
+async def create_completion(endpoint: str, **kwargs):
+    """Run a chat completion on the shared async client with the endpoint's timeout.
+
+    The model comes from the endpoint's route (see ModelRouter), and the model that
+    answered is recorded for the X-Served-Model response header. Calls go through the
+    upstream scheduler, which orders them by endpoint priority and keeps them within the
+    rate budgets. Non-streaming calls are also coalesced: concurrent calls with the same
+    endpoint, messages and parameters share a single upstream generation (and a single
+    scheduler slot). Streaming calls hold their slot only until the response starts.
+    Time spent here is the request's upstream_wait phase (see RequestTimings) and feeds
+    the overload controller's latency signal; under overload, chat and reframe replies
+    get a smaller max_tokens. A JSON-mode generation that Groq rejects as invalid JSON
+    (json_validate_failed, e.g. cut off at max_tokens) is returned with its raw output.
+    """
+    timeout = httpx.Timeout(UPSTREAM_TIMEOUTS[endpoint], connect=GROQ_CONNECT_TIMEOUT)
+    if endpoint in OVERLOAD_MAX_TOKENS and current_overload_level() >= 1:
+        kwargs["max_tokens"] = min(kwargs.get("max_tokens", 1024), OVERLOAD_MAX_TOKENS[endpoint])
+        record_fallback("overload_short_reply")
+    cost = count_message_tokens(kwargs["messages"]) + kwargs.get("max_tokens", 1024)
+
+    async def call_model(model: str):
+        try:
+            return await client.chat.completions.create(model=model, timeout=timeout, **kwargs)
+        except BadRequestError as exc:
+            failed_generation = failed_json_generation(exc) if "response_format" in kwargs else None
+            if failed_generation is None:
+                raise
+            # Not a model failure: hand the invalid output to the caller's repairing parser
+            return ChatCompletion.model_validate({
+                "id": f"json-validate-failed-{uuid.uuid4().hex}", "object": "chat.completion",
+                "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": failed_generation}}],
+            })
+
+    def attempt(model: str, on_admit=None):
+        return upstream_scheduler.call(endpoint, lambda: call_model(model), cost, on_admit)
+
+    if kwargs.get("stream"):
+        started = time.perf_counter()
+        try:
+            with timed_phase("upstream_wait"):
+                stream, model = await model_router.run(endpoint, attempt, stream=True)
+        finally:
+            overload.observe_latency(time.perf_counter() - started)
+        record_served_model(model)
+        return instrumented_stream(stream, started, request_timings.get())
+
+    async def routed():
+        started = time.perf_counter()
+        try:
+            completion, model = await model_router.run(endpoint, attempt)
+        finally:
+            overload.observe_latency(time.perf_counter() - started)
+        return completion
+
+    with timed_phase("upstream_wait"):
+        if not SINGLE_FLIGHT_ENABLED:
+            completion = await routed()
+        else:
+            canonical = json.dumps({"endpoint": endpoint, **kwargs}, sort_keys=True, ensure_ascii=False)
+            key = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+            completion = await single_flight.run(
+                key,
+                routed,
+                lease_seconds=(UPSTREAM_QUEUE_DEADLINES[endpoint] + UPSTREAM_TIMEOUTS[endpoint]) * (GROQ_MAX_RETRIES + 1)
+                              + GROQ_CONNECT_TIMEOUT,
+                serialize=lambda completion: completion.model_dump_json(),
+                deserialize=ChatCompletion.model_validate_json,
+                cross_worker=endpoint in SINGLE_FLIGHT_LEASE_ENDPOINTS,
+            )
+    record_served_model(completion.model)
+    record_usage(getattr(completion, "usage", None))
+    return completion
+
+async def instrumented_stream(stream, started: float, timings: Optional[RequestTimings]):
+    """Pass a completion stream through, recording time to first token and the final usage"""
+    async for chunk in stream:
+        if timings is not None:
+            if chunk.choices and chunk.choices[0].delta.content:
+                timings.mark("time_to_first_token", started)
+            # Groq reports usage on the last chunk, under x_groq
+            usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or getattr(chunk, "usage", None)
+            if usage is not None:
+                timings.add_usage(usage)
+        yield chunk
+
+# Response encoding: JSON is rendered by orjson (pydantic's own serializer for models), and
+# large quiz, flashcard and job payloads are compressed when the client accepts it
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))  # 0 turns compression off
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "5"))
+
+def dumps_json(value) -> bytes:
+    """Compact UTF-8 JSON, as JSONResponse renders it"""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson; a pydantic model is serialized directly, without re-validation.
+
+    The app's default response class. Handlers that return it themselves (rather than a
+    model for FastAPI to check against response_model) validate their payload only once.
+    """
+
+    def render(self, content) -> bytes:
+        if isinstance(content, BaseModel):
+            return content.__pydantic_serializer__.to_json(content)
+        return dumps_json(content)
+
+def negotiate_content_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """The preferred of br and gzip in an Accept-Encoding header, or None for identity"""
+    weights = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.partition(";")
+        match = re.search(r"q\s*=\s*([0-9.]+)", params)
+        try:
+            weights[name.strip().lower()] = float(match.group(1)) if match else 1.0
+        except ValueError:
+            continue
+    available = ("br", "gzip") if brotli is not None else ("gzip",)
+    best = max(available, key=lambda name: weights.get(name, weights.get("*", 0.0)))  # Ties keep br
+    return best if weights.get(best, weights.get("*", 0.0)) > 0 else None
+
+def payload_response(content, accept_encoding: Optional[str] = None, status_code: int = 200,
+                     headers: Optional[dict] = None) -> FastJSONResponse:
+    """Serialize an already validated payload once, compressed if it is large and the client accepts it"""
+    with timed_phase("serialize"):
+        response = FastJSONResponse(content, status_code=status_code, headers=headers)
+        if RESPONSE_COMPRESSION_MIN_BYTES > 0:
+            response.headers["Vary"] = "Accept-Encoding"
+            encoding = negotiate_content_encoding(accept_encoding)
+            if encoding is not None and len(response.body) >= RESPONSE_COMPRESSION_MIN_BYTES:
+                if encoding == "br":
+                    response.body = brotli.compress(response.body, quality=RESPONSE_BROTLI_QUALITY)
+                else:
+                    response.body = gzip.compress(response.body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+                response.headers["Content-Encoding"] = encoding
+                response.headers["Content-Length"] = str(len(response.body))
+    return response
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_runner.start()
+    lag_monitor = None
+    if METRICS_ENABLED and EVENT_LOOP_LAG_INTERVAL_SECONDS > 0:
+        lag_monitor = asyncio.create_task(monitor_event_loop_lag(EVENT_LOOP_LAG_INTERVAL_SECONDS))
+    yield
+    if lag_monitor is not None:
+        lag_monitor.cancel()
+    await job_runner.stop()
+    # Release pooled upstream connections on shutdown
+    await client.close()
+    result_cache.close()
+    summary_cache.close()
+    semantic_cache.close()
+    document_store.close()
+    single_flight.close()
+    job_store.close()
+    chat_sessions.close()
+    metrics.close()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # CORS middleware - reads from environment variable for production
 cors_origins_env = os.getenv("CORS_ORIGINS", "http://localhost:3000,http://localhost:3001,http://localhost:3002,http://localhost:3003,http://localhost:3004")
@@ -25,73 +1333,310 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Cache", "Retry-After", "X-Served-Model", "Server-Timing", "X-Overload-Level"],
 )
 
-# Initialize Groq client
-groq_api_key = os.getenv("GROQ_API_KEY")
-if not groq_api_key:
-    raise ValueError("GROQ_API_KEY not found in environment variables. Please check your .env file.")
+class RequestContextMiddleware:
+    """Per-request context and response headers, in one pure ASGI pass.
+
+    Sets the request's log id and debug sampling decision, the served-model list, the
+    phase timings and the overload level, then adds X-Served-Model, Server-Timing and
+    X-Overload-Level to the response start. A request counts as in flight until its
+    response starts; for streams that covers the wait for the upstream's first byte,
+    which is where requests pile up under overload. Timings reach /metrics once the body
+    has been sent, but a stream's Server-Timing header only covers what happened before
+    its first byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        models = []
+        timings = RequestTimings() if METRICS_ENABLED else None
+        level = overload.update() if OVERLOAD_CONTROL_ENABLED else None
+        request_id = Headers(scope=scope).get("x-request-id") or uuid.uuid4().hex[:16]
+        sampled = random.random() < LOG_DEBUG_SAMPLE_RATE if LOG_DEBUG_SAMPLE_RATE < 1 else None
+        tokens = [
+            (log_request_id, log_request_id.set(request_id)),
+            (log_debug_sampled, log_debug_sampled.set(sampled)),
+            (served_models, served_models.set(models)),
+            (request_timings, request_timings.set(timings)),
+            (overload_level, overload_level.set(level)),
+        ]
+        status = None
+        in_flight = level is not None
+        if in_flight:
+            overload.in_flight += 1
+
+        async def send_with_context(message):
+            nonlocal status, in_flight
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if in_flight:
+                    overload.in_flight -= 1
+                    in_flight = False
+                headers = MutableHeaders(scope=message)
+                if models:
+                    headers["X-Served-Model"] = ", ".join(models)
+                if timings is not None:
+                    headers["Server-Timing"] = timings.server_timing()
+                if level is not None:
+                    headers["X-Overload-Level"] = str(level)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_context)
+        finally:
+            if in_flight:
+                overload.in_flight -= 1
+            for var, token in reversed(tokens):
+                var.reset(token)
+            route = scope.get("route")
+            # Unmatched paths are not worth a label of their own
+            if timings is not None and status is not None and route is not None:
+                metrics.record_request(route.path, status, timings)
+
+app.add_middleware(RequestContextMiddleware)
+
+# Plain-text math to LaTeX. One precompiled lexer scans the reply once: existing $...$ and
+# $$...$$ spans are copied through untouched, equation lines are rewritten in display mode
+# and everything else gets the inline rewrites (trig names, superscripts, number fractions).
+TRIG_FUNCTIONS = ("arcsin", "arccos", "arctan", "sin", "cos", "tan", "sec", "csc", "cot")
+SUPERSCRIPTS = {"²": "^{2}", "³": "^{3}"}
+
+# "Word" boundaries as seen after ² and ³ become ^{2}/^{3}: those two never join a word
+_WORD_CHAR = r"[^\W²³]"
+_INLINE_MATH_PATTERN = (
+    rf"(?P<pm>±{_WORD_CHAR}*)"  # ± becomes \pm, which fuses with a word that follows it
+    r"|(?P<sup>[²³])"
+    rf"|(?<!{_WORD_CHAR})(?:(?P<trig>{'|'.join(TRIG_FUNCTIONS)})"
+    r"|(?P<num>\d+)[^\S\n]*/[^\S\n]*(?P<den>\d+))"
+    rf"(?!{_WORD_CHAR})"
+)
+LATEX_INLINE = re.compile(_INLINE_MATH_PATTERN)
+LATEX_LEXER = re.compile(
+    r"(?P<span>\$\$[\s\S]*?(?:\$\$|\Z)|\$[^$\n]+\$|\\\$)"  # Existing math (or \$), kept verbatim
+    r"|(?P<display>^(?![^\n]*\$)(?=[^\n]*=)(?=[^\n]*[/()+\-*^²³])[^\n]*)"  # An equation line
+    rf"|{_INLINE_MATH_PATTERN}",
+    re.MULTILINE,
+)
+LATEX_SPANS = re.compile(r"\$\$[\s\S]*?(?:\$\$|\Z)|\$[^$\n]+\$|\\\$")
+PAREN_FRACTION = re.compile(r'\$\$(.*?)\(([^)]+)\)\s*/\s*\(([^)]+)\)(.*?)\$\$')
+DISPLAY_MATH = re.compile(r'\$\$(.+?)\$\$')
+SLASH_FRACTION = re.compile(r'([^/\s]+)\s*/\s*([^/\s]+)')
 
-client = Groq(api_key=groq_api_key)
+def _slash_fractions(match) -> str:
+    return '$$' + SLASH_FRACTION.sub(r'\\frac{\1}{\2}', match.group(1)) + '$$'
+
+def _inline_math(match) -> str:
+    group = match.lastgroup
+    if group == "pm":
+        return "\\pm" + match.group(0)[1:]
+    if group == "sup":
+        return SUPERSCRIPTS[match.group(0)]
+    if group == "trig":
+        return "\\" + match.group("trig")
+    return f"$\\frac{{{match.group('num')}}}{{{match.group('den')}}}$"
+
+def _display_line(line: str) -> str:
+    """An equation line in display mode; text before a colon stays outside the math"""
+    converted = LATEX_INLINE.sub(_inline_math, line)
+    head, colon, equation = converted.partition(':')
+    display = '$$' + (equation if colon else converted).strip() + '$$'
+    if '/' in display:
+        # (a) / (b) first, then any remaining x / y
+        display = PAREN_FRACTION.sub(r'$$\1\\frac{\2}{\3}\4$$', display)
+        display = DISPLAY_MATH.sub(_slash_fractions, display)
+    return head + ':\n' + display if colon else display
+
+def _latex_token(match) -> str:
+    group = match.lastgroup
+    if group == "span":
+        return match.group(0)
+    if group == "display":
+        return _display_line(match.group(0))
+    return _inline_math(match)
 
 def convert_math_to_latex(text: str) -> str:
     """Convert plain text math notation to LaTeX format"""
-    
-    # Don't process if already has significant LaTeX
-    if text.count('$') > 5:
-        return text
-    
-    result = text
-    
-    # First, handle superscripts ² ³ before other processing
-    result = result.replace('²', '^{2}')
-    result = result.replace('³', '^{3}')
-    result = result.replace('±', '\\pm')
-    
-    # Convert trig function names to LaTeX commands
-    trig_functions = ['sin', 'cos', 'tan', 'sec', 'csc', 'cot', 'arcsin', 'arccos', 'arctan']
-    for func in trig_functions:
-        result = re.sub(rf'\b{func}\b', rf'\\{func}', result)
-    
-    # Convert equations on their own line or after colons to display mode
-    # Pattern: "formula_name: equation" or lines that are just equations
-    lines = result.split('\n')
-    new_lines = []
-    for line in lines:
-        # Check if line contains formula (has = and math symbols)
-        if '=' in line and any(char in line for char in ['/', '(', ')', '+', '-', '*', '^']):
-            # If it starts with text followed by colon, keep the text outside
-            if ':' in line:
-                parts = line.split(':', 1)
-                if len(parts) == 2:
-                    new_lines.append(parts[0] + ':\n$$' + parts[1].strip() + '$$')
-                else:
-                    new_lines.append('$$' + line.strip() + '$$')
-            else:
-                new_lines.append('$$' + line.strip() + '$$')
-        else:
-            new_lines.append(line)
-    
-    result = '\n'.join(new_lines)
-    
-    # Now convert remaining inline fractions and math
-    # Simple number fractions like 5/6
-    result = re.sub(r'\b(\d+)\s*/\s*(\d+)\b', r'$\\frac{\1}{\2}$', result)
-    
-    # Convert (expression) / (expression) to frac
-    result = re.sub(r'\$\$(.*?)\(([^)]+)\)\s*/\s*\(([^)]+)\)(.*?)\$\$', 
-                    r'$$\1\\frac{\2}{\3}\4$$', result)
-    
-    # Handle expressions like "tan(x) / cos(x)" inside $$
-    def replace_fractions_in_math(match):
-        content = match.group(1)
-        # Replace / with \frac{}{} 
-        content = re.sub(r'([^/\s]+)\s*/\s*([^/\s]+)', r'\\frac{\1}{\2}', content)
-        return '$$' + content + '$$'
-    
-    result = re.sub(r'\$\$(.+?)\$\$', replace_fractions_in_math, result)
-    
-    return result
+    return LATEX_LEXER.sub(_latex_token, text)
+
+class StreamingLatexConverter:
+    """Incremental convert_math_to_latex for streamed replies.
+
+    Text is held back until a line is complete, and while a $$ block is still open,
+    then converted with the batch lexer. Every rewrite the lexer performs is confined
+    to a line or a closed math span, so the concatenated output matches the batch path.
+    """
+
+    def __init__(self):
+        self._pending = ""
+
+    @staticmethod
+    def _open_block(text: str) -> bool:
+        last = None
+        for last in LATEX_SPANS.finditer(text):
+            pass
+        return last is not None and last.group(0).startswith('$$') and (
+            len(last.group(0)) < 4 or not last.group(0).endswith('$$'))
+
+    def feed(self, delta: str) -> str:
+        """Add streamed text and return whatever full lines are ready to send"""
+        self._pending += delta
+        cut = self._pending.rfind('\n')
+        if cut < 0:
+            return ""
+        ready = self._pending[:cut + 1]
+        if '$' in ready and self._open_block(ready):
+            return ""
+        self._pending = self._pending[cut + 1:]
+        return convert_math_to_latex(ready)
+
+    def flush(self) -> str:
+        """Convert and return the trailing partial line at end of stream"""
+        ready, self._pending = self._pending, ""
+        return convert_math_to_latex(ready) if ready else ""
+
+# Result cache for the document tools (flashcards, quiz, scan-problem)
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "2048"))
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "64"))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "86400"))
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB")  # Optional SQLite path shared by all workers
+RESULT_CACHE_DB_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_DB_MAX_ENTRIES", "50000"))
+
+class ResultCache:
+    """LRU + TTL cache of generated tool results keyed by a hash of the normalized request.
+
+    The in-memory tier is per worker and capped by entry count and bytes. The optional
+    SQLite tier is shared by every uvicorn worker on the host and survives restarts.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float,
+                 db_path: Optional[str] = None, db_max_entries: int = 50000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.db_max_entries = db_max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, payload json)
+        self._bytes = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypasses": 0, "evictions": 0}
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, payload TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(endpoint: str, params: dict) -> str:
+        """Hash the endpoint and its normalized request/model parameters"""
+        canonical = json.dumps({"endpoint": endpoint, **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, payload: str, expires_at: float):
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key)[1])
+        if len(payload) > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, payload)
+        self._bytes += len(payload)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def _db_get(self, key: str):
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT payload, expires_at FROM results WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+
+    def _db_set(self, key: str, payload: str, expires_at: float):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, payload, expires_at) VALUES (?, ?, ?)", (key, payload, expires_at)
+            )
+            self._db.execute("DELETE FROM results WHERE expires_at <= ?", (time.time(),))
+            self._db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (self.db_max_entries,),
+            )
+            self._db.commit()
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry:
+            expires_at, payload = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return json.loads(payload)
+            self._bytes -= len(self._entries.pop(key)[1])
+
+        if self._db is not None:
+            row = await asyncio.to_thread(self._db_get, key)
+            if row:
+                payload, expires_at = row
+                self._remember(key, payload, expires_at)
+                self.stats["disk_hits"] += 1
+                return json.loads(payload)
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: dict):
+        payload = json.dumps(value, ensure_ascii=False)
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, payload, expires_at)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_set, key, payload, expires_at)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "disk_enabled": self._db is not None,
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+result_cache = ResultCache(
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024),
+    ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+    db_path=RESULT_CACHE_DB,
+    db_max_entries=RESULT_CACHE_DB_MAX_ENTRIES,
+)
+
+def normalize_cache_text(text: str) -> str:
+    """Collapse whitespace so trivially different uploads share a cache entry"""
+    return " ".join(text.split())
+
+def cache_bypassed(x_cache_bypass: Optional[str], cache_control: Optional[str]) -> bool:
+    """A client can force a fresh generation with `X-Cache-Bypass: 1` or `Cache-Control: no-cache`"""
+    if x_cache_bypass and x_cache_bypass.strip().lower() not in ("0", "false", "no"):
+        return True
+    return bool(cache_control and "no-cache" in cache_control.lower())
+
+MBTI_TYPES = tuple(a + b + c + d for a in "EI" for b in "SN" for c in "TF" for d in "JP")
+
+def normalize_mbti_type(value: Optional[str]) -> Optional[str]:
+    """The canonical four-letter type, or None when unset or malformed (no personalization)"""
+    if not value:
+        return None
+    value = value.strip().upper()
+    return value if value in MBTI_TYPES else None
 
 class Message(BaseModel):
     role: str
@@ -108,13 +1653,26 @@ class ChatRequest(BaseModel):
     mbti_type: Optional[str] = None  # MBTI personality type for personalization
     sentiment: Optional[SentimentContext] = None  # Sentiment data for activity suggestions
 
+    @field_validator("mbti_type", mode="before")
+    @classmethod
+    def normalize_mbti(cls, value):
+        # The profile field is free text; a typo there should not break the request
+        return normalize_mbti_type(value) if isinstance(value, str) else value
+
 class ChatResponse(BaseModel):
     response: str
+    prompt_tokens: Optional[int] = None  # Tokens sent upstream after history compaction
 
 class ReframeRequest(BaseModel):
     thought: str
     mbti_type: Optional[str] = None  # MBTI personality type for personalization
 
+    @field_validator("mbti_type", mode="before")
+    @classmethod
+    def normalize_mbti(cls, value):
+        # The profile field is free text; a typo there should not break the request
+        return normalize_mbti_type(value) if isinstance(value, str) else value
+
 class ReframeResponse(BaseModel):
     reframed: str
 
@@ -123,15 +1681,29 @@ class FlashcardItem(BaseModel):
     answer: str
 
 class FlashcardsRequest(BaseModel):
-    content: str
+    content: Optional[str] = None
+    doc_id: Optional[str] = None  # Reference to a document uploaded via /api/documents, instead of content
     filename: Optional[str] = None
 
+    @model_validator(mode="after")
+    def require_content_or_doc_id(self):
+        if not self.content and not self.doc_id:
+            raise ValueError("Either content or doc_id is required")
+        return self
+
 class FlashcardsResponse(BaseModel):
     title: str
     cards: List[FlashcardItem]
 
 class ScanProblemRequest(BaseModel):
-    prompt: str
+    prompt: Optional[str] = None
+    doc_id: Optional[str] = None  # Reference to a document uploaded via /api/documents, instead of prompt
+
+    @model_validator(mode="after")
+    def require_prompt_or_doc_id(self):
+        if not self.prompt and not self.doc_id:
+            raise ValueError("Either prompt or doc_id is required")
+        return self
 
 class ScanProblemResponse(BaseModel):
     analysis: dict
@@ -146,203 +1718,1203 @@ class QuizQuestion(BaseModel):
     explanation: Optional[str] = None
 
 class QuizRequest(BaseModel):
-    content: str
+    content: Optional[str] = None
+    doc_id: Optional[str] = None  # Reference to a document uploaded via /api/documents, instead of content
     filename: Optional[str] = None
     num_questions: Optional[int] = 5  # Default to 5 questions
 
+    @model_validator(mode="after")
+    def require_content_or_doc_id(self):
+        if not self.content and not self.doc_id:
+            raise ValueError("Either content or doc_id is required")
+        return self
+
 class QuizResponse(BaseModel):
     title: str
     questions: List[QuizQuestion]
 
+class DocumentResponse(BaseModel):
+    doc_id: str
+    filename: Optional[str] = None
+    size: int  # Normalized content length in characters
+    chunks: int
+    idle_ttl_seconds: float  # The document is dropped after this long without use
+
+class JobResponse(BaseModel):
+    job_id: str
+    kind: str  # "flashcards" or "quiz"
+    status: str  # queued, running, succeeded, failed or cancelled
+    progress: float = 0.0  # Fraction of document sections generated so far
+    result: Optional[dict] = None  # The FlashcardsResponse/QuizResponse body once succeeded
+    error: Optional[str] = None
+    created_at: float
+    updated_at: float
+
 class SentimentRequest(BaseModel):
     text: str
 
 class SentimentResponse(BaseModel):
     sentiment: str
     score: float
+    tier: Optional[str] = None  # "crisis", "local", "llm" or "fallback" - which cascade stage answered
+    confidence: Optional[float] = None  # Local scorer confidence when answered without the LLM
+
+class ChatTurnResponse(BaseModel):
+    response: str
+    prompt_tokens: Optional[int] = None
+    sentiment: SentimentResponse  # Score of the latest user message
+    suggested_activity: Optional[str] = None  # "54321" (crisis), "breathing" or None
+
+class SentimentBatchRequest(BaseModel):
+    texts: List[str]
+
+class SentimentBatchResponse(BaseModel):
+    results: List[SentimentResponse]  # Same order as the request's texts
+
+@app.get("/")
+async def root():
+    return {"message": "KindMinds API is running"}
+
+# Prompt registry. Every system prompt variant is assembled once at import: the long static
+# prompt, shared by all users of the endpoint, followed by the short MBTI part. Per-turn text
+# (the sentiment note) goes in its own message after the history, so the system prompt and
+# earlier turns stay a byte-identical prefix that upstream prompt caching can reuse.
+CHAT_SYSTEM_PROMPTS = {
+    "academic": """You are an AI academic assistant for KindMinds. Your ONLY purpose is to help students with academic and educational topics.
+
+You MUST help with:
+- Study techniques and learning strategies
+- Homework help and explanations
+- Time management and productivity for studies
+- Test preparation and study planning
+- Subject-specific guidance (math, science, history, languages, etc.)
+- Learning disabilities and study accommodations
+- Academic goal setting and planning
+
+You MUST REFUSE to answer questions about:
+- General trivia or entertainment
+- Coding/programming (unless it's for an academic course)
+- News, politics, or current events
+- Shopping or product recommendations
+- Dating or relationship advice
+- Medical advice or diagnosis
+- Legal advice
+- Any non-academic topics
+
+If asked about non-academic topics, politely respond: "I'm KindMinds Academic Assistant. I'm specifically designed to help with studying, learning, and academic success. For this type of question, please try a general-purpose AI. Is there anything about your studies I can help you with?"
+
+⚠️ CRITICAL REQUIREMENT - Mathematical Notation ⚠️
+You MUST ALWAYS use LaTeX/KaTeX notation for ANY mathematical expressions. This is NON-NEGOTIABLE.
+
+RULES FOR MATH FORMATTING:
+1. Inline math: Use $expression$ (single dollar signs)
+2. Display math: Use $$expression$$ (double dollar signs for centered equations)
+3. NEVER write plain text math like "tan(x) = sin(x)/cos(x)"
+4. ALWAYS use LaTeX: $\\tan(x) = \\frac{\\sin(x)}{\\cos(x)}$
+
+MANDATORY EXAMPLES - YOU MUST FOLLOW THIS FORMAT:
+❌ WRONG: tan(2θ) = 2tan(θ) / (1 - tan²(θ))
+✓ CORRECT: $$\\tan(2\\theta) = \\frac{2\\tan(\\theta)}{1 - \\tan^2(\\theta)}$$
+
+❌ WRONG: x = (-b ± sqrt(b² - 4ac)) / (2a)
+✓ CORRECT: $$x = \\frac{-b \\pm \\sqrt{b^2 - 4ac}}{2a}$$
+
+❌ WRONG: Write 5/6 as a fraction
+✓ CORRECT: Write $\\frac{5}{6}$ as a fraction
+
+LATEX SYNTAX YOU MUST USE:
+- Fractions: $\\frac{numerator}{denominator}$
+- Greek: $\\theta$ $\\pi$ $\\alpha$ $\\beta$ $\\gamma$ $\\Delta$
+- Trig functions: $\\sin(x)$ $\\cos(x)$ $\\tan(x)$ $\\sec(x)$ $\\csc(x)$ $\\cot(x)$
+- Exponents: $x^2$ $e^{i\\pi}$
+- Subscripts: $a_n$ $x_i$
+- Square roots: $\\sqrt{x}$ $\\sqrt[3]{x}$
+- Sums: $\\sum_{i=1}^{n}$
+- Integrals: $\\int_{a}^{b} f(x) dx$
+- Limits: $\\lim_{x \\to \\infty}$
+
+REMEMBER: Every single mathematical symbol, number, variable, or equation MUST be wrapped in dollar signs with proper LaTeX syntax. NO EXCEPTIONS.
+
+Be encouraging, clear, and supportive. Focus exclusively on helping students learn effectively.""",
+        
+    "mindfulness": """You are an AI mindfulness and mental wellness assistant for KindMinds. Your ONLY purpose is to help users with mental wellness and mindfulness practices.
+
+You MUST help with:
+- Stress management and relaxation techniques
+- Mindfulness practices and meditation guidance
+- Emotional well-being and self-care
+- Building positive habits and resilience
+- Managing anxiety and promoting calm
+- Breathing exercises and grounding techniques
+- Work-life balance and mental health
+- Sleep hygiene and relaxation
+- Dealing with academic stress and burnout
+
+You MUST REFUSE to answer questions about:
+- General trivia or entertainment
+- Coding/programming
+- News, politics, or current events
+- Shopping or product recommendations
+- Dating or relationship advice (unless related to emotional wellness)
+- Medical diagnosis or prescription advice
+- Legal advice
+- Academic homework or study help
+- Any non-wellness topics
+
+If asked about non-wellness topics, politely respond: "I'm KindMinds Mindfulness Assistant. I'm specifically designed to help with stress management, meditation, and mental wellness. For this type of question, please try a general-purpose AI or switch to the Academic tab for study help. Is there anything about your mental wellness or mindfulness practice I can help you with?"
+
+Be compassionate, gentle, and supportive. Focus exclusively on promoting mental wellness and peace."""
+}
+
+REFRAME_SYSTEM_PROMPT = """You are a compassionate cognitive behavioral therapy coach.
+You receive an intrusive or unhelpful thought and respond with a thoughtful, empathetic reframe.
+Return only the reframed statement—concise, encouraging, and practical."""
+
+def chat_mbti_personalization(mbti_type: str) -> str:
+    personalization = f"\n\nPERSONALIZATION - User's MBTI Type: {mbti_type}\n"
+    personalization += "Adapt your communication style, examples, and approach to match this personality type:\n"
+    
+    # MBTI-based personalization guidelines
+    if mbti_type[0] == 'E':  # Extraversion
+        personalization += "- User prefers interactive, energetic communication. Engage actively and encourage discussion.\n"
+    else:  # Introversion
+        personalization += "- User prefers thoughtful, reflective communication. Allow processing time and provide detailed written explanations.\n"
+    
+    if mbti_type[1] == 'S':  # Sensing
+        personalization += "- User learns best with concrete examples, practical applications, and step-by-step processes.\n"
+    else:  # Intuition
+        personalization += "- User learns best with conceptual frameworks, patterns, and big-picture connections.\n"
+    
+    if mbti_type[2] == 'T':  # Thinking
+        personalization += "- User values logical reasoning, objective analysis, and systematic approaches. Be direct and analytical.\n"
+    else:  # Feeling
+        personalization += "- User values empathy, harmony, and personal connections. Be warm, supportive, and consider emotional impact.\n"
+    
+    if mbti_type[3] == 'J':  # Judging
+        personalization += "- User prefers structure, organization, and clear conclusions. Provide organized, definitive answers.\n"
+    else:  # Perceiving
+        personalization += "- User prefers flexibility, exploration, and keeping options open. Offer multiple perspectives and adaptable approaches.\n"
+    return personalization
+
+def reframe_mbti_personalization(mbti_type: str) -> str:
+    personalization = f"\n\nPERSONALIZATION - User's MBTI Type: {mbti_type}\n"
+    if mbti_type[2] == 'T':  # Thinking
+        personalization += "Use logical, analytical reframes. Focus on facts and objective perspectives. Be direct and systematic.\n"
+    else:  # Feeling
+        personalization += "Use warm, empathetic reframes. Focus on values, emotions, and human connections. Be supportive and consider emotional impact.\n"
+    
+    if mbti_type[1] == 'S':  # Sensing
+        personalization += "Provide concrete, practical examples and real-world applications in the reframe.\n"
+    else:  # Intuition
+        personalization += "Connect to broader patterns, meanings, and future possibilities in the reframe.\n"
+    return personalization
+
+class PromptRegistry:
+    """Interned system prompts for every (prompt, MBTI type) pair, built once at startup"""
+
+    def __init__(self):
+        self._static = {}  # name -> prefix shared by every variant
+        self._prompts = {}  # (name, mbti type or None) -> full system prompt
+
+    def register(self, name: str, static: str, personalize):
+        self._static[name] = sys.intern(static)
+        self._prompts[(name, None)] = self._static[name]
+        for mbti_type in MBTI_TYPES:
+            self._prompts[(name, mbti_type)] = sys.intern(static + personalize(mbti_type))
+
+    def get(self, name: str, mbti_type: Optional[str] = None) -> str:
+        return self._prompts[(name, normalize_mbti_type(mbti_type))]
+
+    def snapshot(self) -> dict:
+        """Token sizes per prompt and variant, to keep an eye on prompt growth"""
+        report = {}
+        for name, static in self._static.items():
+            variants = {mbti_type or "none": count_tokens(prompt)
+                        for (prompt_name, mbti_type), prompt in self._prompts.items() if prompt_name == name}
+            report[name] = {
+                "static_prefix_tokens": count_tokens(static),
+                "max_tokens": max(variants.values()),
+                "variants": variants,
+            }
+        return report
+
+prompt_registry = PromptRegistry()
+for _chat_type, _prompt in CHAT_SYSTEM_PROMPTS.items():
+    prompt_registry.register(f"chat.{_chat_type}", _prompt, chat_mbti_personalization)
+prompt_registry.register("reframe", REFRAME_SYSTEM_PROMPT, reframe_mbti_personalization)
+
+@app.get("/api/prompts/stats")
+async def prompt_stats():
+    """Estimated token size of every registered system prompt variant"""
+    return prompt_registry.snapshot()
+
+def build_chat_system_prompt(chat_type: str, mbti_type: Optional[str]) -> str:
+    """The chat_type's system prompt with MBTI personalization, fixed for a whole conversation"""
+    return prompt_registry.get(f"chat.{chat_type if chat_type in CHAT_SYSTEM_PROMPTS else 'academic'}", mbti_type)
+
+def sentiment_prompt_note(sentiment: Optional[SentimentContext]) -> str:
+    """Activity-suggestion instructions for a negative turn, sent right before the latest message"""
+    if not sentiment or not sentiment.suggested_activity:
+        return ""
+    activity_name = "breathing exercises" if sentiment.suggested_activity == "breathing" else "a grounding exercise"
+    sentiment_suggestion = f"⚠️ SENTIMENT CONTEXT - User's current message shows {sentiment.sentiment} sentiment (score: {sentiment.score:.2f}).\n"
+    sentiment_suggestion += f"The system has detected that the user might benefit from {activity_name}, but you should ASK THE USER FIRST before suggesting it.\n"
+    sentiment_suggestion += f"Suggest the activity naturally in your response, like: 'Would you like to try some breathing exercises together? They can really help when you're feeling this way.'\n"
+    sentiment_suggestion += "Wait for the user to say 'yes' or agree before mentioning that the activity is ready to start.\n"
+    sentiment_suggestion += "Be supportive and empathetic, but don't force the activity - let them decide.\n"
+    return sentiment_suggestion
+
+def assemble_chat_messages(system_prompt: str, history: List[dict], sentiment_note: str) -> List[dict]:
+    """System prompt, then the history, with the per-turn note (if any) just before the latest message"""
+    messages = [{"role": "system", "content": system_prompt}] + history[:-1]
+    if sentiment_note:
+        messages.append({"role": "system", "content": sentiment_note})
+    return messages + history[-1:]
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Hit/miss counters for this worker's result cache"""
+    return result_cache.snapshot()
+
+# Conversation history compaction: keep recent turns verbatim, summarize older ones
+CHAT_TOKEN_BUDGETS = {
+    "academic": int(os.getenv("CHAT_TOKEN_BUDGET_ACADEMIC", "6000")),
+    "mindfulness": int(os.getenv("CHAT_TOKEN_BUDGET_MINDFULNESS", "4000")),
+}
+CHAT_SUMMARY_BLOCK = int(os.getenv("CHAT_SUMMARY_BLOCK", "6"))  # Summarized prefix grows in steps of this many messages
+CHAT_SUMMARY_MAX_TOKENS = 300
+
+# Summaries are cached by the persona and a hash of the conversation prefix they cover; RESULT_CACHE_DB shares them across workers
+summary_cache = ResultCache(
+    max_entries=int(os.getenv("CHAT_SUMMARY_CACHE_ENTRIES", "2048")),
+    max_bytes=16 * 1024 * 1024,
+    ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+    db_path=RESULT_CACHE_DB,
+    db_max_entries=RESULT_CACHE_DB_MAX_ENTRIES,
+)
+
+TOKEN_PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def count_tokens(text: str) -> int:
+    """Local estimate of Llama token count: words split into ~4-character pieces plus punctuation"""
+    return sum((len(piece) + 3) // 4 for piece in TOKEN_PIECE_PATTERN.findall(text))
+
+def count_message_tokens(messages: List[dict]) -> int:
+    # ~4 tokens of chat-template overhead per message
+    return sum(count_tokens(message["content"]) + 4 for message in messages)
+
+def prefix_hashes(messages: List[dict]) -> List[str]:
+    """Chained hash of every conversation prefix; entry i covers messages[:i + 1]"""
+    hashes, current = [], hashlib.sha256()
+    for message in messages:
+        current.update(f"{message['role']}\x1f{message['content']}\x1e".encode("utf-8"))
+        hashes.append(current.copy().hexdigest())
+    return hashes
+
+async def summarize_conversation(chat_type: str, previous_summary: Optional[str], messages: List[dict]) -> str:
+    transcript = "\n\n".join(f"{message['role'].upper()}: {message['content']}" for message in messages)
+    earlier = f"Summary of the conversation before this point:\n{previous_summary}\n\n" if previous_summary else ""
+    summary_messages = [
+        {
+            "role": "system",
+            "content": f"You summarize conversations between a user and the KindMinds {chat_type} assistant. "
+                       "Write a concise summary (under 200 words) that preserves the user's goals, questions, "
+                       "key facts and answers given, and anything the user shared about how they feel. "
+                       "Return only the summary.",
+        },
+        {"role": "user", "content": f"{earlier}Conversation to summarize:\n\n{transcript}"},
+    ]
+    chat_completion = await create_completion(
+        "chat",
+        messages=summary_messages,
+        temperature=0.2,
+        max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+    )
+    return chat_completion.choices[0].message.content.strip()
+
+async def compact_history(chat_type: str, mbti_type: Optional[str], system_prompt: str,
+                          history: List[dict]) -> List[dict]:
+    """Fit a conversation into the chat_type's token budget.
+
+    The most recent messages are kept verbatim. Older ones are replaced by a rolling
+    summary; the summarized prefix grows in blocks of CHAT_SUMMARY_BLOCK messages, so a
+    summary is produced once per block and then served from the cache on later turns.
+    Each new summary extends the previous block's summary rather than starting over.
+    Summaries are keyed by the persona too: the same opening under another chat_type or
+    MBTI type gets its own summary.
+    """
+    budget = CHAT_TOKEN_BUDGETS.get(chat_type, CHAT_TOKEN_BUDGETS["academic"]) - count_tokens(system_prompt)
+    if count_message_tokens(history) <= budget or len(history) <= 1:
+        return history
+    # Leave room for the summary itself
+    available = budget - CHAT_SUMMARY_MAX_TOKENS
+
+    # Smallest cut that fits, rounded up to a block boundary; the latest message is always kept
+    kept_tokens, cut = 0, len(history)
+    for index in range(len(history) - 1, -1, -1):
+        kept_tokens += count_tokens(history[index]["content"]) + 4
+        if kept_tokens > available and index < len(history) - 1:
+            break
+        cut = index
+    cut = min(-(-cut // CHAT_SUMMARY_BLOCK) * CHAT_SUMMARY_BLOCK, len(history) - 1)
+    if cut <= 0:
+        return history
+
+    hashes = prefix_hashes(history[:cut])
+    persona = chat_prompt_fingerprint(chat_type, mbti_type)
+
+    def summary_key(prefix_hash: str) -> str:
+        return ResultCache.make_key("chat_summary", {"persona": persona, "prefix": prefix_hash})
+
+    summary = await summary_cache.get(summary_key(hashes[cut - 1]))
+    if summary is None:
+        # Extend the summary of the previous block when we have it
+        previous, start = None, 0
+        for block_end in range(cut - CHAT_SUMMARY_BLOCK, 0, -CHAT_SUMMARY_BLOCK):
+            cached = await summary_cache.get(summary_key(hashes[block_end - 1]))
+            if cached is not None:
+                previous, start = cached["summary"], block_end
+                break
+        try:
+            text = await summarize_conversation(chat_type, previous, history[start:cut])
+        except Exception as exc:
+            # Summaries are an optimization; without one, just send the recent turns
+            chat_log.warning("history summary failed, truncating instead",
+                             extra={"error": f"{type(exc).__name__}: {exc}"})
+            return history[cut:]
+        summary = {"summary": text}
+        await summary_cache.set(summary_key(hashes[cut - 1]), summary)
+
+    summary_message = {"role": "system", "content": f"Summary of the earlier conversation:\n{summary['summary']}"}
+    return [summary_message] + history[cut:]
+
+async def prepare_chat_messages(request: ChatRequest) -> List[dict]:
+    """System prompt plus the conversation compacted to the chat_type's token budget"""
+    system_prompt = build_chat_system_prompt(request.chat_type, request.mbti_type)
+    sentiment_note = sentiment_prompt_note(request.sentiment)
+    history = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+    history = await compact_history(request.chat_type, request.mbti_type, system_prompt + sentiment_note, history)
+    return assemble_chat_messages(system_prompt, history, sentiment_note)
+
+@app.get("/api/upstream/stats")
+async def upstream_stats():
+    """Queue depth, in-flight calls, wait times and rate-limit state of this worker's upstream scheduler"""
+    return upstream_scheduler.snapshot()
+
+@app.get("/api/overload/stats")
+async def overload_stats():
+    """This worker's degradation level, the signals behind it and how often it shed or queued work"""
+    return overload.snapshot()
+
+@app.get("/api/models/stats")
+async def model_stats():
+    """Per-endpoint routes, primary p95 latency, downgrade state and which models served requests"""
+    return model_router.snapshot()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Request, phase, token and fallback metrics of every worker in Prometheus text format"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(await metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/singleflight/stats")
+async def single_flight_stats():
+    """Duplicate-suppression counters for this worker's upstream calls"""
+    return single_flight.snapshot()
+
+# Semantic answer cache for single-turn chat questions that recur (opt-in)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_CHAT_TYPES = {t.strip() for t in os.getenv("SEMANTIC_CACHE_CHAT_TYPES", "academic").split(",") if t.strip()}
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.88"))  # Cosine similarity for a hit
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+SEMANTIC_CACHE_MAX_QUESTION_CHARS = int(os.getenv("SEMANTIC_CACHE_MAX_QUESTION_CHARS", "500"))
+SEMANTIC_CACHE_DIMENSIONS = int(os.getenv("SEMANTIC_CACHE_DIMENSIONS", "1024"))  # Hashed feature space
+SEMANTIC_CACHE_SYNC_SECONDS = float(os.getenv("SEMANTIC_CACHE_SYNC_SECONDS", "5"))  # Pick up other workers' entries
+# SQLite file shared by all workers and kept across restarts; set to an empty string for memory only
+SEMANTIC_CACHE_DB = os.getenv("SEMANTIC_CACHE_DB", os.path.join(tempfile.gettempdir(), "kindminds_semantic.db"))
+
+SEMANTIC_TOKEN_PATTERN = re.compile(r"[a-z]+|\d+(?:\.\d+)?|[=+\-*/^²³√π<>]")
+SEMANTIC_STOPWORDS = frozenset(
+    "a an the is are was were be been am do does did can could would should will i me my we you your it its "
+    "this that these those of in on at to for from with by about and or so as please hi hello hey thanks "
+    "thank what whats how".split()
+)
+
+def semantic_features(text: str):
+    """(hashed feature weights, exact-match signature) for a question.
+
+    Features are word unigrams and bigrams, hashed into SEMANTIC_CACHE_DIMENSIONS signed
+    buckets and L2-normalized. Numbers and math operators go into the signature instead:
+    "solve x² + 5x + 6 = 0" and the same question with 7 must never share an answer.
+    """
+    tokens = SEMANTIC_TOKEN_PATTERN.findall(text.lower())
+    signature = " ".join(token for token in tokens if not token.isalpha())
+    words = [token[:-1] if len(token) > 3 and token.endswith("s") and not token.endswith("ss") else token
+             for token in tokens if token.isalpha() and token not in SEMANTIC_STOPWORDS]
+    weights = {}
+    for feature, weight in itertools.chain(
+        ((word, 1.0) for word in words),
+        ((f"{first} {second}", 0.5) for first, second in zip(words, words[1:])),
+    ):
+        digest = zlib.crc32(feature.encode("utf-8"))
+        index = digest % SEMANTIC_CACHE_DIMENSIONS
+        weights[index] = weights.get(index, 0.0) + (weight if digest & 0x80000000 else -weight)
+    norm = math.sqrt(sum(value * value for value in weights.values()))
+    if norm:
+        weights = {index: value / norm for index, value in weights.items() if value}
+    return weights, signature
+
+@functools.lru_cache(maxsize=64)
+def chat_prompt_fingerprint(chat_type: str, mbti_type: Optional[str]) -> str:
+    """Hash of the chat model and system prompt; editing either retires the cached answers"""
+    prompt = build_chat_system_prompt(chat_type, mbti_type)
+    return hashlib.sha256(f"{MODEL_ROUTES['chat']['primary']}\x1f{prompt}".encode("utf-8")).hexdigest()[:16]
+
+class SemanticIndex:
+    """Nearest-neighbour search over the questions of one cache scope.
+
+    With NumPy the vectors are rows of a dense float32 matrix scored with one
+    matrix-vector product. Without it, an inverted index over the hashed features
+    scores only the entries that share a feature with the query.
+    """
+
+    def __init__(self):
+        self.ids = []  # Row -> entry id
+        self._rows = {}  # entry id -> row
+        self._matrix = np.zeros((16, SEMANTIC_CACHE_DIMENSIONS), dtype=np.float32) if np is not None else None
+        self._postings = {}  # feature -> {entry id: weight}, without NumPy
+        self._vectors = {}  # entry id -> features, for removal from the postings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, entry_id: int, vector: dict):
+        if self._matrix is None:
+            self._vectors[entry_id] = vector
+            for index, value in vector.items():
+                self._postings.setdefault(index, {})[entry_id] = value
+        else:
+            if len(self.ids) == len(self._matrix):
+                self._matrix = np.concatenate([self._matrix, np.zeros_like(self._matrix)])
+            row = self._matrix[len(self.ids)]
+            row[:] = 0
+            row[list(vector)] = list(vector.values())
+        self._rows[entry_id] = len(self.ids)
+        self.ids.append(entry_id)
+
+    def remove(self, entry_id: int):
+        row = self._rows.pop(entry_id)
+        last = self.ids.pop()
+        if last != entry_id:
+            # Move the last row into the gap
+            self.ids[row] = last
+            self._rows[last] = row
+            if self._matrix is not None:
+                self._matrix[row] = self._matrix[len(self.ids)]
+        if self._matrix is None:
+            for index in self._vectors.pop(entry_id):
+                postings = self._postings[index]
+                del postings[entry_id]
+                if not postings:
+                    del self._postings[index]
+
+    def nearest(self, vector: dict):
+        """(entry id, cosine similarity) of the closest question, or (None, 0.0)"""
+        if not self.ids or not vector:
+            return None, 0.0
+        if self._matrix is not None:
+            query = np.zeros(SEMANTIC_CACHE_DIMENSIONS, dtype=np.float32)
+            query[list(vector)] = list(vector.values())
+            scores = self._matrix[:len(self.ids)] @ query
+            row = int(np.argmax(scores))
+            return self.ids[row], float(scores[row])
+        scores = {}
+        for index, value in vector.items():
+            for entry_id, weight in self._postings.get(index, {}).items():
+                scores[entry_id] = scores.get(entry_id, 0.0) + value * weight
+        if not scores:
+            return None, 0.0
+        entry_id = max(scores, key=scores.get)
+        return entry_id, scores[entry_id]
+
+class SemanticCache:
+    """Answers to recurring single-turn questions, found by similarity rather than exact text.
+
+    Entries are grouped into scopes: a hash of the system prompt (chat type and MBTI
+    personalization) and model, plus the question's numbers and operators. Within a
+    scope the nearest question above the threshold is a hit. Capacity is bounded by an
+    LRU across scopes, and the SQLite tier keeps entries across restarts and shares them
+    between workers, which pick up each other's entries every SEMANTIC_CACHE_SYNC_SECONDS.
+    """
+
+    def __init__(self, max_entries: int, threshold: float, ttl_seconds: float, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # entry id -> {"scope", "question", "answer", "created_at"}
+        self._indexes = {}  # scope -> SemanticIndex
+        self._next_local_id = -1  # Ids for entries that are not in SQLite
+        self._synced_id = 0
+        self._synced_at = 0.0
+        self._syncing = False
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "skipped": 0, "evictions": 0}
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_answers (entry_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "scope TEXT NOT NULL, question TEXT NOT NULL, answer TEXT NOT NULL, created_at REAL NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            self._db.commit()
+            self._load(self._db_rows_since(0))
+            self._synced_at = time.monotonic()
+
+    @staticmethod
+    def scope_for(request: ChatRequest, signature: str) -> str:
+        return f"{chat_prompt_fingerprint(request.chat_type, request.mbti_type)}|{signature}"
+
+    def _add(self, entry_id: int, scope: str, question: str, answer: str, created_at: float):
+        vector, _ = semantic_features(question)
+        self._entries[entry_id] = {"scope": scope, "question": question, "answer": answer, "created_at": created_at}
+        self._indexes.setdefault(scope, SemanticIndex()).add(entry_id, vector)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        index = self._indexes[entry["scope"]]
+        index.remove(entry_id)
+        if not len(index):
+            del self._indexes[entry["scope"]]
+
+    def _load(self, rows):
+        for entry_id, scope, question, answer, created_at in rows:
+            self._synced_id = max(self._synced_id, entry_id)
+            if entry_id not in self._entries:
+                self._add(entry_id, scope, question, answer, created_at)
+
+    def _db_rows_since(self, entry_id: int) -> list:
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT entry_id, scope, question, answer, created_at FROM semantic_answers "
+                "WHERE entry_id > ? AND created_at > ? ORDER BY last_used DESC LIMIT ?",
+                (entry_id, time.time() - self.ttl_seconds, self.max_entries),
+            ).fetchall()[::-1]
+
+    def _db_insert(self, scope: str, question: str, answer: str, created_at: float) -> int:
+        with self._db_lock:
+            cursor = self._db.execute(
+                "INSERT INTO semantic_answers (scope, question, answer, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (scope, question, answer, created_at, created_at),
+            )
+            self._db.execute("DELETE FROM semantic_answers WHERE created_at <= ?", (time.time() - self.ttl_seconds,))
+            self._db.execute(
+                "DELETE FROM semantic_answers WHERE entry_id IN "
+                "(SELECT entry_id FROM semantic_answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+            return cursor.lastrowid
+
+    def _db_delete(self, entry_id: int):
+        with self._db_lock:
+            self._db.execute("DELETE FROM semantic_answers WHERE entry_id = ?", (entry_id,))
+            self._db.commit()
+
+    def _db_touch(self, entry_id: int):
+        with self._db_lock:
+            self._db.execute("UPDATE semantic_answers SET last_used = ? WHERE entry_id = ?", (time.time(), entry_id))
+            self._db.commit()
+
+    async def _sync(self):
+        if self._db is None or self._syncing or time.monotonic() - self._synced_at < SEMANTIC_CACHE_SYNC_SECONDS:
+            return
+        self._syncing = True
+        try:
+            self._load(await asyncio.to_thread(self._db_rows_since, self._synced_id))
+            self._synced_at = time.monotonic()
+        finally:
+            self._syncing = False
+
+    @staticmethod
+    def question_for(request: ChatRequest) -> Optional[str]:
+        """The question when the request can use the cache, else None"""
+        if request.chat_type not in SEMANTIC_CACHE_CHAT_TYPES:
+            return None
+        if len(request.messages) != 1 or request.messages[0].role != "user":
+            return None  # Answers to follow-ups depend on the conversation
+        if request.sentiment and (request.sentiment.score < 0 or request.sentiment.suggested_activity):
+            return None  # The reply should respond to how the user feels
+        question = " ".join(request.messages[0].content.split())
+        if not question or len(question) > SEMANTIC_CACHE_MAX_QUESTION_CHARS:
+            return None
+        if score_sentiment_locally(question)["crisis"]:
+            return None
+        return question
+
+    async def get(self, request: ChatRequest, question: str) -> Optional[str]:
+        await self._sync()
+        vector, signature = semantic_features(question)
+        index = self._indexes.get(self.scope_for(request, signature))
+        entry_id, similarity = index.nearest(vector) if index is not None else (None, 0.0)
+        if entry_id is not None and similarity >= self.threshold:
+            entry = self._entries[entry_id]
+            if time.time() - entry["created_at"] <= self.ttl_seconds:
+                self._entries.move_to_end(entry_id)
+                self.stats["hits"] += 1
+                if self._db is not None and entry_id > 0:
+                    await asyncio.to_thread(self._db_touch, entry_id)
+                return entry["answer"]
+            self._remove(entry_id)
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, request: ChatRequest, question: str, answer: str, replace: bool = False):
+        """Store an answer unless a similar question is already cached; `replace` swaps that one out"""
+        vector, signature = semantic_features(question)
+        scope = self.scope_for(request, signature)
+        index = self._indexes.get(scope)
+        similar_id, similarity = index.nearest(vector) if index is not None else (None, 0.0)
+        if not vector or (similarity >= self.threshold and not replace):
+            self.stats["skipped"] += 1  # Nothing to match on, or a concurrent request already stored it
+            return
+        if similarity >= self.threshold:
+            self._remove(similar_id)
+            if self._db is not None and similar_id > 0:
+                await asyncio.to_thread(self._db_delete, similar_id)
+        created_at = time.time()
+        if self._db is not None:
+            entry_id = await asyncio.to_thread(self._db_insert, scope, question, answer, created_at)
+        else:
+            entry_id, self._next_local_id = self._next_local_id, self._next_local_id - 1
+        self._add(entry_id, scope, question, answer, created_at)
+        self.stats["stores"] += 1
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "enabled": SEMANTIC_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "scopes": len(self._indexes),
+            "backend": "numpy" if np is not None else "inverted_index",
+            "threshold": self.threshold,
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+semantic_cache = SemanticCache(
+    max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS,
+    db_path=(SEMANTIC_CACHE_DB or None) if SEMANTIC_CACHE_ENABLED else None,
+)
+
+@app.get("/api/chat/cache/stats")
+async def semantic_cache_stats():
+    """Hit/miss counters and size of this worker's semantic answer cache"""
+    return semantic_cache.snapshot()
+
+async def generate_chat_reply(request: ChatRequest) -> ChatResponse:
+    """Run one chat turn: compact the history, call the model and post-process the reply"""
+    with timed_phase("prompt_build"):
+        messages = await prepare_chat_messages(request)
+    
+    # Call Groq API
+    chat_completion = await create_completion(
+        "chat",
+        messages=messages,
+        temperature=0.7,
+        max_tokens=1024,
+    )
+    
+    response_content = chat_completion.choices[0].message.content
+    usage = getattr(chat_completion, "usage", None)
+    prompt_tokens = usage.prompt_tokens if usage else count_message_tokens(messages)
+    
+    # Convert math notation to LaTeX for academic chat
+    if request.chat_type == "academic":
+        with timed_phase("postprocess"):
+            response_content = convert_math_to_latex(response_content)
+    
+    return ChatResponse(response=response_content, prompt_tokens=prompt_tokens)
+
+async def cached_chat_reply(request: ChatRequest, bypass: bool = False) -> tuple:
+    """generate_chat_reply behind the semantic cache.
+
+    Returns the reply and its X-Cache status (HIT, MISS or BYPASS), or None as the status
+    when the request cannot use the cache.
+    """
+    question = semantic_cache.question_for(request) if SEMANTIC_CACHE_ENABLED else None
+    if question is None:
+        return await generate_chat_reply(request), None
+    if not bypass:
+        with timed_phase("cache_lookup"):
+            answer = await semantic_cache.get(request, question)
+        if answer is not None:
+            return ChatResponse(response=answer, prompt_tokens=0), "HIT"
+    # Track this generation's models on their own: a concurrent sentiment call shares the request's list
+    models = []
+    token = served_models.set(models)
+    try:
+        reply = await generate_chat_reply(request)
+    finally:
+        served_models.reset(token)
+        for model in models:
+            record_served_model(model)
+    # Keep only full-length answers from the primary model, not a fallback's or a shortened one
+    if current_overload_level() == 0 and all(model == MODEL_ROUTES["chat"]["primary"] for model in models):
+        await semantic_cache.set(request, question, reply.response, replace=bypass)
+    return reply, "BYPASS" if bypass else "MISS"
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(
+    request: ChatRequest,
+    response: Response,
+    x_cache_bypass: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
+):
+    try:
+        reply, cache_status = await cached_chat_reply(request, cache_bypassed(x_cache_bypass, cache_control))
+        if cache_status:
+            response.headers["X-Cache"] = cache_status
+        return reply
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def sse_event(event: str, data: dict) -> str:
+    """Format one Server-Sent Events frame"""
+    return f"event: {event}\ndata: {dumps_json(data).decode()}\n\n"
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # Tell nginx not to buffer the stream
+}
+
+async def chat_reply_events(stream, messages: List[dict], chat_type: str):
+    """Turn an upstream chat stream into (event, data) pairs shared by the SSE and WebSocket transports.
+
+    Yields `delta` events as tokens arrive (whole lines for the academic tab, after
+    LaTeX conversion), then a `done` event carrying the full response exactly as
+    `/api/chat` would return it, or an `error` event if the upstream fails mid-stream.
+    """
+    converter = StreamingLatexConverter() if chat_type == "academic" else None
+    parts = []
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if not delta:
+                continue
+            parts.append(delta)
+            out = converter.feed(delta) if converter else delta
+            if out:
+                yield "delta", {"content": out}
+        if converter:
+            tail = converter.flush()
+            if tail:
+                yield "delta", {"content": tail}
+    except Exception as e:
+        yield "error", {"detail": str(e)}
+        return
+
+    response_content = "".join(parts)
+    if chat_type == "academic":
+        with timed_phase("postprocess"):
+            response_content = convert_math_to_latex(response_content)
+    yield "done", {"response": response_content, "prompt_tokens": count_message_tokens(messages)}
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Stream the chat reply as Server-Sent Events (see chat_reply_events for the event sequence)"""
+    try:
+        with timed_phase("prompt_build"):
+            messages = await prepare_chat_messages(request)
+        stream = await create_completion(
+            "chat",
+            messages=messages,
+            temperature=0.7,
+            max_tokens=1024,
+            stream=True,
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def event_source():
+        async for event, data in chat_reply_events(stream, messages, request.chat_type):
+            yield sse_event(event, data)
+
+    return StreamingResponse(event_source(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# WebSocket chat sessions: the server keeps the history and system prompt, the client sends only new messages
+CHAT_SESSION_MAX_SESSIONS = int(os.getenv("CHAT_SESSION_MAX_SESSIONS", "1000"))  # In-memory tier, per worker
+CHAT_SESSION_IDLE_TTL_SECONDS = float(os.getenv("CHAT_SESSION_IDLE_TTL_SECONDS", "1800"))
+CHAT_SESSION_MAX_AGE_SECONDS = float(os.getenv("CHAT_SESSION_MAX_AGE_SECONDS", "86400"))  # Even while in use
+CHAT_SESSION_MAX_MESSAGES = int(os.getenv("CHAT_SESSION_MAX_MESSAGES", "400"))  # Older half is dropped past this
+CHAT_SESSION_MAX_MESSAGE_CHARS = int(os.getenv("CHAT_SESSION_MAX_MESSAGE_CHARS", "16000"))
+# Opt-in SQLite file shared by all workers, so a reconnect can resume on any of them. It holds
+# conversation text, so it is off by default (memory only); point it at private storage.
+CHAT_SESSION_DB = os.getenv("CHAT_SESSION_DB", "")
+CHAT_SESSION_PURGE_SECONDS = 60  # How often a worker deletes expired sessions from the file
+
+class ChatSession:
+    """One conversation: its settings, the system prompt built from them once, and the history so far"""
+
+    def __init__(self, session_id: str, chat_type: str, mbti_type: Optional[str], history: List[dict], next_seq: int,
+                 created_at: Optional[float] = None):
+        self.session_id = session_id
+        self.chat_type = chat_type
+        self.mbti_type = mbti_type
+        self.system_prompt = build_chat_system_prompt(chat_type, mbti_type)
+        self.history = history
+        self.next_seq = next_seq  # Sequence number of the next stored message
+        self.last_used = time.time()
+        self.created_at = self.last_used if created_at is None else created_at
+        self.lock = asyncio.Lock()  # One turn at a time, even with two sockets on the session
+
+class ChatSessionStore:
+    """Bounded, expiring store of chat sessions.
+
+    Sessions live in a per-worker LRU. With the optional SQLite tier each turn appends its
+    two messages as rows (nothing is rewritten), so a client that reconnects to another
+    worker resumes the same conversation. A session expires after `idle_ttl` without use
+    or `max_age` after it was created, and expired rows are purged from the file.
+    """
+
+    def __init__(self, max_sessions: int, idle_ttl: float, max_messages: int, max_age: float,
+                 db_path: Optional[str] = None):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self._sessions = OrderedDict()  # session_id -> ChatSession
+        self._stats = {"created": 0, "resumed": 0, "turns": 0, "expired": 0}
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._purged_at = 0.0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chat_sessions (session_id TEXT PRIMARY KEY, chat_type TEXT NOT NULL, "
+                "mbti_type TEXT, next_seq INTEGER NOT NULL, last_used REAL NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chat_session_messages (session_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                "role TEXT NOT NULL, content TEXT NOT NULL, PRIMARY KEY (session_id, seq))"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(chat_sessions)")]
+            if "created_at" not in columns:
+                # File from before max_age: date existing sessions from their last use
+                self._db.execute("ALTER TABLE chat_sessions ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+                self._db.execute("UPDATE chat_sessions SET created_at = last_used")
+            self._db.commit()
+
+    def _expired(self, session: ChatSession, now: float) -> bool:
+        return now - session.last_used > self.idle_ttl or now - session.created_at > self.max_age
+
+    def _remember(self, session: ChatSession):
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        now = time.time()
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and now - oldest.last_used <= self.idle_ttl:
+                break
+            del self._sessions[oldest.session_id]
+        # Recency order says nothing about creation time: drop sessions past max_age wherever they sit
+        for session_id in [key for key, stored in self._sessions.items() if now - stored.created_at > self.max_age]:
+            del self._sessions[session_id]
+
+    def _trim(self, session: ChatSession):
+        # Drop the older half at once: summaries are cached by history prefix, so dropping
+        # one message per turn would force a fresh summary on every turn
+        if len(session.history) > self.max_messages:
+            cut = len(session.history) - self.max_messages // 2
+            while cut < len(session.history) - 1 and session.history[cut]["role"] != "user":
+                cut += 1
+            del session.history[:cut]
+
+    def _db_append(self, session: ChatSession, messages: List[dict]):
+        first_seq = session.next_seq - len(messages)
+        with self._db_lock:
+            self._db.execute(
+                "INSERT INTO chat_sessions (session_id, chat_type, mbti_type, next_seq, last_used, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET next_seq = excluded.next_seq, last_used = excluded.last_used",
+                (session.session_id, session.chat_type, session.mbti_type, session.next_seq, session.last_used,
+                 session.created_at),
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO chat_session_messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(session.session_id, first_seq + index, message["role"], message["content"])
+                 for index, message in enumerate(messages)],
+            )
+            self._db.execute(
+                "DELETE FROM chat_session_messages WHERE session_id = ? AND seq < ?",
+                (session.session_id, session.next_seq - len(session.history)),
+            )
+            self._db.commit()
+
+    def _db_purge(self):
+        now = time.time()
+        expired = "SELECT session_id FROM chat_sessions WHERE last_used < ? OR created_at < ?"
+        cutoffs = (now - self.idle_ttl, now - self.max_age)
+        with self._db_lock:
+            self._db.execute(f"DELETE FROM chat_session_messages WHERE session_id IN ({expired})", cutoffs)
+            self._db.execute("DELETE FROM chat_sessions WHERE last_used < ? OR created_at < ?", cutoffs)
+            self._db.commit()
 
-@app.get("/")
-async def root():
-    return {"message": "KindMinds API is running"}
+    async def _purge_if_due(self):
+        """Delete expired sessions from the file at most every CHAT_SESSION_PURGE_SECONDS"""
+        if self._db is not None and time.monotonic() - self._purged_at >= CHAT_SESSION_PURGE_SECONDS:
+            self._purged_at = time.monotonic()
+            await asyncio.to_thread(self._db_purge)
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    try:
-        # System prompts based on chat type
-        system_prompts = {
-            "academic": """You are an AI academic assistant for KindMinds. Your ONLY purpose is to help students with academic and educational topics.
+    def _db_touch(self, session_id: str) -> Optional[int]:
+        """Mark the session used and return its stored next_seq, or None if it expired"""
+        now = time.time()
+        with self._db_lock:
+            cursor = self._db.execute(
+                "UPDATE chat_sessions SET last_used = ? WHERE session_id = ? AND last_used >= ? AND created_at >= ?",
+                (now, session_id, now - self.idle_ttl, now - self.max_age),
+            )
+            self._db.commit()
+            if not cursor.rowcount:
+                return None
+            row = self._db.execute("SELECT next_seq FROM chat_sessions WHERE session_id = ?", (session_id,)).fetchone()
+            return row[0] if row else None
 
-You MUST help with:
-- Study techniques and learning strategies
-- Homework help and explanations
-- Time management and productivity for studies
-- Test preparation and study planning
-- Subject-specific guidance (math, science, history, languages, etc.)
-- Learning disabilities and study accommodations
-- Academic goal setting and planning
+    def _db_load(self, session_id: str):
+        now = time.time()
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT chat_type, mbti_type, next_seq, created_at FROM chat_sessions "
+                "WHERE session_id = ? AND last_used >= ? AND created_at >= ?",
+                (session_id, now - self.idle_ttl, now - self.max_age),
+            ).fetchone()
+            if not row:
+                return None
+            messages = self._db.execute(
+                "SELECT role, content FROM chat_session_messages WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+            self._db.execute("UPDATE chat_sessions SET last_used = ? WHERE session_id = ?", (time.time(), session_id))
+            self._db.commit()
+            return row, messages
 
-You MUST REFUSE to answer questions about:
-- General trivia or entertainment
-- Coding/programming (unless it's for an academic course)
-- News, politics, or current events
-- Shopping or product recommendations
-- Dating or relationship advice
-- Medical advice or diagnosis
-- Legal advice
-- Any non-academic topics
+    def _db_delete(self, session_id: str):
+        with self._db_lock:
+            self._db.execute("DELETE FROM chat_session_messages WHERE session_id = ?", (session_id,))
+            self._db.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
+            self._db.commit()
 
-If asked about non-academic topics, politely respond: "I'm KindMinds Academic Assistant. I'm specifically designed to help with studying, learning, and academic success. For this type of question, please try a general-purpose AI. Is there anything about your studies I can help you with?"
+    async def create(self, chat_type: str, mbti_type: Optional[str], history: List[dict]) -> ChatSession:
+        session = ChatSession(uuid.uuid4().hex, chat_type, mbti_type, list(history), len(history))
+        self._trim(session)
+        self._remember(session)
+        self._stats["created"] += 1
+        if self._db is not None:
+            await self._purge_if_due()
+            await asyncio.to_thread(self._db_append, session, session.history)
+        return session
 
-⚠️ CRITICAL REQUIREMENT - Mathematical Notation ⚠️
-You MUST ALWAYS use LaTeX/KaTeX notation for ANY mathematical expressions. This is NON-NEGOTIABLE.
+    async def get(self, session_id: str) -> Optional[ChatSession]:
+        session = self._sessions.get(session_id)
+        now = time.time()
+        if session is not None and self._expired(session, now):
+            del self._sessions[session_id]
+            self._stats["expired"] += 1
+            session = None
+        # Another worker may have served turns since this worker's copy was last used
+        if self._db is not None and (session is None or await asyncio.to_thread(self._db_touch, session_id) != session.next_seq):
+            loaded = await asyncio.to_thread(self._db_load, session_id)
+            if loaded is None:
+                return None
+            (chat_type, mbti_type, next_seq, created_at), messages = loaded
+            history = [{"role": role, "content": content} for role, content in messages]
+            session = ChatSession(session_id, chat_type, mbti_type, history, next_seq, created_at)
+        if session is None:
+            return None
+        session.last_used = now
+        self._remember(session)
+        self._stats["resumed"] += 1
+        return session
 
-RULES FOR MATH FORMATTING:
-1. Inline math: Use $expression$ (single dollar signs)
-2. Display math: Use $$expression$$ (double dollar signs for centered equations)
-3. NEVER write plain text math like "tan(x) = sin(x)/cos(x)"
-4. ALWAYS use LaTeX: $\\tan(x) = \\frac{\\sin(x)}{\\cos(x)}$
+    async def append(self, session: ChatSession, messages: List[dict]):
+        """Record a completed turn"""
+        session.history.extend(messages)
+        session.next_seq += len(messages)
+        session.last_used = time.time()
+        self._trim(session)
+        self._remember(session)
+        self._stats["turns"] += 1
+        if self._db is not None:
+            await asyncio.to_thread(self._db_append, session, messages)
+            await self._purge_if_due()
 
-MANDATORY EXAMPLES - YOU MUST FOLLOW THIS FORMAT:
-❌ WRONG: tan(2θ) = 2tan(θ) / (1 - tan²(θ))
-✓ CORRECT: $$\\tan(2\\theta) = \\frac{2\\tan(\\theta)}{1 - \\tan^2(\\theta)}$$
+    async def delete(self, session_id: str):
+        self._sessions.pop(session_id, None)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_delete, session_id)
 
-❌ WRONG: x = (-b ± sqrt(b² - 4ac)) / (2a)
-✓ CORRECT: $$x = \\frac{-b \\pm \\sqrt{b^2 - 4ac}}{2a}$$
+    def snapshot(self) -> dict:
+        return {
+            **self._stats,
+            "sessions": len(self._sessions),
+            "messages": sum(len(session.history) for session in self._sessions.values()),
+            "persistent": self._db is not None,
+        }
 
-❌ WRONG: Write 5/6 as a fraction
-✓ CORRECT: Write $\\frac{5}{6}$ as a fraction
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
 
-LATEX SYNTAX YOU MUST USE:
-- Fractions: $\\frac{numerator}{denominator}$
-- Greek: $\\theta$ $\\pi$ $\\alpha$ $\\beta$ $\\gamma$ $\\Delta$
-- Trig functions: $\\sin(x)$ $\\cos(x)$ $\\tan(x)$ $\\sec(x)$ $\\csc(x)$ $\\cot(x)$
-- Exponents: $x^2$ $e^{i\\pi}$
-- Subscripts: $a_n$ $x_i$
-- Square roots: $\\sqrt{x}$ $\\sqrt[3]{x}$
-- Sums: $\\sum_{i=1}^{n}$
-- Integrals: $\\int_{a}^{b} f(x) dx$
-- Limits: $\\lim_{x \\to \\infty}$
+chat_sessions = ChatSessionStore(
+    max_sessions=CHAT_SESSION_MAX_SESSIONS,
+    idle_ttl=CHAT_SESSION_IDLE_TTL_SECONDS,
+    max_messages=CHAT_SESSION_MAX_MESSAGES,
+    max_age=CHAT_SESSION_MAX_AGE_SECONDS,
+    db_path=CHAT_SESSION_DB or None,
+)
 
-REMEMBER: Every single mathematical symbol, number, variable, or equation MUST be wrapped in dollar signs with proper LaTeX syntax. NO EXCEPTIONS.
+class ChatSessionStart(BaseModel):
+    chat_type: str  # "academic" or "mindfulness"; ignored when resuming
+    mbti_type: Optional[str] = None
+    session_id: Optional[str] = None  # Resume this session instead of starting a new one
+    messages: List[Message] = []  # Seed a new session with an existing conversation
 
-Be encouraging, clear, and supportive. Focus exclusively on helping students learn effectively.""",
-            
-            "mindfulness": """You are an AI mindfulness and mental wellness assistant for KindMinds. Your ONLY purpose is to help users with mental wellness and mindfulness practices.
+    @field_validator("mbti_type", mode="before")
+    @classmethod
+    def normalize_mbti(cls, value):
+        # The profile field is free text; a typo there should not break the request
+        return normalize_mbti_type(value) if isinstance(value, str) else value
 
-You MUST help with:
-- Stress management and relaxation techniques
-- Mindfulness practices and meditation guidance
-- Emotional well-being and self-care
-- Building positive habits and resilience
-- Managing anxiety and promoting calm
-- Breathing exercises and grounding techniques
-- Work-life balance and mental health
-- Sleep hygiene and relaxation
-- Dealing with academic stress and burnout
+class ChatSessionTurn(BaseModel):
+    content: str
+    sentiment: Optional[SentimentContext] = None  # Same meaning as ChatRequest.sentiment, for this turn only
 
-You MUST REFUSE to answer questions about:
-- General trivia or entertainment
-- Coding/programming
-- News, politics, or current events
-- Shopping or product recommendations
-- Dating or relationship advice (unless related to emotional wellness)
-- Medical diagnosis or prescription advice
-- Legal advice
-- Academic homework or study help
-- Any non-wellness topics
+@app.get("/api/chat/sessions/stats")
+async def chat_session_stats():
+    """Sessions held by this worker and how often they were created, resumed and used"""
+    return chat_sessions.snapshot()
 
-If asked about non-wellness topics, politely respond: "I'm KindMinds Mindfulness Assistant. I'm specifically designed to help with stress management, meditation, and mental wellness. For this type of question, please try a general-purpose AI or switch to the Academic tab for study help. Is there anything about your mental wellness or mindfulness practice I can help you with?"
+async def run_session_turn(websocket: WebSocket, session: ChatSession, turn: ChatSessionTurn):
+    """Answer one message over the socket and, if the reply completes, add both to the history"""
+    user_message = {"role": "user", "content": turn.content}
+    timings = RequestTimings()
+    timings_token = request_timings.set(timings)
+    id_token = log_request_id.set(f"{session.session_id[:8]}-{session.next_seq}")
+    status = 200
+    try:
+        async with session.lock:
+            with timed_phase("prompt_build"):
+                sentiment_note = sentiment_prompt_note(turn.sentiment)
+                history = await compact_history(session.chat_type, session.mbti_type,
+                                                session.system_prompt + sentiment_note, session.history + [user_message])
+                messages = assemble_chat_messages(session.system_prompt, history, sentiment_note)
+            try:
+                stream = await create_completion(
+                    "chat",
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=1024,
+                    stream=True,
+                )
+            except HTTPException as e:
+                status = e.status_code
+                frame = {"type": "error", "detail": e.detail}
+                if e.headers and "Retry-After" in e.headers:
+                    frame["retry_after"] = float(e.headers["Retry-After"])
+                await websocket.send_json(frame)
+                return
+            except Exception as e:
+                status = 500
+                await websocket.send_json({"type": "error", "detail": str(e)})
+                return
+            async for event, data in chat_reply_events(stream, messages, session.chat_type):
+                if event == "done":
+                    await chat_sessions.append(session, [user_message, {"role": "assistant", "content": data["response"]}])
+                elif event == "error":
+                    status = 502
+                await websocket.send_json({"type": event, **data})
+    finally:
+        log_request_id.reset(id_token)
+        request_timings.reset(timings_token)
+        if METRICS_ENABLED:
+            metrics.record_request("/ws/chat", status, timings)
 
-Be compassionate, gentle, and supportive. Focus exclusively on promoting mental wellness and peace."""
-        }
-        
-        # Get the appropriate system prompt
-        base_prompt = system_prompts.get(request.chat_type, system_prompts["academic"])
-        
-        # Add MBTI personalization if provided
-        mbti_personalization = ""
-        if request.mbti_type:
-            mbti_personalization = f"\n\nPERSONALIZATION - User's MBTI Type: {request.mbti_type}\n"
-            mbti_personalization += "Adapt your communication style, examples, and approach to match this personality type:\n"
-            
-            # MBTI-based personalization guidelines
-            if request.mbti_type[0] == 'E':  # Extraversion
-                mbti_personalization += "- User prefers interactive, energetic communication. Engage actively and encourage discussion.\n"
-            else:  # Introversion
-                mbti_personalization += "- User prefers thoughtful, reflective communication. Allow processing time and provide detailed written explanations.\n"
-            
-            if request.mbti_type[1] == 'S':  # Sensing
-                mbti_personalization += "- User learns best with concrete examples, practical applications, and step-by-step processes.\n"
-            else:  # Intuition
-                mbti_personalization += "- User learns best with conceptual frameworks, patterns, and big-picture connections.\n"
-            
-            if request.mbti_type[2] == 'T':  # Thinking
-                mbti_personalization += "- User values logical reasoning, objective analysis, and systematic approaches. Be direct and analytical.\n"
-            else:  # Feeling
-                mbti_personalization += "- User values empathy, harmony, and personal connections. Be warm, supportive, and consider emotional impact.\n"
-            
-            if request.mbti_type[3] == 'J':  # Judging
-                mbti_personalization += "- User prefers structure, organization, and clear conclusions. Provide organized, definitive answers.\n"
-            else:  # Perceiving
-                mbti_personalization += "- User prefers flexibility, exploration, and keeping options open. Offer multiple perspectives and adaptable approaches.\n"
-        
-        # Add sentiment-based activity suggestion to system prompt if negative sentiment detected
-        sentiment_suggestion = ""
-        if request.sentiment and request.sentiment.suggested_activity:
-            activity_name = "breathing exercises" if request.sentiment.suggested_activity == "breathing" else "a grounding exercise"
-            sentiment_suggestion = f"\n\n⚠️ SENTIMENT CONTEXT - User's current message shows {request.sentiment.sentiment} sentiment (score: {request.sentiment.score:.2f}).\n"
-            sentiment_suggestion += f"The system has detected that the user might benefit from {activity_name}, but you should ASK THE USER FIRST before suggesting it.\n"
-            sentiment_suggestion += f"Suggest the activity naturally in your response, like: 'Would you like to try some breathing exercises together? They can really help when you're feeling this way.'\n"
-            sentiment_suggestion += "Wait for the user to say 'yes' or agree before mentioning that the activity is ready to start.\n"
-            sentiment_suggestion += "Be supportive and empathetic, but don't force the activity - let them decide.\n"
-        
-        system_prompt = base_prompt + mbti_personalization + sentiment_suggestion
-        
-        # Prepare messages for Groq
-        messages = [{"role": "system", "content": system_prompt}]
-        messages.extend([{"role": msg.role, "content": msg.content} for msg in request.messages])
-        
-        # Call Groq API
-        chat_completion = client.chat.completions.create(
-            messages=messages,
-            model="llama-3.3-70b-versatile",
-            temperature=0.7,
-            max_tokens=1024,
-        )
-        
-        response_content = chat_completion.choices[0].message.content
-        
-        # Convert math notation to LaTeX for academic chat
-        if request.chat_type == "academic":
-            response_content = convert_math_to_latex(response_content)
-        
-        return ChatResponse(response=response_content)
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    """Chat over one WebSocket with the history held server-side.
+
+    The first frame is `{"type": "start", ...}` (see ChatSessionStart) and is answered with
+    `{"type": "session", "session_id", "messages"}`. Each following `{"type": "message",
+    "content", "sentiment"?}` frame is answered with the same delta/done/error sequence as
+    /api/chat/stream, as `{"type": event, ...}` frames. A turn whose reply fails is not added
+    to the history, so the client can simply send the message again.
+    """
+    origin = websocket.headers.get("origin")
+    if origin and origin not in cors_origins:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    session = None
+    try:
+        while True:
+            try:
+                frame = json.loads(await websocket.receive_text())
+                kind = frame.get("type") if isinstance(frame, dict) else None
+                if kind == "start":
+                    start = ChatSessionStart.model_validate(frame)
+                    session = await chat_sessions.get(start.session_id) if start.session_id else None
+                    if start.session_id and session is None:
+                        await websocket.send_json({"type": "error", "detail": "Session not found or expired."})
+                        continue
+                    if session is None:
+                        session = await chat_sessions.create(
+                            start.chat_type, start.mbti_type,
+                            [{"role": msg.role, "content": msg.content} for msg in start.messages],
+                        )
+                    await websocket.send_json({"type": "session", "session_id": session.session_id,
+                                               "messages": len(session.history)})
+                    continue
+                if kind != "message":
+                    raise ValueError('Expected a frame of type "start" or "message"')
+                if session is None:
+                    raise ValueError('Send a "start" frame before the first message')
+                turn = ChatSessionTurn.model_validate(frame)
+                if len(turn.content) > CHAT_SESSION_MAX_MESSAGE_CHARS:
+                    raise ValueError(f"Message exceeds {CHAT_SESSION_MAX_MESSAGE_CHARS} characters")
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                # Bad frames (invalid JSON or fields, bad MBTI type) are reported without closing the socket
+                await websocket.send_json({"type": "error", "detail": str(e)})
+                continue
+            await run_session_turn(websocket, session, turn)
+    except WebSocketDisconnect:
+        pass
 
 @app.post("/api/tools/reframe", response_model=ReframeResponse)
 async def reframe_thought(request: ReframeRequest):
+    shed_if_overloaded("reframe")
     try:
-        base_prompt = """You are a compassionate cognitive behavioral therapy coach.
-You receive an intrusive or unhelpful thought and respond with a thoughtful, empathetic reframe.
-Return only the reframed statement—concise, encouraging, and practical."""
-
-        # Add MBTI personalization if provided
-        mbti_personalization = ""
-        if request.mbti_type:
-            mbti_personalization = f"\n\nPERSONALIZATION - User's MBTI Type: {request.mbti_type}\n"
-            if request.mbti_type[2] == 'T':  # Thinking
-                mbti_personalization += "Use logical, analytical reframes. Focus on facts and objective perspectives. Be direct and systematic.\n"
-            else:  # Feeling
-                mbti_personalization += "Use warm, empathetic reframes. Focus on values, emotions, and human connections. Be supportive and consider emotional impact.\n"
-            
-            if request.mbti_type[1] == 'S':  # Sensing
-                mbti_personalization += "Provide concrete, practical examples and real-world applications in the reframe.\n"
-            else:  # Intuition
-                mbti_personalization += "Connect to broader patterns, meanings, and future possibilities in the reframe.\n"
-
-        system_prompt = base_prompt + mbti_personalization
+        system_prompt = prompt_registry.get("reframe", request.mbti_type)
 
         messages = [
             {"role": "system", "content": system_prompt},
@@ -352,22 +2924,21 @@ Return only the reframed statement—concise, encouraging, and practical."""
             },
         ]
 
-        chat_completion = client.chat.completions.create(
+        chat_completion = await create_completion(
+            "reframe",
             messages=messages,
-            model="llama-3.3-70b-versatile",
             temperature=0.6,
             max_tokens=400,
         )
 
         reframed = chat_completion.choices[0].message.content.strip()
         return ReframeResponse(reframed=reframed)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/tools/flashcards", response_model=FlashcardsResponse)
-async def generate_flashcards(request: FlashcardsRequest):
-    try:
-        system_prompt = """You are an expert study coach who builds flashcards from learning material.
+FLASHCARDS_SYSTEM_PROMPT = """You are an expert study coach who builds flashcards from learning material.
 Return 4 to 8 high-quality question-answer flashcards that cover the most important concepts.
 Respond strictly in JSON with the following schema:
 {
@@ -378,60 +2949,22 @@ Respond strictly in JSON with the following schema:
 }
 Keep questions short and answers focused."""
 
-        user_prompt = f"""Create flashcards from the following study material:
-Filename: {request.filename or "document"}
-
-Content:
-{request.content.strip()}"""
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ]
-
-        chat_completion = client.chat.completions.create(
-            messages=messages,
-            model="llama-3.3-70b-versatile",
-            temperature=0.3,
-            max_tokens=900,
-        )
-
-        raw_content = chat_completion.choices[0].message.content.strip()
-        try:
-            parsed = json.loads(raw_content)
-        except json.JSONDecodeError:
-            # attempt to extract JSON substring
-            start = raw_content.find("{")
-            end = raw_content.rfind("}") + 1
-            if start >= 0 and end > start:
-                parsed = json.loads(raw_content[start:end])
-            else:
-                raise
-
-        title = parsed.get("title") or (request.filename or "Flashcard Set")
-        cards = parsed.get("cards", [])
-        sanitized_cards = []
-        for card in cards:
-            question = str(card.get("question", "")).strip()
-            answer = str(card.get("answer", "")).strip()
-            if question and answer:
-                sanitized_cards.append({"question": question, "answer": answer})
-
-        if not sanitized_cards:
-            raise HTTPException(status_code=500, detail="Unable to generate flashcards.")
+# Used per section when a large document is split into chunks
+FLASHCARDS_CHUNK_SYSTEM_PROMPT = """You are an expert study coach who builds flashcards from learning material.
+You will receive one section of a larger document. Return {count} high-quality question-answer flashcards that cover the most important concepts in this section, most important first.
+Respond strictly in JSON with the following schema:
+{{
+  "title": "short helpful title",
+  "cards": [
+    {{ "question": "Q1", "answer": "A1" }}
+  ]
+}}
+Keep questions short and answers focused."""
 
-        return FlashcardsResponse(title=title, cards=sanitized_cards)
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+FLASHCARDS_MIN_CARDS = 4  # Fewer surviving cards than this trigger a top-up call
+FLASHCARDS_MAX_CARDS = 8
 
-@app.post("/api/tools/quiz", response_model=QuizResponse)
-async def generate_quiz(request: QuizRequest):
-    try:
-        num_questions = min(max(request.num_questions or 5, 3), 10)  # Between 3-10 questions
-        
-        system_prompt = f"""You are an expert educator who creates high-quality quiz questions from study material.
+QUIZ_SYSTEM_PROMPT = """You are an expert educator who creates high-quality quiz questions from study material.
 Generate {num_questions} multiple-choice questions that test understanding of key concepts from the content.
 
 For each question:
@@ -457,94 +2990,970 @@ Respond strictly in JSON with this schema:
   ]
 }}
 
-Focus on:
-- Testing comprehension, not just recall
-- Covering the most important concepts
-- Creating plausible incorrect options (distractors)
-- Clear, unambiguous questions"""
+Focus on:
+- Testing comprehension, not just recall
+- Covering the most important concepts
+- Creating plausible incorrect options (distractors)
+- Clear, unambiguous questions"""
+
+class JSONArrayItemParser:
+    """Incrementally parse a streamed JSON object, returning elements of one array as they close.
+
+    Only the structure is tracked (nesting depth, strings and escapes); each element is
+    parsed with json.loads once its closing brace arrives. Text before the first "{"
+    (e.g. a Markdown code fence) is skipped. A top-level "title" string is kept as well.
+    """
+
+    def __init__(self, array_key: str):
+        self.array_key = array_key
+        self.text = ""
+        self.items = []
+        self.title = None
+        self.closed = False  # The root object was closed, i.e. the output was not cut short
+        self._pos = 0
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None  # Latest string read at depth 1, the key if a ":" follows
+        self._key = None  # Key whose value is being read at depth 1
+        self._in_array = False
+        self._item_start = None
+
+    def feed(self, delta: str) -> List[dict]:
+        """Add streamed text; returns the array elements completed by it"""
+        self.text += delta
+        text, completed = self.text, []
+        i = self._pos
+        while i < len(text) and not self.closed:
+            ch = text[i]
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._depth = 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._read_string(text[self._string_start:i + 1])
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == ":" and self._depth == 1:
+                self._key, self._last_string = self._last_string, None
+            elif ch == "," and self._depth == 1:
+                self._key = None
+            elif ch in "{[":
+                if ch == "[" and self._depth == 1 and self._key == self.array_key:
+                    self._in_array = True
+                elif ch == "{" and self._in_array and self._depth == 2:
+                    self._item_start = i
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if ch == "}" and self._in_array and self._depth == 2 and self._item_start is not None:
+                    try:
+                        item = json.loads(text[self._item_start:i + 1])
+                    except json.JSONDecodeError:
+                        item = None
+                    if isinstance(item, dict):
+                        self.items.append(item)
+                        completed.append(item)
+                    self._item_start = None
+                elif ch == "]" and self._in_array and self._depth == 1:
+                    self._in_array = False
+                elif self._depth == 0:
+                    self.closed = True
+            i += 1
+        self._pos = i
+        return completed
+
+    def _read_string(self, literal: str):
+        try:
+            value = json.loads(literal)
+        except json.JSONDecodeError:
+            return
+        if self._key is None:
+            self._last_string = value
+        elif self._key == "title":
+            self.title = value
+
+# Structured output: the non-streaming JSON endpoints use Groq's JSON mode (streams are parsed
+# incrementally instead), and a reply that still comes up short gets one top-up call
+STRUCTURED_JSON_MODE = os.getenv("STRUCTURED_JSON_MODE", "true").lower() in ("1", "true", "yes")
+STRUCTURED_TOPUP_ENABLED = os.getenv("STRUCTURED_TOPUP_ENABLED", "true").lower() in ("1", "true", "yes")
+JSON_MODE_PARAMS = {"response_format": {"type": "json_object"}} if STRUCTURED_JSON_MODE else {}
+
+def record_structured_output(endpoint: str, outcome: str):
+    metrics.inc("kindminds_structured_outputs_total", (("endpoint", endpoint), ("outcome", outcome)))
+
+def parse_structured_output(endpoint: str, raw_content: str, array_key: Optional[str] = None) -> dict:
+    """Parse a JSON reply, tolerating extra text around it and, with `array_key`, a cut-off reply.
+
+    A reply that is not valid JSON even around its outermost braces (typically one cut
+    off at max_tokens) still yields every complete element of `array_key`, and the result
+    is marked "truncated". Raises json.JSONDecodeError when nothing usable is left.
+    """
+    try:
+        parsed, outcome = json.loads(raw_content), "parsed"
+    except json.JSONDecodeError as exc:
+        outcome, error = None, exc
+        start, end = raw_content.find("{"), raw_content.rfind("}") + 1
+        if start >= 0 and end > start:
+            try:
+                parsed, outcome = json.loads(raw_content[start:end]), "repaired"
+                record_fallback("json_repair")
+            except json.JSONDecodeError as retry_exc:
+                error = retry_exc
+        if outcome is None:
+            parser = JSONArrayItemParser(array_key) if array_key else None
+            if parser is not None:
+                parser.feed(raw_content)
+            if parser is None or not parser.items:
+                record_structured_output(endpoint, "failed")
+                raise error
+            record_fallback("json_salvage")
+            parsed, outcome = {"title": parser.title, array_key: parser.items, "truncated": True}, "salvaged"
+    record_structured_output(endpoint, outcome)
+    return parsed
+
+def sanitize_flashcards(cards: list) -> List[dict]:
+    """Keep only cards with a non-empty question and answer"""
+    sanitized_cards = []
+    for card in cards:
+        question = str(card.get("question", "")).strip()
+        answer = str(card.get("answer", "")).strip()
+        if question and answer:
+            sanitized_cards.append({"question": question, "answer": answer})
+    return sanitized_cards
+
+def sanitize_quiz_questions(questions_raw: list) -> List[QuizQuestion]:
+    """Keep only questions with text, at least 2 options and exactly one correct answer"""
+    sanitized_questions = []
+    for q in questions_raw:
+        question_text = str(q.get("question", "")).strip()
+        options_raw = q.get("options", [])
+        explanation = str(q.get("explanation", "")).strip() or None
+        
+        if not question_text or len(options_raw) < 2:
+            continue
+        
+        # Process options
+        sanitized_options = []
+        correct_count = 0
+        for opt in options_raw:
+            opt_text = str(opt.get("text", "")).strip()
+            is_correct = opt.get("is_correct", False)
+            
+            if not opt_text:
+                continue
+            
+            if is_correct:
+                correct_count += 1
+            
+            sanitized_options.append(QuizOption(text=opt_text, is_correct=is_correct))
+        
+        # Must have exactly one correct answer and at least 2 options
+        if correct_count != 1 or len(sanitized_options) < 2:
+            continue
+        
+        sanitized_questions.append(QuizQuestion(
+            question=question_text,
+            options=sanitized_options,
+            explanation=explanation
+        ))
+    return sanitized_questions
+
+# Map-reduce generation for large documents
+DOCUMENT_CHUNK_THRESHOLD_CHARS = int(os.getenv("DOCUMENT_CHUNK_THRESHOLD_CHARS", "12000"))  # Larger content is chunked
+DOCUMENT_CHUNK_TARGET_CHARS = int(os.getenv("DOCUMENT_CHUNK_TARGET_CHARS", "6000"))
+DOCUMENT_MAX_CHUNKS = int(os.getenv("DOCUMENT_MAX_CHUNKS", "12"))  # Upper bound on parallel upstream calls per request
+CHUNK_OVERSAMPLE = 1.5  # Ask each chunk for extra candidates so dedupe still leaves enough
+
+# Markdown headings, numbered headings ("2.1 Cell Division"), "Chapter 3 ..." and short ALL-CAPS lines
+HEADING_PATTERN = re.compile(
+    r"^(?:#{1,6}\s+\S|(?:\d+(?:\.\d+)*\.?|[Cc]hapter\s+\d+|[Ss]ection\s+\d+)\s+[A-Z]|[A-Z][A-Z0-9 ,:&'()-]{3,80}$)"
+)
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+
+def _is_heading(block: str) -> bool:
+    return bool(HEADING_PATTERN.match(block.split("\n", 1)[0].strip()))
+
+def _split_long_block(block: str, limit: int) -> List[str]:
+    """Split a paragraph longer than `limit` on sentence boundaries (hard-splitting run-on text)"""
+    if len(block) <= limit:
+        return [block]
+    pieces, current = [], ""
+    for sentence in SENTENCE_BREAK.split(block):
+        while len(sentence) > limit:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:limit])
+            sentence = sentence[limit:]
+        if current and len(current) + len(sentence) + 1 > limit:
+            pieces.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+def chunk_document(text: str) -> List[str]:
+    """Split study material into at most DOCUMENT_MAX_CHUNKS chunks along its structure.
+
+    Paragraphs are packed up to the target size and a heading starts a new chunk once
+    the current one is at least half full. Content under the threshold stays whole.
+    """
+    text = text.strip()
+    if len(text) <= DOCUMENT_CHUNK_THRESHOLD_CHARS:
+        return [text]
+
+    target = max(DOCUMENT_CHUNK_TARGET_CHARS, -(-len(text) // DOCUMENT_MAX_CHUNKS))
+    chunks, current, size = [], [], 0
+    for block in re.split(r"\n\s*\n", text):
+        block = block.strip()
+        if not block:
+            continue
+        for piece in _split_long_block(block, target):
+            if current and (size + len(piece) > target or (_is_heading(piece) and size >= target // 2)):
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+
+    # Heading breaks can overshoot the chunk budget; merge the smallest neighbours back together
+    while len(chunks) > DOCUMENT_MAX_CHUNKS:
+        i = min(range(len(chunks) - 1), key=lambda k: len(chunks[k]) + len(chunks[k + 1]))
+        chunks[i:i + 2] = [chunks[i] + "\n\n" + chunks[i + 1]]
+    return chunks
+
+def _question_tokens(text: str) -> frozenset:
+    return frozenset(re.findall(r"[a-z0-9]+", text.lower()))
+
+def is_near_duplicate(tokens: frozenset, seen: List[frozenset]) -> bool:
+    """Token Jaccard >= 0.8 with any question already kept"""
+    return any(len(tokens & other) >= 0.8 * len(tokens | other) for other in seen)
+
+def merge_ranked_candidates(candidate_lists: List[list], question_of, limit: int) -> list:
+    """Merge per-chunk candidates down to `limit`.
+
+    Chunks are visited round-robin (each chunk lists its most important items first),
+    so every section is represented before any gets a second item. Near-duplicate
+    questions (token Jaccard >= 0.8) are dropped.
+    """
+    merged, seen = [], []
+    for rank in range(max((len(items) for items in candidate_lists), default=0)):
+        for items in candidate_lists:
+            if rank >= len(items):
+                continue
+            tokens = _question_tokens(question_of(items[rank]))
+            if is_near_duplicate(tokens, seen):
+                continue
+            seen.append(tokens)
+            merged.append(items[rank])
+            if len(merged) == limit:
+                return merged
+    return merged
+
+async def generate_json(endpoint: str, system_prompt: str, user_prompt: str, model_params: dict,
+                        array_key: Optional[str] = None) -> dict:
+    """One structured-output generation in JSON mode, parsed into a dict (see parse_structured_output)"""
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+    chat_completion = await create_completion(
+        endpoint,
+        messages=messages,
+        **JSON_MODE_PARAMS,
+        **model_params,
+    )
+
+    raw_content = (chat_completion.choices[0].message.content or "").strip()
+    with timed_phase("parse"):
+        return parse_structured_output(endpoint, raw_content, array_key)
+
+async def top_up_items(endpoint: str, system_prompt: str, user_prompt: str, model_params: dict, array_key: str,
+                       sanitize, question_of, have: list, missing: int) -> list:
+    """One extra generation for the `missing` items a reply came up short by.
+
+    The prompt repeats the original request and lists the questions already generated.
+    New items are sanitized, near-duplicates of earlier ones are dropped and at most
+    `missing` are returned. If the call fails the request keeps what it has.
+    """
+    record_fallback("json_topup")
+    prompt = f"{user_prompt}\n\nOnly {missing} more are needed."
+    if have:
+        previous = "\n".join(f"- {question_of(item)}" for item in have)
+        prompt += f" Do not repeat or rephrase these, which were already generated:\n{previous}"
+    try:
+        parsed = await generate_json(endpoint, system_prompt, prompt, model_params, array_key)
+    except Exception as e:
+        metrics.inc("kindminds_topups_total", (("endpoint", endpoint), ("outcome", "failed")))
+        tools_log.warning("top-up failed", extra={"endpoint": endpoint, "missing": missing, "error": str(e)})
+        return []
+
+    seen = [_question_tokens(question_of(item)) for item in have]
+    added = []
+    for item in sanitize(parsed.get(array_key, [])):
+        tokens = _question_tokens(question_of(item))
+        if is_near_duplicate(tokens, seen):
+            continue
+        seen.append(tokens)
+        added.append(item)
+        if len(added) == missing:
+            break
+    outcome = "filled" if len(added) == missing else "short"
+    metrics.inc("kindminds_topups_total", (("endpoint", endpoint), ("outcome", outcome)))
+    return added
+
+async def stream_json_items(endpoint: str, system_prompt: str, user_prompt: str, model_params: dict,
+                            array_key: str, on_element) -> dict:
+    """Streaming generate_json: `on_element(raw)` is awaited for each element of `array_key` as it closes.
+
+    Returns {"title", array_key, "truncated"}. Every complete element is kept when the
+    output is cut short (max_tokens, or the upstream failing after the first element).
+    """
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    stream = await create_completion(endpoint, messages=messages, stream=True, **model_params)
+    parser = JSONArrayItemParser(array_key)
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            with timed_phase("parse"):
+                elements = parser.feed(chunk.choices[0].delta.content or "")
+            for element in elements:
+                await on_element(element)
+    except Exception:
+        if not parser.items:
+            raise
+
+    elements = parser.items
+    if not elements and not parser.closed:
+        # Not the expected shape after all; fall back to parsing the whole reply
+        record_fallback("json_reparse")
+        with timed_phase("parse"):
+            parsed = parse_structured_output(endpoint, parser.text)
+        elements = [element for element in parsed.get(array_key, []) if isinstance(element, dict)]
+        for element in elements:
+            await on_element(element)
+        parser.title = parser.title or parsed.get("title")
+    else:
+        record_structured_output(endpoint, "parsed" if parser.closed else "salvaged")
+    return {"title": parser.title, array_key: elements, "truncated": not parser.closed}
+
+async def map_chunks(endpoint: str, chunks: List[str], build_prompts, model_params: dict,
+                     artifacts: Optional[dict] = None, on_progress=None,
+                     array_key: Optional[str] = None, on_element=None) -> List[dict]:
+    """Run one generation per chunk in parallel; fails only if every chunk fails.
+
+    When `artifacts` (a stored document's artifact dict) is given, per-chunk outputs are
+    kept there and reused by later requests that build the same chunk prompt.
+    `on_progress(fraction)` is awaited as chunks finish. With `on_element`, chunks are
+    streamed and each element of `array_key` is passed to it as soon as it is generated.
+    """
+    finished = 0
+
+    async def generate(system_prompt: str, user_prompt: str) -> dict:
+        if on_element is None:
+            return await generate_json(endpoint, system_prompt, user_prompt, model_params, array_key)
+        return await stream_json_items(endpoint, system_prompt, user_prompt, model_params, array_key, on_element)
+
+    async def generate_chunk(index: int, chunk: str) -> dict:
+        system_prompt, user_prompt = build_prompts(index, chunk)
+        if artifacts is None:
+            return await generate(system_prompt, user_prompt)
+        key = ResultCache.make_key(endpoint, {"system": system_prompt, "user": user_prompt, **model_params})
+        if key in artifacts:
+            if on_element is not None:
+                for element in artifacts[key].get(array_key, []):
+                    await on_element(element)
+            return artifacts[key]
+        parsed = await generate(system_prompt, user_prompt)
+        if not parsed.get("truncated"):
+            artifacts[key] = parsed
+        return parsed
+
+    async def run_chunk(index: int, chunk: str) -> dict:
+        nonlocal finished
+        try:
+            return await generate_chunk(index, chunk)
+        finally:
+            finished += 1
+            if on_progress is not None:
+                await on_progress(finished / len(chunks))
+
+    outcomes = await asyncio.gather(
+        *(run_chunk(index, chunk) for index, chunk in enumerate(chunks)),
+        return_exceptions=True,
+    )
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException) and not isinstance(outcome, Exception):
+            raise outcome  # A cancelled chunk (CancelledError) cancels the request, it is not a result
+    parsed = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+    if not parsed:
+        raise outcomes[0]
+    return parsed
+
+# Server-side document store so the tools can reference uploads by doc_id
+DOCUMENT_MAX_UPLOAD_MB = float(os.getenv("DOCUMENT_MAX_UPLOAD_MB", "5"))
+DOCUMENT_STORE_MAX_DOCUMENTS = int(os.getenv("DOCUMENT_STORE_MAX_DOCUMENTS", "500"))
+DOCUMENT_STORE_MAX_MB = float(os.getenv("DOCUMENT_STORE_MAX_MB", "128"))  # In-memory tier, per worker
+DOCUMENT_STORE_IDLE_TTL_SECONDS = float(os.getenv("DOCUMENT_STORE_IDLE_TTL_SECONDS", "3600"))
+# Opt-in SQLite file shared by all workers on the host. It holds uploaded notes, so it is off by
+# default (memory only, per worker); point it at private storage.
+DOCUMENT_STORE_DB = os.getenv("DOCUMENT_STORE_DB", "")
+DOCUMENT_UPLOAD_READ_SIZE = 64 * 1024
+
+class StoredDocument:
+    """A normalized, pre-chunked upload plus artifacts cached from earlier generations"""
+
+    def __init__(self, doc_id: str, filename: Optional[str], content: str, chunks: List[str]):
+        self.doc_id = doc_id
+        self.filename = filename
+        self.content = content
+        self.chunks = chunks
+        self.size = len(content)
+        self.last_access = time.time()
+        self.artifacts = {}  # e.g. per-chunk generation outputs, reused by later requests
+
+def normalize_document_text(text: str) -> str:
+    """Unify newlines, strip trailing spaces and collapse runs of blank lines"""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = "\n".join(line.rstrip() for line in text.split("\n"))
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+class DocumentStore:
+    """Bounded, idle-evicted store of uploaded documents.
+
+    Documents are content-addressed, so uploading the same notes twice yields the same
+    doc_id. Parsed documents live in a per-worker LRU capped by count and size; the
+    optional SQLite tier lets any worker serve a doc_id uploaded through another.
+    """
+
+    def __init__(self, max_documents: int, max_bytes: int, idle_ttl: float, db_path: Optional[str] = None):
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._documents = OrderedDict()  # doc_id -> StoredDocument
+        self._bytes = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, filename TEXT, content TEXT NOT NULL, "
+                "chunks TEXT NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _remember(self, document: StoredDocument):
+        self._forget(document.doc_id)
+        self._documents[document.doc_id] = document
+        self._bytes += document.size
+        now = time.time()
+        while self._documents:
+            oldest = next(iter(self._documents.values()))
+            if (len(self._documents) <= self.max_documents and self._bytes <= self.max_bytes
+                    and now - oldest.last_access <= self.idle_ttl):
+                break
+            self._forget(oldest.doc_id)
+
+    def _forget(self, doc_id: str):
+        document = self._documents.pop(doc_id, None)
+        if document:
+            self._bytes -= document.size
+
+    def _db_put(self, document: StoredDocument):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO documents (doc_id, filename, content, chunks, last_access) VALUES (?, ?, ?, ?, ?)",
+                (document.doc_id, document.filename, document.content, json.dumps(document.chunks), document.last_access),
+            )
+            self._db.execute("DELETE FROM documents WHERE last_access < ?", (time.time() - self.idle_ttl,))
+            self._db.execute(
+                "DELETE FROM documents WHERE doc_id IN "
+                "(SELECT doc_id FROM documents ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_documents,),
+            )
+            self._db.commit()
+
+    def _db_get(self, doc_id: str):
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT filename, content, chunks FROM documents WHERE doc_id = ? AND last_access >= ?",
+                (doc_id, time.time() - self.idle_ttl),
+            ).fetchone()
+            if row:
+                self._db.execute("UPDATE documents SET last_access = ? WHERE doc_id = ?", (time.time(), doc_id))
+                self._db.commit()
+            return row
+
+    def _db_delete(self, doc_id: str):
+        with self._db_lock:
+            self._db.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+            self._db.commit()
+
+    async def put(self, content: str, filename: Optional[str]) -> StoredDocument:
+        normalized = normalize_document_text(content)
+        doc_id = hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:32]
+        existing = self._documents.get(doc_id)
+        if existing is not None:
+            existing.last_access = time.time()
+            self._documents.move_to_end(doc_id)
+            return existing
+        # Chunking is CPU-bound on large uploads, keep it off the event loop
+        chunks = await asyncio.to_thread(chunk_document, normalized)
+        document = StoredDocument(doc_id, filename, normalized, chunks)
+        self._remember(document)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_put, document)
+        return document
+
+    async def get(self, doc_id: str) -> Optional[StoredDocument]:
+        document = self._documents.get(doc_id)
+        now = time.time()
+        if document is not None:
+            if now - document.last_access <= self.idle_ttl:
+                document.last_access = now
+                self._documents.move_to_end(doc_id)
+                return document
+            self._forget(doc_id)
+        if self._db is not None:
+            row = await asyncio.to_thread(self._db_get, doc_id)
+            if row:
+                filename, content, chunks = row
+                document = StoredDocument(doc_id, filename, content, json.loads(chunks))
+                self._remember(document)
+                return document
+        return None
+
+    async def delete(self, doc_id: str):
+        self._forget(doc_id)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_delete, doc_id)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+document_store = DocumentStore(
+    max_documents=DOCUMENT_STORE_MAX_DOCUMENTS,
+    max_bytes=int(DOCUMENT_STORE_MAX_MB * 1024 * 1024),
+    idle_ttl=DOCUMENT_STORE_IDLE_TTL_SECONDS,
+    db_path=DOCUMENT_STORE_DB or None,
+)
+
+async def load_request_document(doc_id: Optional[str]) -> Optional[StoredDocument]:
+    """Look up a referenced document, or None if the request carries its content inline"""
+    if not doc_id:
+        return None
+    document = await document_store.get(doc_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found or expired. Please upload it again.")
+    return document
+
+def document_response(document: StoredDocument) -> DocumentResponse:
+    return DocumentResponse(
+        doc_id=document.doc_id,
+        filename=document.filename,
+        size=document.size,
+        chunks=len(document.chunks),
+        idle_ttl_seconds=document_store.idle_ttl,
+    )
+
+@app.post("/api/documents", response_model=DocumentResponse)
+async def upload_document(file: UploadFile = File(...), filename: Optional[str] = Form(None)):
+    """Store study material once and return a doc_id for the flashcards, quiz and scan-problem tools"""
+    max_bytes = int(DOCUMENT_MAX_UPLOAD_MB * 1024 * 1024)
+    too_large = HTTPException(status_code=413, detail=f"Document exceeds the {DOCUMENT_MAX_UPLOAD_MB:g} MB limit.")
+    if file.size is not None and file.size > max_bytes:
+        raise too_large
+
+    # Read in bounded pieces so an oversized upload is rejected without buffering it whole
+    pieces, total = [], 0
+    while True:
+        piece = await file.read(DOCUMENT_UPLOAD_READ_SIZE)
+        if not piece:
+            break
+        total += len(piece)
+        if total > max_bytes:
+            raise too_large
+        pieces.append(piece)
+
+    content = b"".join(pieces).decode("utf-8", errors="replace")
+    if not content.strip():
+        raise HTTPException(status_code=400, detail="Document is empty.")
+
+    document = await document_store.put(content, filename or file.filename)
+    return document_response(document)
+
+@app.get("/api/documents/{doc_id}", response_model=DocumentResponse)
+async def get_document(doc_id: str):
+    document = await load_request_document(doc_id)
+    return document_response(document)
+
+@app.delete("/api/documents/{doc_id}")
+async def delete_document(doc_id: str):
+    await document_store.delete(doc_id)
+    return {"deleted": doc_id}
+
+async def build_flashcards(request: FlashcardsRequest, bypass: bool = False, on_progress=None, on_item=None):
+    """Generate a flashcard set (or load it from the result cache); returns (response, X-Cache status).
+
+    With `on_item`, the generation is streamed and each card is awaited through it as
+    soon as it is complete and passes sanitization; the returned set holds the same cards.
+    """
+    system_prompt = FLASHCARDS_SYSTEM_PROMPT
+    document = await load_request_document(request.doc_id)
+    filename = request.filename or (document.filename if document else None)
+
+    model_params = {"temperature": 0.3, "max_tokens": 900}
+    cache_key = result_cache.make_key("flashcards", {
+        **({"document": document.doc_id} if document else {"content": normalize_cache_text(request.content)}),
+        "filename": filename,
+        "system_prompt": system_prompt,
+        **model_params,
+    })
+    if bypass:
+        result_cache.stats["bypasses"] += 1
+    else:
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            result = FlashcardsResponse(**cached)
+            if on_item is not None:
+                for card in result.cards:
+                    await on_item(card.model_dump())
+            return result, "HIT"
+
+    with timed_phase("prompt_build"):
+        chunks = document.chunks if document else chunk_document(request.content)
+    streamed, seen = [], []
+
+    async def on_element(raw: dict):
+        for card in sanitize_flashcards([raw]):
+            tokens = _question_tokens(card["question"])
+            if len(streamed) >= FLASHCARDS_MAX_CARDS or (len(chunks) > 1 and is_near_duplicate(tokens, seen)):
+                continue
+            seen.append(tokens)
+            streamed.append(card)
+            await on_item(card)
+
+    if len(chunks) == 1:
+        user_prompt = f"""Create flashcards from the following study material:
+Filename: {filename or "document"}
+
+Content:
+{chunks[0]}"""
+        if on_item is None:
+            parsed = await generate_json("flashcards", system_prompt, user_prompt, model_params, "cards")
+        else:
+            parsed = await stream_json_items("flashcards", system_prompt, user_prompt, model_params, "cards", on_element)
+        title = parsed.get("title") or (filename or "Flashcard Set")
+        with timed_phase("postprocess"):
+            sanitized_cards = sanitize_flashcards(parsed.get("cards", []))[:FLASHCARDS_MAX_CARDS]
+        truncated = parsed.get("truncated", False)
+        missing = FLASHCARDS_MIN_CARDS - len(sanitized_cards)
+        if missing > 0 and STRUCTURED_TOPUP_ENABLED and current_overload_level() == 0:
+            topup_params = {**model_params, "max_tokens": min(model_params["max_tokens"], 100 * missing + 100)}
+            added = await top_up_items("flashcards", system_prompt, user_prompt, topup_params, "cards",
+                                       sanitize_flashcards, lambda card: card["question"], sanitized_cards, missing)
+            if on_item is not None:
+                for card in added:
+                    await on_item(card)
+            sanitized_cards += added
+            truncated = truncated and len(added) < missing  # A filled-up set is complete enough to cache
+    else:
+        per_chunk = max(2, -(-int(FLASHCARDS_MAX_CARDS * CHUNK_OVERSAMPLE) // len(chunks)))
+        chunk_params = {**model_params, "max_tokens": min(model_params["max_tokens"], 100 * per_chunk + 100)}
+
+        def build_prompts(index, chunk):
+            user_prompt = f"""Create flashcards from section {index + 1} of {len(chunks)} of the following study material:
+Filename: {filename or "document"}
+
+Content:
+{chunk}"""
+            return FLASHCARDS_CHUNK_SYSTEM_PROMPT.format(count=per_chunk), user_prompt
+
+        parsed_chunks = await map_chunks("flashcards", chunks, build_prompts, chunk_params,
+                                         document.artifacts if document else None, on_progress,
+                                         "cards", on_element if on_item is not None else None)
+        title = filename or parsed_chunks[0].get("title") or "Flashcard Set"
+        if on_item is not None:
+            # Keep the cards in the order they were streamed
+            sanitized_cards = streamed
+        else:
+            with timed_phase("postprocess"):
+                sanitized_cards = merge_ranked_candidates(
+                    [sanitize_flashcards(parsed.get("cards", [])) for parsed in parsed_chunks],
+                    lambda card: card["question"],
+                    FLASHCARDS_MAX_CARDS,
+                )
+        truncated = any(parsed.get("truncated") for parsed in parsed_chunks)
+
+    if not sanitized_cards:
+        raise HTTPException(status_code=500, detail="Unable to generate flashcards.")
+
+    result = FlashcardsResponse(title=title, cards=sanitized_cards)
+    if not truncated:
+        await result_cache.set(cache_key, result.model_dump())
+    return result, "BYPASS" if bypass else "MISS"
+
+@app.post("/api/tools/flashcards", response_model=FlashcardsResponse)
+async def generate_flashcards(
+    request: FlashcardsRequest,
+    x_cache_bypass: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+):
+    shed_if_overloaded("flashcards")
+    bypass = cache_bypassed(x_cache_bypass, cache_control)
+    queued = await queue_if_overloaded(
+        "flashcards", request, lambda on_progress: build_flashcards(request, bypass, on_progress=on_progress)
+    )
+    if queued is not None:
+        return queued
+    try:
+        result, cache_status = await build_flashcards(request, bypass)
+        return payload_response(result, accept_encoding, headers={"X-Cache": cache_status})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def build_quiz(request: QuizRequest, bypass: bool = False, on_progress=None, on_item=None):
+    """Generate a quiz (or load it from the result cache); returns (response, X-Cache status).
 
-        user_prompt = f"""Create {num_questions} quiz questions from the following study material:
-Filename: {request.filename or "document"}
+    With `on_item`, the generation is streamed and each QuizQuestion is awaited through
+    it as soon as it is complete and valid; the returned quiz holds the same questions.
+    """
+    num_questions = min(max(request.num_questions or 5, 3), 10)  # Between 3-10 questions
+    
+    system_prompt = QUIZ_SYSTEM_PROMPT.format(num_questions=num_questions)
+    document = await load_request_document(request.doc_id)
+    filename = request.filename or (document.filename if document else None)
 
-Content:
-{request.content.strip()}"""
+    model_params = {"temperature": 0.3, "max_tokens": 1500}
+    cache_key = result_cache.make_key("quiz", {
+        **({"document": document.doc_id} if document else {"content": normalize_cache_text(request.content)}),
+        "filename": filename,
+        "num_questions": num_questions,
+        "system_prompt": system_prompt,
+        **model_params,
+    })
+    if bypass:
+        result_cache.stats["bypasses"] += 1
+    else:
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            result = QuizResponse(**cached)
+            if on_item is not None:
+                for question in result.questions:
+                    await on_item(question)
+            return result, "HIT"
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ]
+    with timed_phase("prompt_build"):
+        chunks = document.chunks if document else chunk_document(request.content)
+    streamed, seen = [], []
 
-        chat_completion = client.chat.completions.create(
-            messages=messages,
-            model="llama-3.3-70b-versatile",
-            temperature=0.3,
-            max_tokens=1500,
-        )
+    async def on_element(raw: dict):
+        for question in sanitize_quiz_questions([raw]):
+            tokens = _question_tokens(question.question)
+            if len(streamed) >= num_questions or (len(chunks) > 1 and is_near_duplicate(tokens, seen)):
+                continue
+            seen.append(tokens)
+            streamed.append(question)
+            await on_item(question)
 
-        raw_content = chat_completion.choices[0].message.content.strip()
-        
-        # Try to parse JSON
+    if len(chunks) == 1:
+        user_prompt = f"""Create {num_questions} quiz questions from the following study material:
+Filename: {filename or "document"}
+
+Content:
+{chunks[0]}"""
         try:
-            parsed = json.loads(raw_content)
-        except json.JSONDecodeError:
-            # Attempt to extract JSON substring
-            start = raw_content.find("{")
-            end = raw_content.rfind("}") + 1
-            if start >= 0 and end > start:
-                parsed = json.loads(raw_content[start:end])
+            if on_item is None:
+                parsed = await generate_json("quiz", system_prompt, user_prompt, model_params, "questions")
             else:
-                raise HTTPException(status_code=500, detail="Failed to parse quiz response")
+                parsed = await stream_json_items("quiz", system_prompt, user_prompt, model_params, "questions", on_element)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=500, detail="Failed to parse quiz response")
+        title = parsed.get("title") or (filename or "Quiz")
+        with timed_phase("postprocess"):
+            sanitized_questions = sanitize_quiz_questions(parsed.get("questions", []))[:num_questions]
+        truncated = parsed.get("truncated", False)
+        missing = num_questions - len(sanitized_questions)
+        if missing > 0 and STRUCTURED_TOPUP_ENABLED and current_overload_level() == 0:
+            topup_params = {**model_params, "max_tokens": min(model_params["max_tokens"], 250 * missing + 100)}
+            added = await top_up_items("quiz", QUIZ_SYSTEM_PROMPT.format(num_questions=missing), user_prompt,
+                                       topup_params, "questions", sanitize_quiz_questions,
+                                       lambda question: question.question, sanitized_questions, missing)
+            if on_item is not None:
+                for question in added:
+                    await on_item(question)
+            sanitized_questions += added
+            truncated = truncated and len(added) < missing
+    else:
+        per_chunk = max(2, -(-int(num_questions * CHUNK_OVERSAMPLE) // len(chunks)))
+        chunk_params = {**model_params, "max_tokens": min(model_params["max_tokens"], 250 * per_chunk + 100)}
 
-        title = parsed.get("title") or (request.filename or "Quiz")
-        questions_raw = parsed.get("questions", [])
-        
-        # Validate and sanitize questions
-        sanitized_questions = []
-        for q in questions_raw:
-            question_text = str(q.get("question", "")).strip()
-            options_raw = q.get("options", [])
-            explanation = str(q.get("explanation", "")).strip() or None
-            
-            if not question_text or len(options_raw) < 2:
-                continue
-            
-            # Process options
-            sanitized_options = []
-            correct_count = 0
-            for opt in options_raw:
-                opt_text = str(opt.get("text", "")).strip()
-                is_correct = opt.get("is_correct", False)
-                
-                if not opt_text:
-                    continue
-                
-                if is_correct:
-                    correct_count += 1
-                
-                sanitized_options.append(QuizOption(text=opt_text, is_correct=is_correct))
-            
-            # Must have exactly one correct answer and at least 2 options
-            if correct_count != 1 or len(sanitized_options) < 2:
-                continue
-            
-            sanitized_questions.append(QuizQuestion(
-                question=question_text,
-                options=sanitized_options,
-                explanation=explanation
-            ))
-        
-        if not sanitized_questions:
-            raise HTTPException(status_code=500, detail="No valid questions generated")
+        def build_prompts(index, chunk):
+            user_prompt = f"""Create {per_chunk} quiz questions from section {index + 1} of {len(chunks)} of the following study material:
+Filename: {filename or "document"}
+
+Content:
+{chunk}"""
+            return QUIZ_SYSTEM_PROMPT.format(num_questions=per_chunk), user_prompt
 
-        return QuizResponse(title=title, questions=sanitized_questions)
+        parsed_chunks = await map_chunks("quiz", chunks, build_prompts, chunk_params,
+                                         document.artifacts if document else None, on_progress,
+                                         "questions", on_element if on_item is not None else None)
+        title = filename or parsed_chunks[0].get("title") or "Quiz"
+        if on_item is not None:
+            # Keep the questions in the order they were streamed
+            sanitized_questions = streamed
+        else:
+            with timed_phase("postprocess"):
+                sanitized_questions = merge_ranked_candidates(
+                    [sanitize_quiz_questions(parsed.get("questions", [])) for parsed in parsed_chunks],
+                    lambda question: question.question,
+                    num_questions,
+                )
+        truncated = any(parsed.get("truncated") for parsed in parsed_chunks)
     
+    if not sanitized_questions:
+        raise HTTPException(status_code=500, detail="No valid questions generated")
+
+    result = QuizResponse(title=title, questions=sanitized_questions)
+    if not truncated:
+        await result_cache.set(cache_key, result.model_dump())
+    return result, "BYPASS" if bypass else "MISS"
+
+@app.post("/api/tools/quiz", response_model=QuizResponse)
+async def generate_quiz(
+    request: QuizRequest,
+    x_cache_bypass: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+):
+    shed_if_overloaded("quiz")
+    bypass = cache_bypassed(x_cache_bypass, cache_control)
+    queued = await queue_if_overloaded(
+        "quiz", request, lambda on_progress: build_quiz(request, bypass, on_progress=on_progress)
+    )
+    if queued is not None:
+        return queued
+    try:
+        result, cache_status = await build_quiz(request, bypass)
+        return payload_response(result, accept_encoding, headers={"X-Cache": cache_status})
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def stream_frame(event: str, data: dict, sse: bool) -> str:
+    """One streamed event, as an SSE frame or an NDJSON line"""
+    if sse:
+        return sse_event(event, data)
+    return dumps_json({"event": event, "data": data}).decode() + "\n"
+
+def item_stream_response(item_event: str, build, accept: Optional[str]) -> StreamingResponse:
+    """Stream a build_flashcards/build_quiz call item by item.
+
+    Emits one `item_event` per card/question as soon as it is generated, then `done` with
+    the full response body, or `error`. Served as SSE if the client accepts
+    text/event-stream, NDJSON otherwise. Generation stops if the client disconnects.
+    """
+    sse = "text/event-stream" in (accept or "")
+    queue = asyncio.Queue()
+
+    async def on_item(item):
+        await queue.put((item_event, item.model_dump() if isinstance(item, BaseModel) else item))
+
+    async def run():
+        try:
+            result, _ = await build(on_item)
+            await queue.put(("done", result.model_dump()))
+        except HTTPException as e:
+            await queue.put(("error", {"detail": e.detail}))
+        except Exception as e:
+            await queue.put(("error", {"detail": str(e)}))
+
+    async def event_source():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event, data = await queue.get()
+                yield stream_frame(event, data, sse)
+                if event in ("done", "error"):
+                    return
+        finally:
+            task.cancel()
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        headers=SSE_HEADERS,
+    )
+
+@app.post("/api/tools/flashcards/stream")
+async def stream_flashcards(
+    request: FlashcardsRequest,
+    accept: Optional[str] = Header(None),
+    x_cache_bypass: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
+):
+    """Like /api/tools/flashcards, but each card is sent as a `card` event as soon as it is generated"""
+    shed_if_overloaded("flashcards")
+    await load_request_document(request.doc_id)  # 404 before the stream starts
+    bypass = cache_bypassed(x_cache_bypass, cache_control)
+    queued = await queue_if_overloaded(
+        "flashcards", request, lambda on_progress: build_flashcards(request, bypass, on_progress=on_progress)
+    )
+    if queued is not None:
+        return queued
+    return item_stream_response("card", lambda on_item: build_flashcards(request, bypass, on_item=on_item), accept)
+
+@app.post("/api/tools/quiz/stream")
+async def stream_quiz(
+    request: QuizRequest,
+    accept: Optional[str] = Header(None),
+    x_cache_bypass: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
+):
+    """Like /api/tools/quiz, but each question is sent as a `question` event as soon as it is generated"""
+    shed_if_overloaded("quiz")
+    await load_request_document(request.doc_id)
+    bypass = cache_bypassed(x_cache_bypass, cache_control)
+    queued = await queue_if_overloaded(
+        "quiz", request, lambda on_progress: build_quiz(request, bypass, on_progress=on_progress)
+    )
+    if queued is not None:
+        return queued
+    return item_stream_response("question", lambda on_item: build_quiz(request, bypass, on_item=on_item), accept)
+
 @app.post("/api/tools/scan-problem", response_model=ScanProblemResponse)
-async def scan_problem(request: ScanProblemRequest):
+async def scan_problem(
+    request: ScanProblemRequest,
+    x_cache_bypass: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
+):
+    shed_if_overloaded("scan_problem")
     try:
         system_prompt = """You are a study coach who analyses academic problems.
 Given a problem description, respond in JSON with:
@@ -554,29 +3963,39 @@ Given a problem description, respond in JSON with:
   "recommended_steps": ["actionable steps"]
 }
 Focus on clarity and scaffolding the learner's next move."""
+        document = await load_request_document(request.doc_id)
+        # A whole upload can be megabytes; analyse what fits in one prompt, as the other tools do per call
+        problem = document_excerpt(document) if document else request.prompt.strip()
+
+        model_params = {"temperature": 0.4, "max_tokens": 700}
+        cache_key = result_cache.make_key("scan_problem", {
+            **({"document": document.doc_id} if document else {"prompt": normalize_cache_text(request.prompt)}),
+            "system_prompt": system_prompt,
+            **model_params,
+        })
+        bypass = cache_bypassed(x_cache_bypass, cache_control)
+        if bypass:
+            result_cache.stats["bypasses"] += 1
+        else:
+            cached = await result_cache.get(cache_key)
+            if cached is not None:
+                return payload_response(ScanProblemResponse(**cached), headers={"X-Cache": "HIT"})
 
         messages = [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": request.prompt.strip()},
+            {"role": "user", "content": problem},
         ]
 
-        chat_completion = client.chat.completions.create(
+        chat_completion = await create_completion(
+            "scan_problem",
             messages=messages,
-            model="llama-3.3-70b-versatile",
-            temperature=0.4,
-            max_tokens=700,
+            **JSON_MODE_PARAMS,
+            **model_params,
         )
 
-        raw_content = chat_completion.choices[0].message.content.strip()
-        try:
-            parsed = json.loads(raw_content)
-        except json.JSONDecodeError:
-            start = raw_content.find("{")
-            end = raw_content.rfind("}") + 1
-            if start >= 0 and end > start:
-                parsed = json.loads(raw_content[start:end])
-            else:
-                raise
+        raw_content = (chat_completion.choices[0].message.content or "").strip()
+        with timed_phase("parse"):
+            parsed = parse_structured_output("scan_problem", raw_content)
 
         summary = parsed.get("summary", "").strip()
         key_points = parsed.get("key_points", [])
@@ -588,27 +4007,552 @@ Focus on clarity and scaffolding the learner's next move."""
             "recommended_steps": recommended_steps,
         }
 
-        return ScanProblemResponse(analysis=analysis)
+        result = ScanProblemResponse(analysis=analysis)
+        await result_cache.set(cache_key, result.model_dump())
+        return payload_response(result, headers={"X-Cache": "BYPASS" if bypass else "MISS"})
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/tools/sentiment", response_model=SentimentResponse)
-async def sentiment_analysis(request: SentimentRequest):
-    text = (request.text or "").strip()
-    print(f"\n{'='*60}")
-    print(f"[SENTIMENT API] Received request")
-    print(f"[SENTIMENT API] Input text: {text[:100]}...")
-    print(f"[SENTIMENT API] Text length: {len(text)}")
+def document_excerpt(document: StoredDocument, limit: int = DOCUMENT_CHUNK_THRESHOLD_CHARS) -> str:
+    """The document's leading chunks, up to `limit` characters: what fits in one prompt"""
+    parts, size = [], 0
+    for chunk in document.chunks:
+        if parts and size + len(chunk) + 2 > limit:
+            break
+        parts.append(chunk[:limit - size])
+        size += len(parts[-1]) + 2
+    return "\n\n".join(parts)
+
+# Background jobs: long generations run in a bounded pool and are collected by polling or SSE
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # Jobs running at once, per worker process
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "100"))
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", "3600"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.5"))
+# SQLite file shared by all workers on the host; set to an empty string to keep jobs in the submitting worker only
+JOB_STORE_DB = os.getenv("JOB_STORE_DB", os.path.join(tempfile.gettempdir(), "kindminds_jobs.db"))
+JOB_TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+class JobStore:
+    """Job records, kept in memory for the worker running them and in SQLite for the others.
+
+    Finished jobs are kept for the TTL so a client that dropped its connection can come
+    back (to any worker) and collect the result. A cancel request for a job running in
+    another worker is recorded as a flag that the running worker polls for.
+    """
+
+    def __init__(self, ttl: float, db_path: Optional[str] = None):
+        self.ttl = ttl
+        self._jobs = {}  # job_id -> record, for jobs submitted to this worker
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, record TEXT NOT NULL, "
+                "cancel_requested INTEGER NOT NULL DEFAULT 0, expires_at REAL)"
+            )
+            self._db.commit()
+
+    def _expires_at(self, record: dict) -> Optional[float]:
+        return record["updated_at"] + self.ttl if record["status"] in JOB_TERMINAL_STATUSES else None
+
+    def _db_save(self, record: dict):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT INTO jobs (job_id, record, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET record = excluded.record, expires_at = excluded.expires_at",
+                (record["job_id"], json.dumps(record), self._expires_at(record)),
+            )
+            self._db.execute("DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+            self._db.commit()
+
+    def _db_get(self, job_id: str):
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT record, cancel_requested FROM jobs WHERE job_id = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (job_id, time.time()),
+            ).fetchone()
+
+    def _db_request_cancel(self, job_id: str):
+        with self._db_lock:
+            self._db.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,))
+            self._db.commit()
+
+    async def save(self, record: dict):
+        record["updated_at"] = time.time()
+        self._jobs[record["job_id"]] = record
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if (self._expires_at(job) or float("inf")) <= now]:
+            del self._jobs[job_id]
+        if self._db is not None:
+            await asyncio.to_thread(self._db_save, dict(record))
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        record = self._jobs.get(job_id)
+        if record is not None:
+            expires_at = self._expires_at(record)
+            return dict(record) if expires_at is None or expires_at > time.time() else None
+        if self._db is not None:
+            row = await asyncio.to_thread(self._db_get, job_id)
+            if row:
+                return json.loads(row[0])
+        return None
+
+    def holds(self, job_id: str) -> bool:
+        """Whether the job was submitted to this worker"""
+        return job_id in self._jobs
+
+    async def request_cancel(self, job_id: str):
+        if self._db is not None:
+            await asyncio.to_thread(self._db_request_cancel, job_id)
+
+    async def cancel_requested(self, job_id: str) -> bool:
+        if self._db is None:
+            return False
+        row = await asyncio.to_thread(self._db_get, job_id)
+        return bool(row and row[1])
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+class JobRunner:
+    """Bounded pool of background tasks that run queued jobs, apart from request handling.
+
+    Jobs keep running if the submitting client disconnects. Cancelling a job cancels its
+    task, which cancels the in-flight upstream calls it is waiting on.
+    """
+
+    def __init__(self, store: JobStore, workers: int, queue_max: int, poll_interval: float):
+        self.store = store
+        self.workers = workers
+        self.queue_max = queue_max
+        self.poll_interval = poll_interval
+        self._queue = None
+        self._workers = []
+        self._running = {}  # job_id -> (Task, Event set once the job's outcome is saved)
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_max)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, kind: str, run) -> dict:
+        """Queue `run(on_progress)`, a coroutine function returning a pydantic model"""
+        if self._queue is None or self._queue.full():
+            raise HTTPException(status_code=503, detail="Too many jobs are queued. Please try again shortly.",
+                                headers={"Retry-After": "10"})
+        now = time.time()
+        record = {"job_id": uuid.uuid4().hex, "kind": kind, "status": "queued", "progress": 0.0,
+                  "result": None, "error": None, "created_at": now, "updated_at": now}
+        await self.store.save(record)
+        self._queue.put_nowait((record["job_id"], run))
+        return record
+
+    async def cancel(self, job_id: str) -> Optional[dict]:
+        record = await self.store.get(job_id)
+        if record is None or record["status"] in JOB_TERMINAL_STATUSES:
+            return record
+        running = self._running.get(job_id)
+        if running is not None:
+            task, settled = running
+            task.cancel()
+            try:
+                # Return the record once the pool has saved the outcome, not just when the task ends
+                await asyncio.wait_for(settled.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            return await self.store.get(job_id)
+        if self.store.holds(job_id):
+            # Still queued here; the pool skips it when it comes up
+            record["status"] = "cancelled"
+            await self.store.save(record)
+        else:
+            await self.store.request_cancel(job_id)
+        return record
+
+    async def _work(self):
+        while True:
+            job_id, run = await self._queue.get()
+            try:
+                await self._run(job_id, run)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str, run):
+        record = await self.store.get(job_id)
+        if record is None or record["status"] != "queued":
+            return
+        if await self.store.cancel_requested(job_id):
+            record["status"] = "cancelled"
+            await self.store.save(record)
+            return
+        record["status"] = "running"
+        await self.store.save(record)
+
+        async def on_progress(fraction: float):
+            record["progress"] = round(fraction, 3)
+            await self.store.save(record)
+
+        task = asyncio.create_task(run(on_progress))
+        settled = asyncio.Event()
+        self._running[job_id] = (task, settled)
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=self.poll_interval)
+                if not task.done() and await self.store.cancel_requested(job_id):
+                    task.cancel()
+            result = task.result()
+            record.update(status="succeeded", progress=1.0, result=result.model_dump())
+        except asyncio.CancelledError:
+            if not task.done() or asyncio.current_task().cancelling():
+                # The pool itself is shutting down (possibly just as the job ended)
+                task.cancel()
+                raise
+            record["status"] = "cancelled"
+        except HTTPException as e:
+            record.update(status="failed", error=str(e.detail))
+        except Exception as e:
+            jobs_log.warning("job failed", extra={"job_id": job_id, "kind": record["kind"],
+                                                  "error": f"{type(e).__name__}: {e}"})
+            record.update(status="failed", error=str(e))
+        finally:
+            self._running.pop(job_id, None)
+        jobs_log.debug("job finished", extra={"job_id": job_id, "kind": record["kind"], "status": record["status"]})
+        await self.store.save(record)
+        settled.set()
+
+job_store = JobStore(ttl=JOB_RESULT_TTL_SECONDS, db_path=JOB_STORE_DB or None)
+job_runner = JobRunner(job_store, workers=JOB_WORKERS, queue_max=JOB_QUEUE_MAX, poll_interval=JOB_POLL_SECONDS)
+
+async def _job_result(build):
+    result, _ = await build  # Drop the X-Cache status
+    return result
+
+async def load_job(job_id: str) -> dict:
+    record = await job_store.get(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    return record
+
+async def queue_if_overloaded(kind: str, request, build) -> Optional[FastJSONResponse]:
+    """At the queued-only overload level, run a generation as a background job and answer 202.
+
+    The body is the job record (as from /api/jobs/{kind}); clients follow the Location
+    header until the job succeeds. Returns None when the request should run inline.
+    """
+    if current_overload_level() < 3:
+        return None
+    await load_request_document(request.doc_id)
+    record = await job_runner.submit(kind, lambda on_progress: _job_result(build(on_progress)))
+    overload.stats["queued"] += 1
+    record_fallback("overload_queued")
+    return payload_response(
+        JobResponse(**record), status_code=202, headers={"Location": f"/api/jobs/{record['job_id']}"}
+    )
+
+@app.post("/api/jobs/flashcards", response_model=JobResponse, status_code=202)
+async def submit_flashcards_job(request: FlashcardsRequest):
+    """Queue a flashcard generation; poll GET /api/jobs/{job_id} or stream its events"""
+    shed_if_overloaded("flashcards")
+    await load_request_document(request.doc_id)  # Fail fast on an unknown doc_id
+    record = await job_runner.submit(
+        "flashcards", lambda on_progress: _job_result(build_flashcards(request, on_progress=on_progress))
+    )
+    return JobResponse(**record)
+
+@app.post("/api/jobs/quiz", response_model=JobResponse, status_code=202)
+async def submit_quiz_job(request: QuizRequest):
+    """Queue a quiz generation; poll GET /api/jobs/{job_id} or stream its events"""
+    shed_if_overloaded("quiz")
+    await load_request_document(request.doc_id)
+    record = await job_runner.submit(
+        "quiz", lambda on_progress: _job_result(build_quiz(request, on_progress=on_progress))
+    )
+    return JobResponse(**record)
+
+@app.get("/api/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str, accept_encoding: Optional[str] = Header(None)):
+    return payload_response(JobResponse(**await load_job(job_id)), accept_encoding)
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-Sent Events for a job: `status` on every change, then `done` with the final record"""
+    await load_job(job_id)
+
+    async def event_source():
+        last_update = None
+        while True:
+            record = await job_store.get(job_id)
+            if record is None:
+                yield sse_event("error", {"detail": "Job not found or expired."})
+                return
+            if record["status"] in JOB_TERMINAL_STATUSES:
+                yield sse_event("done", JobResponse(**record).model_dump())
+                return
+            if record["updated_at"] != last_update:
+                last_update = record["updated_at"]
+                yield sse_event("status", JobResponse(**record).model_dump())
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+    return StreamingResponse(event_source(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.delete("/api/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job, including its in-flight upstream calls"""
+    await load_job(job_id)
+    record = await job_runner.cancel(job_id)
+    return JobResponse(**(record or await load_job(job_id)))
+
+# Sentiment cascade: a local lexicon scorer answers clear-cut texts, only ambiguous ones go to the LLM
+SENTIMENT_CASCADE_ENABLED = os.getenv("SENTIMENT_CASCADE_ENABLED", "true").lower() in ("1", "true", "yes")
+SENTIMENT_LOCAL_MIN_CONFIDENCE = float(os.getenv("SENTIMENT_LOCAL_MIN_CONFIDENCE", "0.75"))
+SENTIMENT_LOCAL_MAX_WORDS = int(os.getenv("SENTIMENT_LOCAL_MAX_WORDS", "40"))
+
+# CRISIS-LEVEL indicators (highest priority - severe negative sentiment)
+CRISIS_PHRASES = {
+    "harm myself", "harm self",
+    "hurt myself", "hurt self",
+    "kill myself", "kill self",
+    "suicide", "suicidal",
+    "end it all", "end my life", "end everything",
+    "want to die",
+    "don't want to live", "dont want to live",
+    "better off dead",
+    "no point in living",
+    # Intent without the words above
+    "no reason to live", "nothing to live for", "not worth living",
+    "wish i was dead", "wish i were dead", "want to disappear", "disappear forever",
+    "life is meaningless", "my life is pointless",
+    "don't want to wake up", "dont want to wake up", "never wake up",
+    "take my own life", "end myself",
+    # Methods
+    "overdose", "overdosing", "take all my pills", "take all the pills", "swallow all the pills",
+    "cut myself", "cutting myself", "cut my wrists", "slit my wrists",
+    "hang myself", "hanging myself", "noose",
+    "jump off a bridge", "jump off the bridge", "jump off a building", "jump off the roof",
+    "jump in front of a train", "in front of a train",
+    "self harm", "selfharm",
+    # Slang
+    "kms", "kys", "unalive", "unalive myself", "sewerslide",
+}
+
+# HIGH-LEVEL negative indicators
+HIGH_NEGATIVE_WORDS = {
+    "hopeless", "desperate", "worthless", "useless", "pathetic", "failure",
+    "hate myself", "hate my life", "can't go on", "can't take it",
+    "breaking down", "falling apart", "losing it", "going crazy",
+    "terrified", "panic", "panic attack", "breakdown", "meltdown"
+}
+
+# MODERATE negative indicators
+MODERATE_NEGATIVE_WORDS = {
+    "stressed", "anxious", "overwhelmed", "sad", "depressed", "down",
+    "angry", "frustrated", "annoyed", "irritated", "upset", "worried",
+    "tired", "exhausted", "drained", "burned out", "lonely", "isolated",
+    "scared", "afraid", "nervous", "uneasy", "uncomfortable", "unhappy",
+    "disappointed", "let down", "hurt", "pain", "suffering", "struggling",
+    "difficult", "hard", "tough", "challenging", "problem", "issue"
+}
+
+# MILD negative indicators
+MILD_NEGATIVE_WORDS = {
+    "concerned", "uncertain", "confused", "unsure", "hesitant", "reluctant"
+}
+
+# Positive indicators
+POSITIVE_WORDS = {
+    "grateful", "thankful", "happy", "joyful", "excited", "enthusiastic",
+    "calm", "peaceful", "relaxed", "content", "satisfied", "pleased",
+    "confident", "proud", "accomplished", "successful", "optimistic",
+    "hopeful", "hopeful", "motivated", "energetic", "refreshed", "renewed",
+    "better", "improving", "progress", "breakthrough", "relief"
+}
+
+# Words that can flip the meaning of a lexicon hit ("not happy"), so the text is left to the LLM
+NEGATION_WORDS = {
+    "not", "no", "never", "nothing", "nobody", "nowhere", "without", "hardly", "barely", "cannot",
+    "don't", "can't", "won't", "isn't", "aren't", "wasn't", "weren't", "doesn't", "didn't",
+    "couldn't", "shouldn't", "wouldn't", "haven't", "hasn't", "hadn't", "ain't",
+    "dont", "cant", "wont", "isnt", "doesnt", "didnt"
+}
+
+# Emotional cues the lexicon does not grade; their presence makes a "neutral" verdict unsafe
+UNSCORED_EMOTION_WORDS = {
+    "feel", "feeling", "felt", "pointless", "empty", "numb", "alone", "cry", "crying", "cried",
+    "lost", "miss", "anymore", "worse", "awful", "terrible", "horrible", "scary", "fear", "afraid",
+    "ugh", "sick", "bad", "stuck", "hate", "give up"
+}
+
+class LexiconMatcher:
+    """Word-boundary phrase matcher for a fixed, categorized lexicon.
+
+    The text is tokenized once (str.translate + split, both in C) and single-word
+    entries are found with set intersections; multi-word entries are only confirmed
+    against the joined token stream when all of their words occur. This keeps the
+    per-message cost to one linear pass regardless of lexicon size, and words no
+    longer match inside other words ("hard" in "hardware"). Overlapping phrases
+    ("panic" and "panic attack") are each counted once, as before.
+    """
+
+    # Everything except letters, digits and apostrophes separates tokens
+    _TRANSLATION = {i: " " for i in range(128) if not (chr(i).isalnum() or chr(i) == "'")}
+    _TRANSLATION.update({ord(c): " " for c in "—–…“”‘"})
+    _TRANSLATION[ord("’")] = "'"
+
+    def __init__(self, lexicon: dict):
+        self.categories = list(lexicon)
+        self._unigrams = {}
+        self._phrases = []  # (padded phrase, word set, category)
+        for category, entries in lexicon.items():
+            words = set()
+            for entry in entries:
+                tokens = self.tokenize(entry.lower())
+                if len(tokens) == 1:
+                    words.add(tokens[0])
+                else:
+                    self._phrases.append((f" {' '.join(tokens)} ", frozenset(tokens), category))
+            self._unigrams[category] = frozenset(words)
+
+    @classmethod
+    def tokenize(cls, lower_text: str) -> List[str]:
+        return lower_text.translate(cls._TRANSLATION).split()
+
+    def count_tokens(self, tokens: List[str]) -> dict:
+        """Number of distinct lexicon entries found per category in a token list"""
+        token_set = set(tokens)
+        counts = {category: len(words & token_set) for category, words in self._unigrams.items()}
+        joined = None
+        for padded, words, category in self._phrases:
+            if words <= token_set:
+                if joined is None:
+                    joined = f" {' '.join(tokens)} "
+                if padded in joined:
+                    counts[category] += 1
+        return counts
+
+    def count(self, lower_text: str) -> dict:
+        return self.count_tokens(self.tokenize(lower_text))
+
+SENTIMENT_LEXICON = LexiconMatcher({
+    "crisis": CRISIS_PHRASES,
+    "high_negative": HIGH_NEGATIVE_WORDS,
+    "moderate_negative": MODERATE_NEGATIVE_WORDS,
+    "mild_negative": MILD_NEGATIVE_WORDS,
+    "positive": POSITIVE_WORDS,
+    "negation": NEGATION_WORDS,
+    "unscored_emotion": UNSCORED_EMOTION_WORDS,
+})
+
+def score_sentiment_locally(text: str) -> dict:
+    """Lexicon sentiment heuristic.
+
+    Returns the label and normalized score along with a confidence in [0, 1] saying
+    how safe it is to answer without the LLM. Only short, negation-free texts with
+    positive lexicon evidence and no negative cue earn a high confidence. Texts without
+    any lexicon hit are not "clearly neutral": the lexicon cannot see distress it has no
+    words for, so they are left to the LLM along with everything negative.
+    """
+    lower_text = text.lower()
+    tokens = SENTIMENT_LEXICON.tokenize(lower_text)
+
+    # Count word matches for every category in one pass over the text
+    hits = SENTIMENT_LEXICON.count_tokens(tokens)
+
+    # Check for crisis phrases first (highest severity); any "suicid..." word also counts
+    if hits["crisis"] or "suicid" in lower_text:
+        return {"sentiment": "negative", "score": -0.95, "confidence": 1.0, "crisis": True, "hits": hits}
+
+    high_neg_hits = hits["high_negative"]
+    moderate_neg_hits = hits["moderate_negative"]
+    mild_neg_hits = hits["mild_negative"]
+    pos_hits = hits["positive"]
+
+    # Calculate weighted score
+    # High negative: -3 each, Moderate: -1 each, Mild: -0.3 each, Positive: +1 each
+    score = (pos_hits * 1.0) - (high_neg_hits * 3.0) - (moderate_neg_hits * 1.0) - (mild_neg_hits * 0.3)
+
+    # Determine sentiment
+    if score < -1.5:
+        sentiment = "negative"
+        # Normalize to -1 to 0 range for very negative
+        normalized = max(min(score / 5.0, 0), -1.0)
+    elif score < -0.3:
+        sentiment = "negative"
+        # Normalize to -0.3 to -1 range for moderately negative
+        normalized = max(min(score / 3.0, -0.3), -1.0)
+    elif score > 0.3:
+        sentiment = "positive"
+        # Normalize to 0.3 to 1 range for positive
+        normalized = min(max(score / 3.0, 0.3), 1.0)
+    else:
+        sentiment = "neutral"
+        normalized = 0.0
+
+    # Confidence: high for short, negation-free texts with no negative cues, decaying with length
+    negative_hits = high_neg_hits + moderate_neg_hits + mild_neg_hits
+    word_count = len(tokens)
+    if pos_hits == 0 or negative_hits or hits["negation"]:
+        confidence = 0.0
+    elif pos_hits <= hits["unscored_emotion"]:
+        confidence = 0.0  # Ungraded cues ("empty", "numb", "alone") are not clearly outweighed
+    elif word_count > SENTIMENT_LOCAL_MAX_WORDS:
+        confidence = 0.0
+    else:
+        length_penalty = 0.3 * word_count / SENTIMENT_LOCAL_MAX_WORDS
+        confidence = max(min(0.7 + 0.15 * pos_hits, 0.95) - length_penalty, 0.0)
+
+    return {"sentiment": sentiment, "score": float(normalized), "confidence": round(confidence, 3),
+            "crisis": False, "hits": hits}
+
+def local_sentiment_verdict(text: str):
+    """Tier 1 of the sentiment cascade.
+
+    Returns (response, local) where response is set when the local scorer can answer on
+    its own (empty text, crisis phrase or a clear-cut short text) and `local` is the
+    heuristic result the LLM tier falls back to.
+    """
+    sentiment_log.debug("sentiment request", extra={"text": text, "length": len(text)})
     
     if not text:
-        print(f"[SENTIMENT API] Empty text, returning neutral")
-        return SentimentResponse(sentiment="neutral", score=0.0)
+        sentiment_log.debug("empty text, returning neutral")
+        return SentimentResponse(sentiment="neutral", score=0.0, tier="local", confidence=1.0), None
+
+    # Tier 1: local scorer. Crisis patterns short-circuit, clear-cut texts are answered here.
+    local = score_sentiment_locally(text)
+    if local["crisis"]:
+        sentiment_log.debug("crisis phrase matched", extra={"sentiment": "negative", "score": -0.95})
+        return SentimentResponse(sentiment="negative", score=-0.95, tier="crisis", confidence=1.0), local
+    if SENTIMENT_CASCADE_ENABLED and local["confidence"] >= SENTIMENT_LOCAL_MIN_CONFIDENCE:
+        sentiment_log.debug("local result is clear-cut, skipping Groq", extra={
+            "confidence": local["confidence"], "sentiment": local["sentiment"], "score": local["score"],
+        })
+        return SentimentResponse(sentiment=local["sentiment"], score=local["score"],
+                                 tier="local", confidence=local["confidence"]), local
+
+    return None, local
+
+async def llm_sentiment(text: str, local: dict) -> SentimentResponse:
+    """Tiers 2 and 3 of the sentiment cascade: Groq, falling back to the local heuristic"""
+    if current_overload_level() >= 2:
+        # Overloaded: keep sentiment checks off the upstream entirely
+        record_fallback("overload_local_sentiment")
+        return SentimentResponse(sentiment=local["sentiment"], score=local["score"],
+                                 tier="local", confidence=local["confidence"])
 
-    # Use Groq API for sentiment analysis (already have it set up for chat)
+    # Tier 2: Groq API for ambiguous texts
     try:
-        print(f"[SENTIMENT API] Using Groq API for sentiment analysis...")
+        sentiment_log.debug("ambiguous text, using Groq", extra={"confidence": local["confidence"]})
         
         system_prompt = """You are a sentiment analysis expert. Analyze the sentiment of the given text and respond with ONLY a JSON object in this exact format:
 {
@@ -633,155 +4577,286 @@ Be accurate and consider the emotional intensity. Crisis situations should get s
             {"role": "user", "content": f"Analyze the sentiment of this text: {text}"}
         ]
         
-        chat_completion = client.chat.completions.create(
+        chat_completion = await create_completion(
+            "sentiment",
             messages=messages,
-            model="llama-3.3-70b-versatile",
             temperature=0.1,  # Low temperature for consistent sentiment analysis
             max_tokens=150,
             response_format={"type": "json_object"}  # Force JSON response
         )
         
         response_content = chat_completion.choices[0].message.content.strip()
-        print(f"[SENTIMENT API] Groq raw response: {response_content}")
+        sentiment_log.debug("Groq raw response", extra={"raw": response_content})
         
         # Parse JSON response
         try:
-            parsed = json.loads(response_content)
+            with timed_phase("parse"):
+                parsed = json.loads(response_content)
             sentiment_label = str(parsed.get("sentiment", "neutral")).lower()
             score = float(parsed.get("score", 0.0))
             
             # Validate sentiment
             if sentiment_label not in ["positive", "negative", "neutral"]:
-                print(f"[SENTIMENT API] Invalid sentiment label '{sentiment_label}', defaulting to neutral")
+                sentiment_log.debug("invalid sentiment label, defaulting to neutral", extra={"label": sentiment_label})
                 sentiment_label = "neutral"
                 score = 0.0
             
             # Clamp score to valid range
             score = max(-1.0, min(1.0, score))
             
-            print(f"[SENTIMENT API] Groq result: sentiment={sentiment_label}, score={score}")
-            print(f"[SENTIMENT API] Returning: sentiment={sentiment_label}, score={score}")
-            print(f"{'='*60}\n")
-            return SentimentResponse(sentiment=sentiment_label, score=score)
+            sentiment_log.debug("Groq result", extra={"sentiment": sentiment_label, "score": score})
+            return SentimentResponse(sentiment=sentiment_label, score=score, tier="llm")
             
         except json.JSONDecodeError as e:
-            print(f"[SENTIMENT API] Failed to parse JSON from Groq response: {e}")
-            print(f"[SENTIMENT API] Response content: {response_content}")
-            print(f"[SENTIMENT API] Falling back to heuristic...")
+            sentiment_log.warning("unparseable Groq response, falling back to heuristic",
+                                  extra={"error": str(e), "raw": response_content})
         except (KeyError, ValueError, TypeError) as e:
-            print(f"[SENTIMENT API] Error extracting sentiment data: {e}")
-            print(f"[SENTIMENT API] Falling back to heuristic...")
+            sentiment_log.warning("bad sentiment data from Groq, falling back to heuristic", extra={"error": str(e)})
             
     except Exception as exc:
-        print(f"[SENTIMENT API] Groq API error: {type(exc).__name__}: {exc}")
-        print(f"[SENTIMENT API] Error traceback:")
-        import traceback
-        traceback.print_exc()
-        print(f"[SENTIMENT API] Falling back to heuristic...")
-
-    # Enhanced fallback heuristic with crisis detection
-    print(f"[SENTIMENT API] Using fallback heuristic (HuggingFace not available or failed)")
-    lower_text = text.lower()
-    print(f"[SENTIMENT API] Lowercase text: {lower_text[:100]}...")
-    
-    # CRISIS-LEVEL indicators (highest priority - severe negative sentiment)
-    crisis_patterns = [
-        r"harm\s+(myself|self)",
-        r"hurt\s+(myself|self)",
-        r"kill\s+(myself|self)",
-        r"suicide|suicidal",
-        r"end\s+(it\s+all|my\s+life|everything)",
-        r"want\s+to\s+die",
-        r"don'?t\s+want\s+to\s+live",
-        r"better\s+off\s+dead",
-        r"no\s+point\s+in\s+living",
+        sentiment_log.warning("Groq API error, falling back to heuristic",
+                              extra={"error": f"{type(exc).__name__}: {exc}"},
+                              exc_info=sentiment_log.isEnabledFor(logging.DEBUG))
+
+    # Tier 3: Groq failed, fall back to the local heuristic
+    record_fallback("sentiment_heuristic")
+    sentiment_log.debug("using fallback heuristic", extra={
+        "hits": local["hits"], "sentiment": local["sentiment"], "score": local["score"],
+    })
+    return SentimentResponse(sentiment=local["sentiment"], score=local["score"],
+                             tier="fallback", confidence=local["confidence"])
+
+@app.post("/api/tools/sentiment", response_model=SentimentResponse)
+async def sentiment_analysis(request: SentimentRequest):
+    text = (request.text or "").strip()
+    verdict, local = local_sentiment_verdict(text)
+    if verdict is not None:
+        return verdict
+    return await llm_sentiment(text, local)
+
+def suggest_activity(score: float) -> Optional[str]:
+    """Activity for a sentiment score (same thresholds as the chat dock on the frontend)"""
+    if score <= -0.8:
+        # Crisis level: 54321 grounding method for panic attacks
+        return "54321"
+    if score < -0.2:
+        # High/moderate negative: breathing exercises
+        return "breathing"
+    return None
+
+def sentiment_context_for(result: SentimentResponse) -> Optional[SentimentContext]:
+    """The SentimentContext the chat prompt should carry, if any.
+
+    Crisis-level turns are handled by the frontend's grounding redirect and never add the
+    suggestion to the prompt, so only moderate/high negative scores change the chat call.
+    """
+    activity = suggest_activity(result.score)
+    if activity and result.score > -0.8:
+        return SentimentContext(sentiment=result.sentiment, score=result.score, suggested_activity=activity)
+    return None
+
+def discard_task(task: asyncio.Task):
+    """Cancel a task whose result is no longer needed, retrieving its exception if it already failed"""
+    task.cancel()
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+def chat_turn_error(status_code: int, detail, sentiment: SentimentResponse, headers: Optional[dict] = None):
+    """A failed turn's error response, still carrying the sentiment so the client can act on a crisis"""
+    return FastJSONResponse(
+        {"detail": detail, "sentiment": sentiment.model_dump(), "suggested_activity": suggest_activity(sentiment.score)},
+        status_code=status_code,
+        headers=headers,
+    )
+
+@app.post("/api/chat/turn", response_model=ChatTurnResponse)
+async def chat_turn(
+    request: ChatRequest,
+    response: Response,
+    x_cache_bypass: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
+):
+    """Score the latest user message and answer it in one round trip.
+
+    Replaces the frontend's serial /api/tools/sentiment then /api/chat calls. When the
+    local scorer settles the sentiment, one chat call is made with the right prompt.
+    Otherwise the LLM sentiment call and a speculative chat call (without the activity
+    suggestion) run concurrently, and the chat is restarted with the suggestion only if
+    the score turns out to need it. Both chat calls go through the semantic cache.
+    Crisis-level turns keep the generated reply; the frontend redirects to grounding on
+    `suggested_activity`. If the chat call fails, the error body still holds the
+    sentiment, so that redirect does not depend on the reply. Any client-supplied
+    `sentiment` is ignored.
+    """
+    latest_user = next((msg.content for msg in reversed(request.messages) if msg.role == "user"), "")
+    text = latest_user.strip()
+    base_request = request.model_copy(update={"sentiment": None})
+    bypass = cache_bypassed(x_cache_bypass, cache_control)
+
+    try:
+        sentiment, local = local_sentiment_verdict(text)
+        speculative = None
+        if sentiment is None:
+            sentiment_task = asyncio.create_task(llm_sentiment(text, local))
+            speculative = asyncio.create_task(cached_chat_reply(base_request, bypass))
+            try:
+                sentiment = await sentiment_task
+            except BaseException:
+                discard_task(speculative)
+                raise
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    context = sentiment_context_for(sentiment)
+    try:
+        if speculative is not None and context is None:
+            reply, cache_status = await speculative
+        else:
+            if speculative is not None:
+                discard_task(speculative)
+            reply, cache_status = await cached_chat_reply(request.model_copy(update={"sentiment": context}), bypass)
+    except HTTPException as e:
+        return chat_turn_error(e.status_code, e.detail, sentiment, e.headers)
+    except Exception as e:
+        return chat_turn_error(500, str(e), sentiment)
+
+    if cache_status:
+        response.headers["X-Cache"] = cache_status
+    return ChatTurnResponse(
+        response=reply.response,
+        prompt_tokens=reply.prompt_tokens,
+        sentiment=sentiment,
+        suggested_activity=suggest_activity(sentiment.score),
+    )
+
+# Batch scoring for offline re-analysis (chat histories, mood journals)
+SENTIMENT_BATCH_MAX_TEXTS = int(os.getenv("SENTIMENT_BATCH_MAX_TEXTS", "1000"))
+SENTIMENT_BATCH_PACK_SIZE = int(os.getenv("SENTIMENT_BATCH_PACK_SIZE", "20"))  # Texts per LLM prompt
+SENTIMENT_BATCH_PACK_CHARS = int(os.getenv("SENTIMENT_BATCH_PACK_CHARS", "8000"))  # Text budget per LLM prompt
+SENTIMENT_BATCH_ITEM_CHARS = int(os.getenv("SENTIMENT_BATCH_ITEM_CHARS", "2000"))  # Longer texts are truncated in the prompt
+SENTIMENT_BATCH_CONCURRENCY = int(os.getenv("SENTIMENT_BATCH_CONCURRENCY", "4"))
+
+# Shared by every batch request in this worker so bulk jobs cannot crowd out interactive traffic
+sentiment_batch_semaphore = asyncio.Semaphore(SENTIMENT_BATCH_CONCURRENCY)
+
+SENTIMENT_BATCH_SYSTEM_PROMPT = """You are a sentiment analysis expert. You will receive several numbered texts. Analyze each one independently and respond with ONLY a JSON object in this exact format:
+{
+  "results": [
+    {"id": <text number>, "sentiment": "positive" | "negative" | "neutral", "score": <float between -1.0 and 1.0>}
+  ]
+}
+
+Return exactly one result per text, using the same id.
+
+Where:
+- sentiment: "positive" if the text expresses positive emotions, "negative" if it expresses negative emotions (including distress, sadness, anxiety, crisis thoughts), or "neutral" if it's neither strongly positive nor negative.
+- score: A float between -1.0 and 1.0 where:
+  - -1.0 to -0.8: Crisis-level negative (suicidal thoughts, self-harm, severe distress)
+  - -0.8 to -0.4: High negative (hopeless, desperate, panicked)
+  - -0.4 to -0.2: Moderate negative (stressed, anxious, sad)
+  - -0.2 to 0.2: Neutral
+  - 0.2 to 0.4: Moderate positive
+  - 0.4 to 1.0: High positive
+
+Be accurate and consider the emotional intensity. Crisis situations should get scores <= -0.8."""
+
+def pack_sentiment_texts(items: List[tuple]) -> List[List[tuple]]:
+    """Group (index, text) pairs into prompts bounded by item count and total characters"""
+    packs, current, current_chars = [], [], 0
+    for index, text in items:
+        size = min(len(text), SENTIMENT_BATCH_ITEM_CHARS)
+        if current and (len(current) >= SENTIMENT_BATCH_PACK_SIZE or current_chars + size > SENTIMENT_BATCH_PACK_CHARS):
+            packs.append(current)
+            current, current_chars = [], 0
+        current.append((index, text))
+        current_chars += size
+    if current:
+        packs.append(current)
+    return packs
+
+async def score_sentiment_pack(pack: List[tuple]) -> dict:
+    """Score several ambiguous texts with one JSON-mode LLM call; returns {index: SentimentResponse}"""
+    numbered = "\n\n".join(
+        f"Text {number}:\n{text[:SENTIMENT_BATCH_ITEM_CHARS]}" for number, (_, text) in enumerate(pack)
+    )
+    messages = [
+        {"role": "system", "content": SENTIMENT_BATCH_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Analyze the sentiment of these {len(pack)} texts:\n\n{numbered}"},
     ]
-    
-    # HIGH-LEVEL negative indicators
-    high_negative_words = {
-        "hopeless", "desperate", "worthless", "useless", "pathetic", "failure",
-        "hate myself", "hate my life", "can't go on", "can't take it",
-        "breaking down", "falling apart", "losing it", "going crazy",
-        "terrified", "panic", "panic attack", "breakdown", "meltdown"
-    }
-    
-    # MODERATE negative indicators
-    moderate_negative_words = {
-        "stressed", "anxious", "overwhelmed", "sad", "depressed", "down",
-        "angry", "frustrated", "annoyed", "irritated", "upset", "worried",
-        "tired", "exhausted", "drained", "burned out", "lonely", "isolated",
-        "scared", "afraid", "nervous", "uneasy", "uncomfortable", "unhappy",
-        "disappointed", "let down", "hurt", "pain", "suffering", "struggling",
-        "difficult", "hard", "tough", "challenging", "problem", "issue"
-    }
-    
-    # MILD negative indicators
-    mild_negative_words = {
-        "concerned", "uncertain", "confused", "unsure", "hesitant", "reluctant"
-    }
-    
-    # Positive indicators
-    positive_words = {
-        "grateful", "thankful", "happy", "joyful", "excited", "enthusiastic",
-        "calm", "peaceful", "relaxed", "content", "satisfied", "pleased",
-        "confident", "proud", "accomplished", "successful", "optimistic",
-        "hopeful", "hopeful", "motivated", "energetic", "refreshed", "renewed",
-        "better", "improving", "progress", "breakthrough", "relief"
-    }
-    
-    # Check for crisis patterns first (highest severity)
-    print(f"[SENTIMENT API] Checking crisis patterns...")
-    crisis_detected = any(re.search(pattern, lower_text) for pattern in crisis_patterns)
-    if crisis_detected:
-        print(f"[SENTIMENT API] CRISIS DETECTED! Pattern matched in text")
-        print(f"[SENTIMENT API] Returning: sentiment=negative, score=-0.95")
-        return SentimentResponse(sentiment="negative", score=-0.95)
-    print(f"[SENTIMENT API] No crisis patterns detected")
-    
-    # Count word matches
-    print(f"[SENTIMENT API] Counting word matches...")
-    high_neg_hits = sum(1 for phrase in high_negative_words if phrase in lower_text)
-    moderate_neg_hits = sum(1 for word in moderate_negative_words if word in lower_text)
-    mild_neg_hits = sum(1 for word in mild_negative_words if word in lower_text)
-    pos_hits = sum(1 for word in positive_words if word in lower_text)
-    
-    print(f"[SENTIMENT API] Word match counts:")
-    print(f"  - High negative hits: {high_neg_hits}")
-    print(f"  - Moderate negative hits: {moderate_neg_hits}")
-    print(f"  - Mild negative hits: {mild_neg_hits}")
-    print(f"  - Positive hits: {pos_hits}")
-    
-    # Calculate weighted score
-    # High negative: -3 each, Moderate: -1 each, Mild: -0.3 each, Positive: +1 each
-    score = (pos_hits * 1.0) - (high_neg_hits * 3.0) - (moderate_neg_hits * 1.0) - (mild_neg_hits * 0.3)
-    print(f"[SENTIMENT API] Raw calculated score: {score}")
-    
-    # Determine sentiment
-    print(f"[SENTIMENT API] Determining sentiment from score...")
-    if score < -1.5:
-        sentiment = "negative"
-        # Normalize to -1 to 0 range for very negative
-        normalized = max(min(score / 5.0, 0), -1.0)
-        print(f"[SENTIMENT API] Very negative detected: score < -1.5")
-    elif score < -0.3:
-        sentiment = "negative"
-        # Normalize to -0.3 to -1 range for moderately negative
-        normalized = max(min(score / 3.0, -0.3), -1.0)
-        print(f"[SENTIMENT API] Moderately negative detected: -1.5 <= score < -0.3")
-    elif score > 0.3:
-        sentiment = "positive"
-        # Normalize to 0.3 to 1 range for positive
-        normalized = min(max(score / 3.0, 0.3), 1.0)
-        print(f"[SENTIMENT API] Positive detected: score > 0.3")
-    else:
-        sentiment = "neutral"
-        normalized = 0.0
-        print(f"[SENTIMENT API] Neutral detected: -0.3 <= score <= 0.3")
-    
-    print(f"[SENTIMENT API] Final result: sentiment={sentiment}, score={normalized}")
-    print(f"[SENTIMENT API] Returning response")
-    print(f"{'='*60}\n")
-    return SentimentResponse(sentiment=sentiment, score=float(normalized))
+
+    async with sentiment_batch_semaphore:
+        chat_completion = await create_completion(
+            "sentiment_batch",
+            messages=messages,
+            temperature=0.1,
+            max_tokens=40 * len(pack) + 50,
+            response_format={"type": "json_object"},
+        )
+
+    parsed = json.loads(chat_completion.choices[0].message.content.strip())
+    scored = {}
+    for result in parsed.get("results", []):
+        try:
+            number = int(result.get("id"))
+            sentiment_label = str(result.get("sentiment", "neutral")).lower()
+            score = max(-1.0, min(1.0, float(result.get("score", 0.0))))
+        except (AttributeError, ValueError, TypeError):
+            continue
+        if not 0 <= number < len(pack) or sentiment_label not in ["positive", "negative", "neutral"]:
+            continue
+        scored[pack[number][0]] = SentimentResponse(sentiment=sentiment_label, score=score, tier="llm")
+    return scored
+
+@app.post("/api/tools/sentiment/batch", response_model=SentimentBatchResponse)
+async def sentiment_analysis_batch(request: SentimentBatchRequest):
+    """Score many texts at once, in order.
+
+    Each text goes through the same cascade as /api/tools/sentiment. Ambiguous texts
+    are packed several to a prompt and the packs run under a per-worker concurrency
+    limit; anything the LLM does not score falls back to the local heuristic.
+    """
+    if len(request.texts) > SENTIMENT_BATCH_MAX_TEXTS:
+        raise HTTPException(status_code=413, detail=f"At most {SENTIMENT_BATCH_MAX_TEXTS} texts per batch.")
+
+    results: List[Optional[SentimentResponse]] = [None] * len(request.texts)
+    local_results = {}
+    ambiguous = []
+    for index, raw_text in enumerate(request.texts):
+        text = (raw_text or "").strip()
+        if not text:
+            results[index] = SentimentResponse(sentiment="neutral", score=0.0, tier="local", confidence=1.0)
+            continue
+        local = score_sentiment_locally(text)
+        if local["crisis"]:
+            results[index] = SentimentResponse(sentiment="negative", score=-0.95, tier="crisis", confidence=1.0)
+        elif SENTIMENT_CASCADE_ENABLED and local["confidence"] >= SENTIMENT_LOCAL_MIN_CONFIDENCE:
+            results[index] = SentimentResponse(sentiment=local["sentiment"], score=local["score"],
+                                               tier="local", confidence=local["confidence"])
+        else:
+            local_results[index] = local
+            ambiguous.append((index, text))
+
+    if current_overload_level() >= 2:
+        record_fallback("overload_local_sentiment")
+        ambiguous = []  # Overloaded: everything gets the local heuristic below
+    packs = pack_sentiment_texts(ambiguous)
+    outcomes = await asyncio.gather(*(score_sentiment_pack(pack) for pack in packs), return_exceptions=True)
+    for pack, outcome in zip(packs, outcomes):
+        if isinstance(outcome, Exception):
+            sentiment_log.warning("batch pack failed, using heuristic",
+                                  extra={"pack_size": len(pack), "error": f"{type(outcome).__name__}: {outcome}"})
+            continue
+        for index, result in outcome.items():
+            results[index] = result
+
+    # Anything the LLM skipped or failed on gets the local heuristic
+    for index, local in local_results.items():
+        if results[index] is None:
+            results[index] = SentimentResponse(sentiment=local["sentiment"], score=local["score"],
+                                               tier="fallback", confidence=local["confidence"])
+
+    return SentimentBatchResponse(results=results)
 
 if __name__ == "__main__":
     import uvicorn
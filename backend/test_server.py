@@ -1,5 +1,6 @@
+import os
 import sys
-sys.path.insert(0, '/Users/rahulbajaj/Desktop/kindminds_website/backend')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from main import app
 import uvicorn
@@ -0,0 +1,90 @@
+"""Shared fixtures: main imported with every store in memory and the Groq client replaced by a fake"""
+import asyncio
+import json
+import os
+import sys
+import types
+
+os.environ.setdefault("GROQ_API_KEY", "test")
+# Keep the tests off the shared SQLite files a running backend would use
+for name in ("SINGLE_FLIGHT_DB", "METRICS_DB", "JOB_STORE_DB", "RESULT_CACHE_DB", "SEMANTIC_CACHE_DB", "CHAT_SESSION_DB",
+             "DOCUMENT_STORE_DB"):
+    os.environ[name] = ""
+os.environ["SEMANTIC_CACHE_ENABLED"] = "false"
+os.environ["OVERLOAD_CONTROL_ENABLED"] = "false"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from groq.types.chat import ChatCompletion, ChatCompletionChunk  # noqa: E402
+
+import main  # noqa: E402
+
+class FakeUpstream:
+    """Stands in for client.chat.completions and records every call.
+
+    Sentiment prompts are answered with `sentiment` (a dict, or an exception to raise),
+    every other prompt with `reply` (a string or dict, an exception to raise, or a
+    callable taking the call's keyword arguments and returning one of those). Streamed
+    calls get the same content in small chunks.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.sentiment = {"sentiment": "neutral", "score": 0.0}
+        self.reply = "Here is a reply."
+        self.delay = 0.0
+
+    @staticmethod
+    def is_sentiment(call: dict) -> bool:
+        return "sentiment analysis expert" in call["messages"][0]["content"]
+
+    def chat_calls(self) -> list:
+        return [call for call in self.calls if not self.is_sentiment(call)]
+
+    def sentiment_calls(self) -> list:
+        return [call for call in self.calls if self.is_sentiment(call)]
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        await asyncio.sleep(self.delay)
+        answer = self.sentiment if self.is_sentiment(kwargs) else self.reply
+        if callable(answer) and not isinstance(answer, Exception):
+            answer = answer(kwargs)
+        if isinstance(answer, Exception):
+            raise answer
+        content = answer if isinstance(answer, str) else json.dumps(answer)
+        if kwargs.get("stream"):
+            return self._chunks(kwargs["model"], content)
+        return ChatCompletion.model_validate({
+            "id": "test", "object": "chat.completion", "created": 0, "model": kwargs["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        })
+
+    @staticmethod
+    async def _chunks(model: str, content: str, size: int = 16):
+        for start in range(0, len(content), size):
+            yield ChatCompletionChunk.model_validate({
+                "id": "test", "object": "chat.completion.chunk", "created": 0, "model": model,
+                "choices": [{"index": 0, "finish_reason": None, "delta": {"content": content[start:start + size]}}],
+                "x_groq": {"id": "test", "usage": None, "error": None},
+            })
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeUpstream()
+    fake_client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=fake))
+    monkeypatch.setattr(main, "client", fake_client)
+    # Failures injected by one test must not downgrade the model routes for the next
+    monkeypatch.setattr(main, "model_router", main.ModelRouter(
+        routes=main.MODEL_ROUTES,
+        min_samples=main.MODEL_DOWNGRADE_MIN_SAMPLES,
+        max_errors=main.MODEL_DOWNGRADE_ERRORS,
+        cooldown=main.MODEL_DOWNGRADE_COOLDOWN_SECONDS,
+    ))
+    return fake
+
+@pytest.fixture
+def api(upstream):
+    return TestClient(main.app)
@@ -0,0 +1,79 @@
+"""/api/chat/turn: one round trip for the sentiment verdict and the reply"""
+
+def turn(api, text: str):
+    return api.post("/api/chat/turn", json={"messages": [{"role": "user", "content": text}], "chat_type": "mindfulness"})
+
+def suggests_activity(call: dict) -> bool:
+    return any("SENTIMENT CONTEXT" in message["content"] for message in call["messages"])
+
+def test_local_crisis_needs_no_sentiment_call(api, upstream):
+    response = turn(api, "I want to kill myself")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["response"] == "Here is a reply."
+    assert body["sentiment"]["tier"] == "crisis"
+    assert body["suggested_activity"] == "54321"
+    assert upstream.sentiment_calls() == []
+    assert not suggests_activity(upstream.chat_calls()[0])
+
+def test_llm_scored_crisis_keeps_the_speculative_reply(api, upstream):
+    upstream.sentiment = {"sentiment": "negative", "score": -0.9}
+    response = turn(api, "everything keeps falling apart around me")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["sentiment"]["tier"] == "llm"
+    assert body["suggested_activity"] == "54321"
+    assert len(upstream.chat_calls()) == 1  # No restart: crisis turns never add the suggestion
+
+def test_crisis_verdict_survives_a_chat_failure(api, upstream):
+    upstream.reply = RuntimeError("upstream down")
+    response = turn(api, "I want to kill myself")
+    assert response.status_code == 500
+    body = response.json()
+    assert body["sentiment"]["tier"] == "crisis"
+    assert body["suggested_activity"] == "54321"
+
+def test_chat_failure_still_carries_the_sentiment(api, upstream):
+    upstream.sentiment = {"sentiment": "negative", "score": -0.5}
+    upstream.reply = RuntimeError("upstream down")
+    response = turn(api, "everything keeps falling apart around me")
+    assert response.status_code == 500
+    body = response.json()
+    assert body["detail"] == "upstream down"
+    assert body["sentiment"]["score"] == -0.5
+    assert body["suggested_activity"] == "breathing"
+
+def test_clear_cut_turn_makes_one_chat_call(api, upstream):
+    response = turn(api, "I'm so happy today!")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["response"] == "Here is a reply."
+    assert body["sentiment"]["tier"] == "local"
+    assert body["suggested_activity"] is None
+    assert upstream.sentiment_calls() == []
+    assert len(upstream.chat_calls()) == 1
+
+def test_negative_turn_restarts_chat_with_the_suggestion(api, upstream):
+    upstream.sentiment = {"sentiment": "negative", "score": -0.5}
+    response = turn(api, "everything keeps falling apart around me")
+    assert response.status_code == 200
+    assert response.json()["suggested_activity"] == "breathing"
+    chat_calls = upstream.chat_calls()
+    assert len(chat_calls) == 2  # The speculative call, then the one with the suggestion
+    assert not suggests_activity(chat_calls[0])
+    assert suggests_activity(chat_calls[1])
+
+def test_neutral_turn_keeps_the_speculative_reply(api, upstream):
+    response = turn(api, "everything keeps falling apart around me")
+    assert response.status_code == 200
+    assert response.json()["suggested_activity"] is None
+    assert len(upstream.chat_calls()) == 1
+
+def test_client_supplied_sentiment_is_ignored(api, upstream):
+    response = api.post("/api/chat/turn", json={
+        "messages": [{"role": "user", "content": "I'm so happy today!"}],
+        "chat_type": "mindfulness",
+        "sentiment": {"sentiment": "negative", "score": -0.5, "suggested_activity": "breathing"},
+    })
+    assert response.status_code == 200
+    assert not suggests_activity(upstream.chat_calls()[0])
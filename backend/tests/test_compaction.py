@@ -0,0 +1,40 @@
+"""History compaction: rolling summaries cached per conversation prefix and persona"""
+import asyncio
+import uuid
+
+import main
+
+def long_history(turns: int = 12) -> list:
+    topic = uuid.uuid4().hex  # Fresh prefix hashes, so earlier tests' summaries never match
+    return [{"role": "user" if index % 2 == 0 else "assistant", "content": f"{topic} message {index} " + "word " * 200}
+            for index in range(turns)]
+
+def summary_calls(upstream) -> list:
+    return [call for call in upstream.calls if "You summarize conversations" in call["messages"][0]["content"]]
+
+def compact(chat_type: str, mbti_type, history: list) -> list:
+    return asyncio.run(main.compact_history(chat_type, mbti_type, "system prompt", history))
+
+def test_short_history_is_untouched(upstream):
+    history = long_history(2)
+    assert compact("academic", None, history) == history
+    assert upstream.calls == []
+
+def test_summary_replaces_the_older_messages_and_is_cached(upstream, monkeypatch):
+    monkeypatch.setitem(main.CHAT_TOKEN_BUDGETS, "academic", 1500)
+    upstream.reply = "They talked about exams."
+    history = long_history()
+    compacted = compact("academic", None, history)
+    assert compacted[0]["role"] == "system"
+    assert "They talked about exams." in compacted[0]["content"]
+    assert compacted[-1] == history[-1]
+    assert compact("academic", None, history) == compacted
+    assert len(summary_calls(upstream)) == 1
+
+def test_summaries_are_not_shared_across_personas(upstream, monkeypatch):
+    monkeypatch.setitem(main.CHAT_TOKEN_BUDGETS, "academic", 1500)
+    history = long_history()
+    compact("academic", "INTJ", history)
+    compact("academic", "ENFP", history)
+    compact("academic", "INTJ", history)
+    assert len(summary_calls(upstream)) == 2
@@ -0,0 +1,70 @@
+"""Document ingestion: doc_id uploads, the store's limits and the tools reading from it"""
+import asyncio
+
+import main
+
+ANALYSIS = {"summary": "s", "key_points": ["k"], "recommended_steps": ["r"]}
+
+def upload(api, text: str, filename: str = "notes.txt"):
+    return api.post("/api/documents", files={"file": (filename, text.encode("utf-8"), "text/plain")})
+
+def test_upload_is_content_addressed(api):
+    first = upload(api, "Photosynthesis turns light into sugar.\r\n\r\n\r\nIt happens in chloroplasts.  ")
+    second = upload(api, "Photosynthesis turns light into sugar.\n\nIt happens in chloroplasts.")
+    assert first.status_code == 200
+    assert first.json()["doc_id"] == second.json()["doc_id"]
+    assert first.json()["chunks"] == 1
+
+def test_get_and_delete(api):
+    doc_id = upload(api, "Osmosis moves water across membranes.").json()["doc_id"]
+    assert api.get(f"/api/documents/{doc_id}").json()["filename"] == "notes.txt"
+    assert api.delete(f"/api/documents/{doc_id}").status_code == 200
+    assert api.get(f"/api/documents/{doc_id}").status_code == 404
+
+def test_oversized_and_empty_uploads_are_rejected(api, monkeypatch):
+    monkeypatch.setattr(main, "DOCUMENT_MAX_UPLOAD_MB", 0.001)
+    assert upload(api, "x" * 2000).status_code == 413
+    assert upload(api, "   \n").status_code == 400
+
+def test_tools_read_the_document_by_id(api, upstream):
+    upstream.reply = {"title": "T", "cards": [{"question": f"q{i}?", "answer": f"a{i}"} for i in range(5)]}
+    doc_id = upload(api, "Enzymes lower activation energy.").json()["doc_id"]
+    response = api.post("/api/tools/flashcards", json={"doc_id": doc_id})
+    assert response.status_code == 200
+    assert "Enzymes lower activation energy." in upstream.calls[0]["messages"][-1]["content"]
+    assert api.post("/api/tools/flashcards", json={"doc_id": "missing"}).status_code == 404
+
+def test_scan_problem_sends_at_most_one_prompt_worth_of_a_document(api, upstream):
+    upstream.reply = ANALYSIS
+    paragraphs = [f"Paragraph {i}: " + "the derivative measures change. " * 30 for i in range(200)]
+    doc_id = upload(api, "\n\n".join(paragraphs)).json()["doc_id"]
+    response = api.post("/api/tools/scan-problem", json={"doc_id": doc_id})
+    assert response.status_code == 200
+    prompt = upstream.calls[0]["messages"][-1]["content"]
+    assert prompt.startswith("Paragraph 0:")
+    assert len(prompt) <= main.DOCUMENT_CHUNK_THRESHOLD_CHARS
+
+def test_store_evicts_least_recently_used_and_idle_documents():
+    store = main.DocumentStore(max_documents=2, max_bytes=10_000, idle_ttl=60)
+    first = asyncio.run(store.put("first document", None))
+    asyncio.run(store.put("second document", None))
+    asyncio.run(store.get(first.doc_id))  # Now the most recently used
+    third = asyncio.run(store.put("third document", None))
+    assert asyncio.run(store.get(first.doc_id)) is not None
+    assert asyncio.run(store.get(third.doc_id)) is not None
+    assert len(store._documents) == 2
+
+    idle = main.DocumentStore(max_documents=2, max_bytes=10_000, idle_ttl=-1)
+    document = asyncio.run(idle.put("soon stale", None))
+    assert asyncio.run(idle.get(document.doc_id)) is None
+
+def test_sqlite_tier_serves_other_workers(tmp_path):
+    path = str(tmp_path / "documents.db")
+    one = main.DocumentStore(max_documents=5, max_bytes=10_000, idle_ttl=60, db_path=path)
+    two = main.DocumentStore(max_documents=5, max_bytes=10_000, idle_ttl=60, db_path=path)
+    document = asyncio.run(one.put("shared notes", "shared.txt"))
+    loaded = asyncio.run(two.get(document.doc_id))
+    assert loaded.content == "shared notes"
+    assert loaded.filename == "shared.txt"
+    one.close()
+    two.close()
@@ -0,0 +1,161 @@
+"""Background jobs: JobStore records and the JobRunner pool"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+import main
+
+class Answer(BaseModel):
+    value: str
+
+def runner(store: main.JobStore = None, workers: int = 1, queue_max: int = 10) -> main.JobRunner:
+    return main.JobRunner(store or main.JobStore(ttl=60), workers=workers, queue_max=queue_max, poll_interval=0.01)
+
+async def wait_for_status(store: main.JobStore, job_id: str, *statuses: str) -> dict:
+    for _ in range(200):
+        record = await store.get(job_id)
+        if record["status"] in statuses:
+            return record
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job stayed {record['status']}")
+
+def test_job_runs_to_completion_with_progress():
+    jobs = runner()
+    seen = []
+
+    async def run(on_progress):
+        await on_progress(0.5)
+        seen.append((await jobs.store.get(record["job_id"]))["progress"])
+        return Answer(value="done")
+
+    async def scenario():
+        nonlocal record
+        jobs.start()
+        try:
+            record = await jobs.submit("quiz", run)
+            assert record["status"] == "queued"
+            return await wait_for_status(jobs.store, record["job_id"], "succeeded")
+        finally:
+            await jobs.stop()
+
+    record = None
+    finished = asyncio.run(scenario())
+    assert seen == [0.5]
+    assert finished["progress"] == 1.0
+    assert finished["result"] == {"value": "done"}
+
+def test_failed_job_records_the_error():
+    jobs = runner()
+
+    async def run(on_progress):
+        raise RuntimeError("model down")
+
+    async def scenario():
+        jobs.start()
+        try:
+            record = await jobs.submit("quiz", run)
+            return await wait_for_status(jobs.store, record["job_id"], "failed")
+        finally:
+            await jobs.stop()
+
+    assert asyncio.run(scenario())["error"] == "model down"
+
+def test_cancel_running_and_queued_jobs():
+    jobs = runner(workers=1)
+    started = []
+
+    async def run(on_progress):
+        started.append(1)
+        await asyncio.sleep(10)
+        return Answer(value="never")
+
+    async def scenario():
+        jobs.start()
+        try:
+            running = await jobs.submit("quiz", run)
+            queued = await jobs.submit("quiz", run)
+            await wait_for_status(jobs.store, running["job_id"], "running")
+            assert (await jobs.cancel(queued["job_id"]))["status"] == "cancelled"
+            assert (await jobs.cancel(running["job_id"]))["status"] == "cancelled"
+            await asyncio.sleep(0.05)  # The pool picks up the cancelled job and skips it
+            return await jobs.store.get(queued["job_id"])
+        finally:
+            await jobs.stop()
+
+    assert asyncio.run(scenario())["status"] == "cancelled"
+    assert len(started) == 1
+
+def test_full_queue_is_rejected_with_503():
+    jobs = runner(queue_max=1)
+
+    async def run(on_progress):
+        return Answer(value="x")
+
+    async def scenario():
+        jobs.start()
+        await jobs.stop()  # No workers: the queue only fills up
+        await jobs.submit("quiz", run)
+        with pytest.raises(HTTPException) as excinfo:
+            await jobs.submit("quiz", run)
+        return excinfo.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert error.headers["Retry-After"] == "10"
+
+def test_finished_jobs_expire_after_the_ttl():
+    store = main.JobStore(ttl=-1)
+
+    async def scenario():
+        await store.save({"job_id": "a", "kind": "quiz", "status": "running"})
+        assert (await store.get("a"))["status"] == "running"  # Unfinished jobs never expire
+        await store.save({"job_id": "a", "kind": "quiz", "status": "succeeded"})
+        return await store.get("a")
+
+    assert asyncio.run(scenario()) is None
+
+def test_other_workers_see_the_job_and_can_cancel_it(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    owner, other = main.JobStore(ttl=60, db_path=db_path), main.JobStore(ttl=60, db_path=db_path)
+    jobs, remote = runner(owner), runner(other)
+
+    async def run(on_progress):
+        await asyncio.sleep(10)
+        return Answer(value="never")
+
+    async def scenario():
+        jobs.start()
+        try:
+            record = await jobs.submit("flashcards", run)
+            await wait_for_status(other, record["job_id"], "running")
+            assert not other.holds(record["job_id"])
+            await remote.cancel(record["job_id"])  # Recorded as a flag the owning worker polls for
+            return await wait_for_status(other, record["job_id"], "cancelled")
+        finally:
+            await jobs.stop()
+
+    try:
+        assert asyncio.run(scenario())["status"] == "cancelled"
+    finally:
+        owner.close()
+        other.close()
+
+def test_pool_stops_even_when_a_job_ends_at_the_same_time():
+    jobs = runner()
+
+    async def run(on_progress):
+        await asyncio.sleep(10)
+        return Answer(value="never")
+
+    async def scenario():
+        jobs.start()
+        record = await jobs.submit("quiz", run)
+        await wait_for_status(jobs.store, record["job_id"], "running")
+        task, _ = jobs._running[record["job_id"]]
+        task.cancel()
+        await asyncio.sleep(0)  # The job ends; the worker has not seen it yet
+        await asyncio.wait_for(jobs.stop(), timeout=1)
+
+    asyncio.run(scenario())
@@ -0,0 +1,27 @@
+"""The math-to-LaTeX converter against the golden corpus and the legacy converter (see bench_latex.py)"""
+import json
+
+import pytest
+
+import bench_latex
+import main
+
+with open(bench_latex.GOLDEN_PATH, encoding="utf-8") as golden_file:
+    GOLDEN = json.load(golden_file)
+
+@pytest.mark.parametrize("case", GOLDEN, ids=[case["name"] for case in GOLDEN])
+def test_golden_corpus(case):
+    assert main.convert_math_to_latex(case["input"]) == case["expected"]
+
+@pytest.mark.parametrize("step", [1, 3, 7])
+@pytest.mark.parametrize("case", GOLDEN, ids=[case["name"] for case in GOLDEN])
+def test_streamed_conversion_matches_the_golden_corpus(case, step):
+    assert bench_latex.stream_convert(case["input"], step) == case["expected"]
+
+def test_matches_the_legacy_converter_on_random_replies():
+    samples = list(bench_latex.differential_samples(2000, seed=16))
+    assert len(samples) > 1000
+    for text, step in samples:
+        expected = bench_latex.legacy_convert_math_to_latex(text)
+        assert main.convert_math_to_latex(text) == expected, text
+        assert bench_latex.stream_convert(text, step) == expected, text
@@ -0,0 +1,75 @@
+"""Structured logging: one JSON object per record, with user text and API keys redacted"""
+import json
+import logging
+import sys
+
+import main
+
+KEY = "gsk_" + "A1b2C3d4" * 6
+
+def record(message: str = "chat reply generated", level: int = logging.INFO, exc_info=None, **extra):
+    logger = logging.getLogger("kindminds.chat")
+    return logger.makeRecord(logger.name, level, __file__, 1, message, (), exc_info, extra=extra)
+
+def formatted(log_record: logging.LogRecord, as_json: bool = True, redact: bool = True) -> str:
+    return main.StructuredFormatter(as_json=as_json, redact=redact).format(log_record)
+
+def test_records_are_single_line_json_with_extra_fields():
+    log_record = record(model="llama", latency_ms=812)
+    log_record.request_id = "abc123"
+    line = formatted(log_record)
+    assert "\n" not in line
+    entry = json.loads(line)
+    assert entry["level"] == "INFO"
+    assert entry["logger"] == "kindminds.chat"
+    assert entry["event"] == "chat reply generated"
+    assert entry["request_id"] == "abc123"
+    assert entry["model"] == "llama"
+    assert entry["latency_ms"] == 812
+    assert entry["ts"].endswith("Z")
+
+def test_message_content_is_redacted():
+    secret = "I have been feeling hopeless lately"
+    line = formatted(record(text=secret, messages=[{"role": "user", "content": secret}]))
+    assert "hopeless" not in line
+    entry = json.loads(line)
+    assert entry["text"].startswith(f"<redacted len={len(secret)} sha256=")
+    assert entry["messages"].startswith("<redacted len=")
+    # The same text always gets the same hash, so log lines can still be correlated
+    assert entry["text"] == json.loads(formatted(record(text=secret)))["text"]
+
+def test_redaction_can_be_turned_off():
+    line = formatted(record(text="hello there", note=f"using {KEY}"), redact=False)
+    assert json.loads(line)["text"] == "hello there"
+    assert KEY in line
+
+def test_api_keys_are_masked_everywhere():
+    try:
+        raise RuntimeError(f"401 from Groq: Authorization: Bearer {KEY}")
+    except RuntimeError:
+        exc_info = sys.exc_info()
+    line = formatted(record(f"upstream rejected key {KEY}", level=logging.ERROR, exc_info=exc_info, error=f"bad {KEY}"))
+    assert "gsk_" not in line
+    assert "A1b2C3d4" not in line
+    entry = json.loads(line)
+    assert entry["event"] == "upstream rejected key <redacted key>"
+    assert entry["error"] == "bad <redacted key>"
+    assert "Authorization: <redacted key>" in entry["exc"]
+
+def test_text_format_is_one_key_value_line():
+    line = formatted(record(model="llama", text="private words"), as_json=False)
+    assert "[kindminds.chat] chat reply generated" in line
+    assert "model=llama" in line
+    assert "private words" not in line
+
+def test_context_filter_tags_the_request_and_applies_its_sampling_decision():
+    context_filter = main.LogContextFilter(debug_sample_rate=0.5)
+    id_token = main.log_request_id.set("req-1")
+    sample_token = main.log_debug_sampled.set(False)
+    try:
+        info, debug = record(), record(level=logging.DEBUG)
+        assert context_filter.filter(info) and info.request_id == "req-1"
+        assert not context_filter.filter(debug)
+    finally:
+        main.log_debug_sampled.reset(sample_token)
+        main.log_request_id.reset(id_token)
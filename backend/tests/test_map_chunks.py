@@ -0,0 +1,32 @@
+"""Map-reduce generation over document chunks"""
+import asyncio
+
+import pytest
+
+import main
+
+def build_prompts(index: int, chunk: str):
+    return "system", chunk
+
+def fake_generate_json(outcomes: dict):
+    async def generate_json(endpoint, system_prompt, user_prompt, model_params, array_key=None):
+        outcome = outcomes[user_prompt]
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+    return generate_json
+
+def test_failed_chunks_are_dropped(monkeypatch):
+    monkeypatch.setattr(main, "generate_json", fake_generate_json({"a": {"cards": [1]}, "b": ValueError("bad json")}))
+    assert asyncio.run(main.map_chunks("flashcards", ["a", "b"], build_prompts, {})) == [{"cards": [1]}]
+
+def test_all_chunks_failing_raises(monkeypatch):
+    monkeypatch.setattr(main, "generate_json", fake_generate_json({"a": ValueError("bad json")}))
+    with pytest.raises(ValueError):
+        asyncio.run(main.map_chunks("flashcards", ["a"], build_prompts, {}))
+
+def test_a_cancelled_chunk_is_not_merged(monkeypatch):
+    monkeypatch.setattr(main, "generate_json",
+                        fake_generate_json({"a": {"cards": [1]}, "b": asyncio.CancelledError()}))
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(main.map_chunks("flashcards", ["a", "b"], build_prompts, {}))
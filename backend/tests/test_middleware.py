@@ -0,0 +1,54 @@
+"""RequestContextMiddleware: per-request context and the headers it adds to every response"""
+import main
+
+def chat(api, text: str = "What is a cell?", path: str = "/api/chat"):
+    return api.post(path, json={"messages": [{"role": "user", "content": text}], "chat_type": "academic"})
+
+def requests_total(route: str, status: int = 200) -> float:
+    return main.metrics._counters.get(("kindminds_requests_total", (("route", route), ("status", str(status)))), 0)
+
+def test_response_reports_timings_and_the_served_model(api, upstream):
+    before = requests_total("/api/chat")
+    response = chat(api)
+    assert response.status_code == 200
+    assert response.headers["X-Served-Model"] == main.MODEL_ROUTES["chat"]["primary"]
+    timing = response.headers["Server-Timing"]
+    assert "upstream_wait;dur=" in timing and "total;dur=" in timing
+    assert 'tokens;desc="prompt=100 completion=20"' in timing
+    assert requests_total("/api/chat") == before + 1
+    assert "X-Overload-Level" not in response.headers
+
+def test_streamed_response_is_recorded_once_the_body_is_sent(api, upstream):
+    before = requests_total("/api/chat/stream")
+    response = chat(api, path="/api/chat/stream")
+    assert response.status_code == 200
+    assert "Server-Timing" in response.headers
+    assert requests_total("/api/chat/stream") == before + 1
+
+def test_unmatched_paths_are_not_recorded(api):
+    counters = dict(main.metrics._counters)
+    assert api.get("/no/such/route").status_code == 404
+    assert {key: value for key, value in main.metrics._counters.items() if key[0] == "kindminds_requests_total"} == {
+        key: value for key, value in counters.items() if key[0] == "kindminds_requests_total"
+    }
+
+def test_overload_level_is_reported_and_requests_leave_the_in_flight_count(api, upstream, monkeypatch):
+    monkeypatch.setattr(main, "OVERLOAD_CONTROL_ENABLED", True)
+    response = chat(api)
+    assert response.headers["X-Overload-Level"] == "0"
+    assert main.overload.in_flight == 0
+
+def test_request_id_is_set_for_the_handler_and_reset_afterwards(api, upstream):
+    seen = []
+
+    def reply(kwargs):
+        seen.append(main.log_request_id.get())
+        return "Here is a reply."
+
+    upstream.reply = reply
+    chat(api, "What is mitosis?")
+    api.post("/api/chat", headers={"X-Request-ID": "abc123"},
+             json={"messages": [{"role": "user", "content": "What is meiosis?"}], "chat_type": "academic"})
+    assert len(seen[0]) == 16
+    assert seen[1] == "abc123"
+    assert main.log_request_id.get() is None
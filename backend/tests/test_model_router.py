@@ -0,0 +1,57 @@
+"""ModelRouter: hedging, fallbacks and downgrades between the primary and fallback models"""
+import asyncio
+
+import pytest
+
+import main
+
+ROUTE = {"primary": "big", "fallback": "small", "latency_budget": 1.0, "hedge_delay": 0.05}
+
+def router(**route) -> main.ModelRouter:
+    return main.ModelRouter(routes={"quiz": {**ROUTE, **route}}, min_samples=3, max_errors=2, cooldown=60)
+
+def fake_attempt(delays: dict, errors: dict = None):
+    """attempt(model, on_admit) answering after delays[model] seconds, or raising errors[model]"""
+    calls = []
+
+    async def attempt(model, on_admit=None):
+        calls.append(model)
+        if (errors or {}).get(model) is not None:
+            raise errors[model]
+        if on_admit is not None:
+            on_admit()
+        await asyncio.sleep(delays[model])
+        return model
+
+    return attempt, calls
+
+def test_fast_primary_is_not_hedged():
+    models = router()
+    attempt, calls = fake_attempt({"big": 0.0, "small": 0.0})
+    assert asyncio.run(models.run("quiz", attempt)) == ("big", "big")
+    assert calls == ["big"]
+
+def test_slow_primary_is_hedged_with_the_fallback():
+    models = router()
+    attempt, calls = fake_attempt({"big": 0.5, "small": 0.0})
+    assert asyncio.run(models.run("quiz", attempt)) == ("small", "small")
+    assert calls == ["big", "small"]
+    assert models.stats["quiz"]["hedge_wins"] == 1
+
+@pytest.mark.parametrize("hedge_delay", [0.05, 0])
+def test_queue_rejection_is_not_retried_on_the_fallback(hedge_delay):
+    models = router(hedge_delay=hedge_delay)
+    attempt, calls = fake_attempt({"big": 0.0, "small": 0.0}, errors={"big": main.UpstreamBusyError(2)})
+    with pytest.raises(main.UpstreamBusyError):
+        asyncio.run(models.run("quiz", attempt))
+    assert calls == ["big"]
+    assert models.stats["quiz"]["primary_errors"] == 0
+
+def test_failing_primary_falls_back_and_is_downgraded():
+    models = router(hedge_delay=0)
+    attempt, calls = fake_attempt({"big": 0.0, "small": 0.0}, errors={"big": RuntimeError("model down")})
+    for _ in range(2):
+        assert asyncio.run(models.run("quiz", attempt)) == ("small", "small")
+    assert models.downgraded("quiz")
+    assert asyncio.run(models.run("quiz", attempt)) == ("small", "small")
+    assert calls == ["big", "small", "big", "small", "small"]
@@ -0,0 +1,80 @@
+"""Overload control: the degradation level and what each level changes"""
+import asyncio
+import time
+import uuid
+
+import pytest
+
+import main
+
+NEVER = 10 ** 6
+
+def controller(cooldown: float = 60) -> main.OverloadController:
+    return main.OverloadController([2, 4, 6, 8], [1.0, 2.0, 3.0, 4.0], cooldown)
+
+@pytest.fixture
+def at_level(monkeypatch):
+    """Pin every request to one overload level"""
+    def pin(level: int):
+        monkeypatch.setattr(main, "OVERLOAD_CONTROL_ENABLED", True)
+        monkeypatch.setattr(main, "overload", main.OverloadController([0] * level + [NEVER] * (4 - level), [NEVER] * 4, 60))
+    return pin
+
+def test_level_rises_with_in_flight_requests_at_once():
+    overload = controller()
+    overload.in_flight = 5
+    assert overload.update() == 2
+    overload.in_flight = 9
+    assert overload.update() == 4
+    assert overload.stats["level_changes"] == 2
+
+def test_level_steps_down_one_at_a_time_after_the_cooldown():
+    overload = controller(cooldown=0.05)
+    overload.in_flight = 9
+    assert overload.update() == 4
+    overload.in_flight = 0
+    assert overload.update() == 4  # Calm period starts
+    time.sleep(0.06)
+    assert overload.update() == 3
+    assert overload.update() == 3  # The next step needs another calm period
+    time.sleep(0.06)
+    assert overload.update() == 2
+
+def test_upstream_latency_raises_the_level_and_decays():
+    overload = controller(cooldown=0.05)
+    for _ in range(20):
+        overload.observe_latency(3.5)
+    assert overload.latency() == pytest.approx(3.5, abs=0.1)
+    assert overload.update() == 3
+    time.sleep(0.3)  # Six cooldown periods without samples
+    assert overload.latency() < 0.1
+
+def test_level_1_caps_reply_length(api, upstream, at_level):
+    at_level(1)
+    response = api.post("/api/chat", json={"messages": [{"role": "user", "content": "What is a cell?"}],
+                                           "chat_type": "academic"})
+    assert response.status_code == 200
+    assert response.headers["X-Overload-Level"] == "1"
+    assert upstream.chat_calls()[0]["max_tokens"] <= main.OVERLOAD_MAX_TOKENS["chat"]
+
+def test_level_2_keeps_sentiment_local(api, upstream, at_level):
+    at_level(2)
+    response = api.post("/api/tools/sentiment", json={"text": "I don't know what to do anymore"})
+    assert response.status_code == 200
+    assert response.json()["tier"] == "local"
+    assert upstream.calls == []
+
+def test_level_3_runs_generations_as_jobs(api, upstream, at_level, monkeypatch):
+    at_level(3)
+    monkeypatch.setattr(main.job_runner, "_queue", asyncio.Queue())  # Accepts jobs without running them
+    response = api.post("/api/tools/quiz", json={"content": f"Cells are the unit of life. {uuid.uuid4().hex}"})
+    assert response.status_code == 202
+    assert response.headers["Location"] == f"/api/jobs/{response.json()['job_id']}"
+    assert upstream.calls == []
+
+def test_level_4_sheds_low_priority_work_only(api, upstream, at_level):
+    at_level(4)
+    response = api.post("/api/tools/quiz", json={"content": "Cells are the unit of life."})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(int(main.OVERLOAD_RETRY_AFTER_SECONDS))
+    assert api.post("/api/tools/sentiment", json={"text": "I'm so happy today!"}).status_code == 200
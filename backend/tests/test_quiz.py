@@ -0,0 +1,30 @@
+"""Quiz generation: whole and streamed, capped at the requested number of questions"""
+import json
+import uuid
+
+def quiz_reply(count: int) -> dict:
+    return {"title": "Cells", "questions": [
+        {"question": f"Question {index} about cells?", "explanation": "Because.",
+         "options": [{"text": "Right", "is_correct": True}, {"text": "Wrong", "is_correct": False}]}
+        for index in range(count)
+    ]}
+
+def quiz_request(num_questions: int) -> dict:
+    return {"content": f"Cells are the basic unit of life. {uuid.uuid4().hex}", "num_questions": num_questions}
+
+def test_quiz_is_capped_at_num_questions(api, upstream):
+    upstream.reply = quiz_reply(6)
+    response = api.post("/api/tools/quiz", json=quiz_request(3))
+    assert response.status_code == 200
+    assert len(response.json()["questions"]) == 3
+
+def test_streamed_single_chunk_quiz_is_capped_at_num_questions(api, upstream):
+    upstream.reply = quiz_reply(6)
+    response = api.post("/api/tools/quiz/stream", json=quiz_request(3))
+    assert response.status_code == 200
+    events = [json.loads(line) for line in response.text.splitlines() if line]
+    assert [event["event"] for event in events] == ["question"] * 3 + ["done"]
+    assert [question["question"] for question in events[-1]["data"]["questions"]] == [
+        event["data"]["question"] for event in events[:3]
+    ]
+    assert len(upstream.chat_calls()) == 1
@@ -0,0 +1,56 @@
+"""Content-addressed result cache for the generation tools"""
+import asyncio
+
+import main
+
+CARDS = {"title": "Cells", "cards": [{"question": f"What is organelle {i}?", "answer": f"Answer {i}"} for i in range(5)]}
+
+def flashcards(api, content: str, **headers):
+    return api.post("/api/tools/flashcards", json={"content": content}, headers=headers)
+
+def test_identical_request_is_served_from_the_cache(api, upstream):
+    upstream.reply = CARDS
+    first = flashcards(api, "Mitochondria make ATP.  Ribosomes make proteins.")
+    second = flashcards(api, "Mitochondria make ATP.\nRibosomes make proteins.")  # Same text after whitespace folding
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.json() == first.json()
+    assert len(upstream.calls) == 1
+
+def test_bypass_regenerates_and_replaces_the_entry(api, upstream):
+    upstream.reply = CARDS
+    flashcards(api, "The nucleus stores DNA.")
+    bypassed = flashcards(api, "The nucleus stores DNA.", **{"X-Cache-Bypass": "1"})
+    assert bypassed.headers["X-Cache"] == "BYPASS"
+    assert len(upstream.calls) == 2
+    assert flashcards(api, "The nucleus stores DNA.").headers["X-Cache"] == "HIT"
+
+def test_different_content_is_a_miss(api, upstream):
+    upstream.reply = CARDS
+    flashcards(api, "Chloroplasts capture light.")
+    assert flashcards(api, "Vacuoles store water.").headers["X-Cache"] == "MISS"
+
+def test_lru_evicts_by_entry_count_and_bytes():
+    cache = main.ResultCache(max_entries=2, max_bytes=1000, ttl_seconds=60)
+    for key in ("a", "b", "c"):
+        asyncio.run(cache.set(key, {"value": key}))
+    assert asyncio.run(cache.get("a")) is None
+    assert asyncio.run(cache.get("c")) == {"value": "c"}
+    asyncio.run(cache.set("big", {"value": "x" * 2000}))  # Larger than the whole cache: not kept
+    assert asyncio.run(cache.get("big")) is None
+    assert cache.snapshot()["evictions"] == 1
+
+def test_expired_entries_are_misses():
+    cache = main.ResultCache(max_entries=10, max_bytes=1000, ttl_seconds=-1)
+    asyncio.run(cache.set("k", {"value": 1}))
+    assert asyncio.run(cache.get("k")) is None
+
+def test_disk_tier_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "results.db")
+    writer = main.ResultCache(max_entries=10, max_bytes=1000, ttl_seconds=60, db_path=path)
+    reader = main.ResultCache(max_entries=10, max_bytes=1000, ttl_seconds=60, db_path=path)
+    asyncio.run(writer.set("k", {"value": 1}))
+    assert asyncio.run(reader.get("k")) == {"value": 1}
+    assert reader.stats["disk_hits"] == 1
+    writer.close()
+    reader.close()
@@ -0,0 +1,109 @@
+"""UpstreamScheduler: priority lanes, queue deadlines, rate budgets and retries"""
+import asyncio
+
+import httpx
+import pytest
+from groq import APIConnectionError, RateLimitError
+
+import main
+
+REQUEST = httpx.Request("POST", "https://api.groq.test/openai/v1/chat/completions")
+
+def scheduler(max_concurrency=1, rpm=0.0, tpm=0.0, deadline=5.0, max_retries=2) -> main.UpstreamScheduler:
+    return main.UpstreamScheduler(
+        priorities={"sentiment": 0, "chat": 1, "quiz": 4},
+        deadlines={"sentiment": deadline, "chat": deadline, "quiz": deadline},
+        max_concurrency=max_concurrency,
+        requests_per_minute=rpm,
+        tokens_per_minute=tpm,
+        max_retries=max_retries,
+    )
+
+def rate_limited() -> RateLimitError:
+    response = httpx.Response(429, request=REQUEST, headers={"retry-after-ms": "10"})
+    return RateLimitError("rate limited", response=response, body=None)
+
+def test_higher_priority_lanes_are_dispatched_first():
+    upstream = scheduler()
+    order = []
+
+    async def job(name, delay=0.0):
+        await asyncio.sleep(delay)
+        order.append(name)
+
+    async def scenario():
+        holder = asyncio.create_task(upstream.call("chat", lambda: job("holder", 0.05), cost=1))
+        await asyncio.sleep(0.01)
+        quiz = asyncio.create_task(upstream.call("quiz", lambda: job("quiz"), cost=1))
+        await asyncio.sleep(0.01)
+        sentiment = asyncio.create_task(upstream.call("sentiment", lambda: job("sentiment"), cost=1))
+        await asyncio.gather(holder, quiz, sentiment)
+
+    asyncio.run(scenario())
+    assert order == ["holder", "sentiment", "quiz"]
+
+def test_call_that_misses_its_deadline_is_rejected_with_503():
+    upstream = scheduler(deadline=0.05)
+
+    async def scenario():
+        holder = asyncio.create_task(upstream.call("chat", lambda: asyncio.sleep(0.3), cost=1))
+        await asyncio.sleep(0.01)
+        with pytest.raises(main.UpstreamBusyError) as excinfo:
+            await upstream.call("chat", lambda: asyncio.sleep(0), cost=1)
+        await holder
+        return excinfo.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert int(error.headers["Retry-After"]) >= 1
+    assert upstream.snapshot()["lanes"]["chat"]["rejected"] == 1
+
+def test_rate_limited_attempt_is_refunded_to_the_buckets():
+    upstream = scheduler(rpm=10, tpm=1000)
+    attempts = []
+
+    async def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise rate_limited()
+        return "ok"
+
+    assert asyncio.run(upstream.call("chat", factory, cost=100)) == "ok"
+    assert len(attempts) == 2
+    # Only the successful attempt stays charged
+    assert upstream.requests.level == pytest.approx(9, abs=0.1)
+    assert upstream.tokens.level == pytest.approx(900, abs=1)
+    assert upstream.snapshot()["lanes"]["chat"]["rate_limited"] == 1
+
+def test_exhausted_rate_limit_retries_become_503():
+    upstream = scheduler(max_retries=1)
+
+    async def factory():
+        raise rate_limited()
+
+    with pytest.raises(main.UpstreamBusyError):
+        asyncio.run(upstream.call("chat", factory, cost=1))
+
+def test_backing_off_call_frees_its_slot(monkeypatch):
+    monkeypatch.setattr(main, "retry_backoff", lambda attempt: 0.2)
+    upstream = scheduler()
+    finished = []
+
+    async def flaky():
+        if "flaky attempt" not in finished:
+            finished.append("flaky attempt")
+            raise APIConnectionError(request=REQUEST)
+        finished.append("flaky")
+
+    async def quick():
+        finished.append("quick")
+
+    async def scenario():
+        first = asyncio.create_task(upstream.call("chat", flaky, cost=1))
+        await asyncio.sleep(0.05)  # first is now sleeping before its retry
+        await asyncio.wait_for(upstream.call("chat", quick, cost=1), timeout=0.1)
+        await first
+
+    asyncio.run(scenario())
+    assert finished == ["flaky attempt", "quick", "flaky"]
+    assert upstream.snapshot()["in_flight"] == 0
@@ -0,0 +1,95 @@
+"""SemanticCache: similar questions share an answer within a scope, with either index backend"""
+import asyncio
+
+import pytest
+
+import main
+
+@pytest.fixture(params=["numpy", "inverted_index"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        monkeypatch.setattr(main, "np", pytest.importorskip("numpy"))
+    else:
+        monkeypatch.setattr(main, "np", None)
+    return request.param
+
+def ask(question: str, chat_type: str = "academic", **fields) -> main.ChatRequest:
+    return main.ChatRequest(messages=[{"role": "user", "content": question}], chat_type=chat_type, **fields)
+
+def cache(**kwargs) -> main.SemanticCache:
+    return main.SemanticCache(**{"max_entries": 100, "threshold": 0.88, "ttl_seconds": 3600, **kwargs})
+
+def lookup(semantic_cache: main.SemanticCache, question: str, **fields):
+    return asyncio.run(semantic_cache.get(ask(question, **fields), question))
+
+def store(semantic_cache: main.SemanticCache, question: str, answer: str, **fields):
+    asyncio.run(semantic_cache.set(ask(question, **fields), question, answer))
+
+def test_index_finds_the_nearest_question_and_survives_removal(backend):
+    index = main.SemanticIndex()
+    questions = ["What is photosynthesis?", "How do plants breathe?", "What is the capital of France?"]
+    for entry_id, question in enumerate(questions):
+        index.add(entry_id, main.semantic_features(question)[0])
+    query = main.semantic_features("what is photosynthesis??")[0]
+    entry_id, similarity = index.nearest(query)
+    assert entry_id == 0 and similarity == pytest.approx(1.0, abs=1e-5)
+    index.remove(0)  # The last row moves into the gap
+    assert len(index) == 2
+    assert index.nearest(main.semantic_features("What is the capital of France?")[0])[0] == 2
+    assert index.nearest(query)[1] < 0.88
+
+def test_rephrased_question_is_a_hit(backend):
+    semantic_cache = cache()
+    store(semantic_cache, "Can you explain how photosynthesis works?", "Plants turn light into sugar.")
+    assert lookup(semantic_cache, "Could you explain how photosynthesis works") == "Plants turn light into sugar."
+    assert lookup(semantic_cache, "What is the capital of France?") is None
+    assert semantic_cache.stats["hits"] == 1 and semantic_cache.stats["misses"] == 1
+    assert semantic_cache.snapshot()["backend"] == backend
+
+def test_numbers_and_personas_get_their_own_scope(backend):
+    semantic_cache = cache()
+    store(semantic_cache, "How do I solve 2x + 3 = 7?", "x = 2")
+    assert lookup(semantic_cache, "How do I solve 2x + 3 = 8?") is None
+    assert lookup(semantic_cache, "How do I solve 2x + 3 = 7?", mbti_type="INTJ") is None
+    assert lookup(semantic_cache, "how do I solve 2x + 3 = 7") == "x = 2"
+
+def test_least_recently_used_entry_is_evicted(backend):
+    semantic_cache = cache(max_entries=2)
+    store(semantic_cache, "What is photosynthesis?", "a")
+    store(semantic_cache, "What is the capital of France?", "b")
+    assert lookup(semantic_cache, "What is photosynthesis?") == "a"
+    store(semantic_cache, "Why is the sky blue?", "c")
+    assert lookup(semantic_cache, "What is the capital of France?") is None
+    assert lookup(semantic_cache, "What is photosynthesis?") == "a"
+    assert semantic_cache.stats["evictions"] == 1
+
+def test_expired_answers_are_not_served(backend):
+    semantic_cache = cache(ttl_seconds=-1)
+    store(semantic_cache, "What is photosynthesis?", "a")
+    assert lookup(semantic_cache, "What is photosynthesis?") is None
+    assert semantic_cache.snapshot()["entries"] == 0
+
+@pytest.mark.parametrize("request_fields", [
+    {"messages": [{"role": "user", "content": "What is a cell?"}], "chat_type": "mindfulness"},
+    {"messages": [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello!"},
+                  {"role": "user", "content": "What is a cell?"}], "chat_type": "academic"},
+    {"messages": [{"role": "user", "content": "What is a cell?"}], "chat_type": "academic",
+     "sentiment": {"sentiment": "negative", "score": -0.5}},
+    {"messages": [{"role": "user", "content": "I want to kill myself"}], "chat_type": "academic"},
+])
+def test_questions_that_must_not_be_answered_from_the_cache(request_fields):
+    assert main.SemanticCache.question_for(main.ChatRequest(**request_fields)) is None
+
+def test_workers_share_answers_through_sqlite(backend, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "SEMANTIC_CACHE_SYNC_SECONDS", 0)
+    db_path = str(tmp_path / "semantic.db")
+    first, second = cache(db_path=db_path), cache(db_path=db_path)
+    try:
+        store(first, "What is photosynthesis?", "Plants turn light into sugar.")
+        assert lookup(second, "what is photosynthesis") == "Plants turn light into sugar."  # Synced
+        restarted = cache(db_path=db_path)  # Loaded on start
+        assert lookup(restarted, "What is photosynthesis?") == "Plants turn light into sugar."
+        restarted.close()
+    finally:
+        first.close()
+        second.close()
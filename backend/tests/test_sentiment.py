@@ -0,0 +1,65 @@
+"""The sentiment cascade: crisis phrases, the local tier and the LLM/fallback tiers"""
+import pytest
+
+import main
+
+@pytest.mark.parametrize("text", [
+    "I want to kill myself",
+    "there's no reason to live anymore",
+    "I'm going to take all my pills tonight",
+    "honestly kms",
+    "I just want to unalive myself",
+    "I keep thinking about how to hang myself",
+    "I wish I was dead",
+])
+def test_crisis_phrases_short_circuit(text):
+    verdict, _ = main.local_sentiment_verdict(text)
+    assert verdict is not None
+    assert verdict.tier == "crisis"
+    assert verdict.score == -0.95
+
+def test_clear_positive_text_is_answered_locally():
+    verdict, _ = main.local_sentiment_verdict("I'm so happy today!")
+    assert verdict is not None
+    assert verdict.tier == "local"
+    assert verdict.sentiment == "positive"
+    assert verdict.confidence >= main.SENTIMENT_LOCAL_MIN_CONFIDENCE
+
+@pytest.mark.parametrize("text", [
+    "I don't know what to do anymore",  # No lexicon hit: not evidence of a neutral mood
+    "I feel empty",
+    "I'm happy but also really anxious",
+    "I'm not happy at all",
+])
+def test_ambiguous_texts_go_to_the_llm(text):
+    verdict, local = main.local_sentiment_verdict(text)
+    assert verdict is None
+    assert local is not None
+
+def test_empty_text_is_neutral():
+    verdict, _ = main.local_sentiment_verdict("")
+    assert verdict.sentiment == "neutral"
+    assert verdict.score == 0.0
+
+def test_endpoint_crisis_makes_no_upstream_call(api, upstream):
+    response = api.post("/api/tools/sentiment", json={"text": "I want to end my life"})
+    assert response.status_code == 200
+    assert response.json()["tier"] == "crisis"
+    assert upstream.calls == []
+
+def test_endpoint_scores_ambiguous_text_with_the_llm(api, upstream):
+    upstream.sentiment = {"sentiment": "negative", "score": -0.5}
+    response = api.post("/api/tools/sentiment", json={"text": "I don't know what to do anymore"})
+    assert response.status_code == 200
+    assert response.json() == {"sentiment": "negative", "score": -0.5, "tier": "llm", "confidence": None}
+    assert len(upstream.sentiment_calls()) == 1
+
+def test_endpoint_falls_back_to_the_heuristic_when_the_llm_fails(api, upstream):
+    upstream.sentiment = RuntimeError("upstream down")
+    response = api.post("/api/tools/sentiment", json={"text": "I don't know what to do anymore"})
+    assert response.status_code == 200
+    assert response.json()["tier"] == "fallback"
+
+@pytest.mark.parametrize("score, activity", [(-0.95, "54321"), (-0.8, "54321"), (-0.5, "breathing"), (-0.2, None), (0.6, None)])
+def test_suggest_activity_thresholds(score, activity):
+    assert main.suggest_activity(score) == activity
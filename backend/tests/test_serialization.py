@@ -0,0 +1,87 @@
+"""Response serialization: orjson rendering, content negotiation and compressed payloads"""
+import gzip
+import json
+import uuid
+
+import pytest
+
+import main
+
+PAYLOAD = {"title": "Cells – ünïcode ✓", "items": [{"n": index, "ok": index % 2 == 0, "x": None} for index in range(3)]}
+
+def large_quiz() -> main.QuizResponse:
+    return main.QuizResponse(title="Cells", questions=[
+        main.QuizQuestion(question=f"Question {index}: which organelle makes ATP?", explanation="Mitochondria do.",
+                          options=[main.QuizOption(text="Mitochondria", is_correct=True),
+                                   main.QuizOption(text="Ribosome", is_correct=False)])
+        for index in range(20)
+    ])
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_json_matches_the_stdlib_encoding(use_orjson, monkeypatch):
+    if not use_orjson:
+        monkeypatch.setattr(main, "orjson", None)
+    elif main.orjson is None:
+        pytest.skip("orjson is not installed")
+    encoded = main.dumps_json(PAYLOAD)
+    assert json.loads(encoded) == PAYLOAD
+    assert encoded == json.dumps(PAYLOAD, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def test_models_render_without_revalidation():
+    quiz = large_quiz()
+    assert main.FastJSONResponse(quiz).body == quiz.model_dump_json().encode("utf-8")
+
+@pytest.mark.parametrize("header, with_brotli, expected", [
+    (None, True, None),
+    ("gzip, deflate, br", True, "br"),
+    ("gzip, deflate, br", False, "gzip"),
+    ("br;q=0.5, gzip", True, "gzip"),
+    ("br;q=0", False, None),
+    ("*", True, "br"),
+    ("identity", True, None),
+])
+def test_content_encoding_negotiation(header, with_brotli, expected, monkeypatch):
+    if with_brotli:
+        pytest.importorskip("brotli")
+    else:
+        monkeypatch.setattr(main, "brotli", None)
+    assert main.negotiate_content_encoding(header) == expected
+
+def test_small_payloads_are_sent_as_is():
+    response = main.payload_response(PAYLOAD, "gzip, br")
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+
+def test_large_payloads_are_gzipped(monkeypatch):
+    monkeypatch.setattr(main, "brotli", None)
+    quiz = large_quiz()
+    response = main.payload_response(quiz, "gzip")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert int(response.headers["Content-Length"]) == len(response.body)
+    assert gzip.decompress(response.body) == quiz.model_dump_json().encode("utf-8")
+
+def test_large_payloads_are_brotli_compressed_when_accepted():
+    brotli = pytest.importorskip("brotli")
+    quiz = large_quiz()
+    response = main.payload_response(quiz, "gzip, br", status_code=202, headers={"X-Cache": "MISS"})
+    assert response.status_code == 202
+    assert response.headers["Content-Encoding"] == "br"
+    assert response.headers["X-Cache"] == "MISS"
+    assert brotli.decompress(response.body) == quiz.model_dump_json().encode("utf-8")
+
+def test_compression_can_be_turned_off(monkeypatch):
+    monkeypatch.setattr(main, "RESPONSE_COMPRESSION_MIN_BYTES", 0)
+    response = main.payload_response(large_quiz(), "gzip, br")
+    assert "Content-Encoding" not in response.headers and "Vary" not in response.headers
+
+def test_quiz_endpoint_sends_a_compressed_body(api, upstream):
+    upstream.reply = {"title": "Cells", "questions": [
+        {"question": f"Question {index} about the parts of a eukaryotic cell?", "explanation": "Because. " * 10,
+         "options": [{"text": "Right", "is_correct": True}, {"text": "Wrong", "is_correct": False}]}
+        for index in range(10)
+    ]}
+    response = api.post("/api/tools/quiz", headers={"Accept-Encoding": "gzip"},
+                        json={"content": f"Cells are the unit of life. {uuid.uuid4().hex}", "num_questions": 10})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.json()["questions"]) == 10  # httpx decodes the body
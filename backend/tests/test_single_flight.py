@@ -0,0 +1,125 @@
+"""SingleFlight: identical in-flight calls share one generation, within and across workers"""
+import asyncio
+
+import pytest
+
+import main
+
+def counting_factory(result="done", delay=0.05):
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return result
+
+    return factory, calls
+
+def run(flight: main.SingleFlight, key: str, factory, **kwargs):
+    return flight.run(key, factory, lease_seconds=5, serialize=str, deserialize=str, **kwargs)
+
+def test_concurrent_callers_share_one_call():
+    flight = main.SingleFlight()
+    factory, calls = counting_factory()
+
+    async def scenario():
+        return await asyncio.gather(*(run(flight, "k", factory) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["done"] * 5
+    assert len(calls) == 1
+    assert flight.stats["local_joins"] == 4
+
+def test_finished_results_are_not_cached():
+    flight = main.SingleFlight()
+    factory, calls = counting_factory()
+
+    async def scenario():
+        await run(flight, "k", factory)
+        await run(flight, "k", factory)
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+def test_call_survives_until_the_last_waiter_leaves():
+    flight = main.SingleFlight()
+    factory, calls = counting_factory(delay=0.2)
+
+    async def scenario():
+        first = asyncio.create_task(run(flight, "k", factory))
+        second = asyncio.create_task(run(flight, "k", factory))
+        await asyncio.sleep(0.05)
+        first.cancel()  # The first client disconnects; the second still gets its answer
+        assert await second == "done"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+        lonely = asyncio.create_task(run(flight, "other", factory))
+        await asyncio.sleep(0.05)
+        lonely.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await lonely
+
+    asyncio.run(scenario())
+    assert flight.stats["cancelled"] == 1
+    assert flight.snapshot()["in_flight"] == 0
+
+def test_lease_coalesces_across_instances(tmp_path):
+    db_path = str(tmp_path / "flights.db")
+    leader, follower = (main.SingleFlight(db_path=db_path, poll_interval=0.01) for _ in range(2))
+    factory, calls = counting_factory(delay=0.2)
+
+    async def scenario():
+        first = asyncio.create_task(run(leader, "k", factory))
+        await asyncio.sleep(0.05)
+        return await asyncio.gather(first, run(follower, "k", factory))
+
+    try:
+        assert asyncio.run(scenario()) == ["done", "done"]
+        assert len(calls) == 1
+        assert follower.stats["remote_joins"] == 1
+    finally:
+        leader.close()
+        follower.close()
+
+def test_calls_without_the_lease_stay_per_worker(tmp_path):
+    db_path = str(tmp_path / "flights.db")
+    first, second = (main.SingleFlight(db_path=db_path, poll_interval=0.01) for _ in range(2))
+    factory, calls = counting_factory()
+
+    async def scenario():
+        await asyncio.gather(run(first, "k", factory, cross_worker=False), run(second, "k", factory, cross_worker=False))
+
+    try:
+        asyncio.run(scenario())
+        assert len(calls) == 2
+        assert second.stats["remote_joins"] == 0
+    finally:
+        first.close()
+        second.close()
+
+def test_follower_takes_over_when_the_leader_fails(tmp_path):
+    db_path = str(tmp_path / "flights.db")
+    leader, follower = (main.SingleFlight(db_path=db_path, poll_interval=0.01) for _ in range(2))
+
+    async def failing():
+        await asyncio.sleep(0.1)
+        raise RuntimeError("upstream down")
+
+    factory, calls = counting_factory()
+
+    async def scenario():
+        first = asyncio.create_task(run(leader, "k", failing))
+        await asyncio.sleep(0.03)
+        second = asyncio.create_task(run(follower, "k", factory))
+        await asyncio.sleep(0.03)
+        assert follower.stats["remote_joins"] == 1
+        with pytest.raises(RuntimeError):
+            await first
+        return await second
+
+    try:
+        assert asyncio.run(scenario()) == "done"
+        assert len(calls) == 1
+    finally:
+        leader.close()
+        follower.close()
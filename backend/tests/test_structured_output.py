@@ -0,0 +1,92 @@
+"""Structured output: JSON repair and salvage, json_validate_failed recovery and top-up calls"""
+import json
+import uuid
+
+import httpx
+import pytest
+from groq import BadRequestError
+
+import main
+
+CARDS = [{"question": "What is ATP?", "answer": "The cell's energy currency."},
+         {"question": "Where is DNA kept?", "answer": "In the nucleus."}]
+
+def test_valid_json_is_parsed_as_is():
+    assert main.parse_structured_output("flashcards", json.dumps({"cards": CARDS}), "cards") == {"cards": CARDS}
+
+def test_text_around_the_object_is_stripped():
+    raw = "Here you go:\n```json\n" + json.dumps({"title": "Cells", "cards": CARDS}) + "\n```"
+    assert main.parse_structured_output("flashcards", raw, "cards") == {"title": "Cells", "cards": CARDS}
+
+def test_cut_off_reply_keeps_its_complete_elements():
+    raw = json.dumps({"title": "Cells", "cards": CARDS})[:-40]  # Cut inside the second card
+    parsed = main.parse_structured_output("flashcards", raw, "cards")
+    assert parsed == {"title": "Cells", "cards": CARDS[:1], "truncated": True}
+
+@pytest.mark.parametrize("raw, array_key", [
+    ("not json at all", "cards"),
+    ('{"title": "Cells", "cards": [{"question": "What', "cards"),  # No complete element
+    (json.dumps({"cards": CARDS})[:-40], None),  # Nothing to salvage without the array key
+])
+def test_unusable_replies_raise(raw, array_key):
+    with pytest.raises(json.JSONDecodeError):
+        main.parse_structured_output("flashcards", raw, array_key)
+
+def test_item_parser_yields_elements_as_they_close():
+    raw = json.dumps({"title": "Braces {and} \"quotes\"", "cards": [
+        {"question": "What does } mean in JSON?", "answer": "It closes an object."}, *CARDS]})
+    parser = main.JSONArrayItemParser("cards")
+    completed = []
+    for char in raw:
+        completed.extend(parser.feed(char))
+    assert parser.title == 'Braces {and} "quotes"'
+    assert completed[0]["question"] == "What does } mean in JSON?"
+    assert completed[1:] == CARDS
+    assert parser.closed
+
+def json_validate_failed(failed_generation: str) -> BadRequestError:
+    body = {"error": {"message": "Failed to generate JSON", "type": "invalid_request_error",
+                      "code": "json_validate_failed", "failed_generation": failed_generation}}
+    request = httpx.Request("POST", "https://api.groq.test/openai/v1/chat/completions")
+    return BadRequestError("Failed to generate JSON", response=httpx.Response(400, request=request), body=body)
+
+def test_json_validate_failed_output_is_repaired(api, upstream):
+    upstream.reply = json_validate_failed(json.dumps({"cards": CARDS * 2})[:-30])
+    response = api.post("/api/tools/flashcards", json={"content": f"Cells and energy. {uuid.uuid4().hex}"})
+    assert response.status_code == 200
+    # The cut-off output yields three cards, and the top-up (failing the same way) only repeats them
+    assert response.json()["cards"] == CARDS + CARDS[:1]
+
+def test_other_bad_requests_are_not_swallowed(api, upstream):
+    request = httpx.Request("POST", "https://api.groq.test/openai/v1/chat/completions")
+    upstream.reply = BadRequestError("context too long", response=httpx.Response(400, request=request), body=None)
+    response = api.post("/api/tools/flashcards", json={"content": f"Cells and energy. {uuid.uuid4().hex}"})
+    assert response.status_code == 500
+
+def test_short_reply_is_topped_up_without_duplicates(api, upstream):
+    extra = [CARDS[0], {"question": "What do ribosomes make?", "answer": "Proteins."},
+             {"question": "What surrounds the cell?", "answer": "The membrane."}]
+
+    def reply(kwargs):
+        if "more are needed" in kwargs["messages"][1]["content"]:
+            return {"cards": extra}
+        return {"title": "Cells", "cards": CARDS}
+
+    upstream.reply = reply
+    response = api.post("/api/tools/flashcards", json={"content": f"Cells and energy. {uuid.uuid4().hex}"})
+    assert response.status_code == 200
+    questions = [card["question"] for card in response.json()["cards"]]
+    assert questions == [card["question"] for card in CARDS + extra[1:]]
+    topup_prompt = upstream.chat_calls()[1]["messages"][1]["content"]
+    assert "Only 2 more are needed." in topup_prompt and "- What is ATP?" in topup_prompt
+
+def test_failed_top_up_keeps_what_the_reply_had(api, upstream):
+    def reply(kwargs):
+        if "more are needed" in kwargs["messages"][1]["content"]:
+            raise RuntimeError("upstream down")
+        return {"title": "Cells", "cards": CARDS}
+
+    upstream.reply = reply
+    response = api.post("/api/tools/flashcards", json={"content": f"Cells and energy. {uuid.uuid4().hex}"})
+    assert response.status_code == 200
+    assert len(response.json()["cards"]) == 2
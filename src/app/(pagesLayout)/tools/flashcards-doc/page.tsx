@@ -16,7 +16,7 @@ import {
   getSignedFileUrl,
   logActivity,
 } from "@/lib/toolsAPI";
-import { resolveBackendUrl } from "@/lib/api";
+import { resolveBackendUrl, readToolResult } from "@/lib/api";
 import { motion, AnimatePresence } from "motion/react";
 import { ChevronLeft, ChevronRight, X, RotateCcw } from "lucide-react";
 
@@ -129,7 +129,7 @@ export default function FlashcardsFromDocPage() {
         throw new Error("Failed to generate flashcards");
       }
 
-      const data = await response.json();
+      const data = await readToolResult(response);
       setGeneratedCards(data.cards);
 
       const { error } = await saveFlashcards({
@@ -18,7 +18,7 @@ import {
   saveQuizAttempt,
   logActivity,
 } from "@/lib/toolsAPI";
-import { resolveBackendUrl } from "@/lib/api";
+import { resolveBackendUrl, readToolResult } from "@/lib/api";
 import { CheckCircle2, XCircle, ArrowRight, Play, Download, X } from "lucide-react";
 
 export default function QuizFromDocPage() {
@@ -132,7 +132,7 @@ export default function QuizFromDocPage() {
         return;
       }
 
-      const data = await response.json();
+      const data = await readToolResult(response);
       setGeneratedQuiz({ title: data.title, questions: data.questions });
 
       const { error } = await saveQuiz({
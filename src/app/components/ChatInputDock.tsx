@@ -5,7 +5,7 @@ import { useState } from "react";
 import { useChat } from "../contexts/ChatContext";
 import { usePathname, useRouter } from "next/navigation";
 import { motion } from "framer-motion";
-import { ChatMessage, ChatWithMessages, logSentimentEvent } from "@/lib/supabaseChat";
+import { ChatMessage, logSentimentEvent } from "@/lib/supabaseChat";
 import { useActivity } from "../contexts/ActivityContext";
 import { useAuth } from "@/app/contexts/AuthContext";
 import { fetchProfile } from "@/lib/profileAPI";
@@ -45,85 +45,55 @@ export default function ChatInputDock({ position }: ChatInputDockProps) {
   };
 
   /**
-   * Analyzes sentiment of user message and triggers appropriate activity if needed
-   * @param message User message text
+   * Logs the sentiment returned with a chat turn and triggers the crisis activity if needed
+   * @param data Sentiment data from /api/chat/turn
    * @param chatId Chat ID
-   * @param chatTab Chat tab type
-   * @param fallbackChat Fallback chat object
-   * @returns Object with sentiment data and activity info, or null if analysis failed
+   * @returns Object with sentiment data and activity info
    */
-  const analyzeSentiment = async (
-    message: string,
-    chatId: string,
-    chatTab: "academic" | "mindfulness",
-    fallbackChat?: ChatWithMessages | null
-  ): Promise<{ sentiment: string; score: number; activity: string | null } | null> => {
-    try {
-      console.log("[analyzeSentiment] Analyzing sentiment for message:", message.substring(0, 50));
-      
-      const response = await fetch(resolveBackendUrl("/api/tools/sentiment"), {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({ text: message }),
-      });
-
-      if (!response.ok) {
-        const errorText = await response.text();
-        console.error("[analyzeSentiment] API error:", response.status, errorText);
-        throw new Error(`Failed to analyze sentiment: ${response.status} ${errorText}`);
-      }
-
-      const data = await response.json();
-      console.log("[analyzeSentiment] Received sentiment data:", data);
-      
-      const sentimentLabel = String(data.sentiment || "neutral").toLowerCase();
-      const sentimentScore = Number(data.score ?? 0);
-
-      console.log("[analyzeSentiment] Parsed sentiment:", {
-        label: sentimentLabel,
-        score: sentimentScore,
-        chatId,
-      });
-
-      // Log sentiment to database (non-blocking, don't wait for it to complete)
-      logSentimentEvent({
-        chatId,
-        sentiment: sentimentLabel,
-        score: sentimentScore,
-      }).catch((error) => {
-        console.error("[analyzeSentiment] Failed to log sentiment event:", error);
-      });
-
-      // Determine which activity is recommended based on sentiment score
-      const activityType = getActivityForSentiment(sentimentScore);
-
-      // Only automatically trigger crisis-level activities (54321)
-      // Other activities should be suggested to the user first
-      if (activityType === "54321" && sentimentScore <= -0.8) {
-        // CRISIS LEVEL: Auto-redirect to dedicated 5-4-3-2-1 grounding page
-        console.log(
-          `[analyzeSentiment] CRISIS detected - redirecting to /grounding (score: ${sentimentScore})`
-        );
-        if (typeof window !== "undefined") {
-          router.push("/grounding");
-        }
-      } else if (activityType) {
-        // HIGH/MODERATE NEGATIVE: Don't auto-trigger, but return activity type
-        // so the LLM can suggest it to the user
-        console.log(`[analyzeSentiment] Negative sentiment detected - Activity suggested: ${activityType} (score: ${sentimentScore})`);
+  const applySentiment = (
+    data: { sentiment?: string; score?: number },
+    chatId: string
+  ): { sentiment: string; score: number; activity: string | null } => {
+    const sentimentLabel = String(data.sentiment || "neutral").toLowerCase();
+    const sentimentScore = Number(data.score ?? 0);
+
+    console.log("[applySentiment] Parsed sentiment:", {
+      label: sentimentLabel,
+      score: sentimentScore,
+      chatId,
+    });
+
+    // Log sentiment to database (non-blocking, don't wait for it to complete)
+    logSentimentEvent({
+      chatId,
+      sentiment: sentimentLabel,
+      score: sentimentScore,
+    }).catch((error) => {
+      console.error("[applySentiment] Failed to log sentiment event:", error);
+    });
+
+    // Determine which activity is recommended based on sentiment score
+    const activityType = getActivityForSentiment(sentimentScore);
+
+    // Only automatically trigger crisis-level activities (54321)
+    // Other activities are suggested to the user by the LLM reply
+    if (activityType === "54321" && sentimentScore <= -0.8) {
+      // CRISIS LEVEL: Auto-redirect to dedicated 5-4-3-2-1 grounding page
+      console.log(
+        `[applySentiment] CRISIS detected - redirecting to /grounding (score: ${sentimentScore})`
+      );
+      if (typeof window !== "undefined") {
+        router.push("/grounding");
       }
-
-      return {
-        sentiment: sentimentLabel,
-        score: sentimentScore,
-        activity: activityType,
-      };
-    } catch (error) {
-      console.error("[analyzeSentiment] Sentiment analysis failed:", error);
-      return null;
+    } else if (activityType) {
+      console.log(`[applySentiment] Negative sentiment detected - Activity suggested: ${activityType} (score: ${sentimentScore})`);
     }
+
+    return {
+      sentiment: sentimentLabel,
+      score: sentimentScore,
+      activity: activityType,
+    };
   };
 
   const handleSend = async () => {
@@ -163,23 +133,11 @@ export default function ChatInputDock({ position }: ChatInputDockProps) {
       // Update local activeChat for API call (messagesToSend already has user message)
     }
 
-    // STEP 1: Analyze sentiment immediately after user sends message
-    // This happens BEFORE LLM responds to enable proactive support
+    // Sentiment scoring runs on the backend alongside the LLM call (/api/chat/turn),
+    // which adds the activity suggestion to the prompt when the score calls for it
     let sentimentData: { sentiment: string; score: number; activity: string | null } | null = null;
-    if (activeChat) {
-      console.log("[handleSend] Analyzing sentiment BEFORE LLM call...");
-      sentimentData = await analyzeSentiment(userMessageContent, activeChat.id, chatTab, activeChat);
-      
-      if (sentimentData) {
-        console.log(`[handleSend] Sentiment analysis complete:`, {
-          sentiment: sentimentData.sentiment,
-          score: sentimentData.score,
-          activityTriggered: sentimentData.activity,
-        });
-      }
-    }
 
-    // STEP 2: Call backend API for LLM response
+    // Call backend API for LLM response and sentiment in one round trip
     try {
       if (activeChat) {
         setPendingAssistantMessage(activeChat.id, { startedAt: Date.now() });
@@ -192,12 +150,10 @@ export default function ChatInputDock({ position }: ChatInputDockProps) {
         mbtiType = profile?.mbti_type || null;
       }
 
-      // Include sentiment data in the request so LLM can suggest appropriate activities
       const requestBody: {
         messages: Array<{ role: string; content: string }>;
         chat_type: string;
         mbti_type: string | null;
-        sentiment?: { sentiment: string; score: number; suggested_activity: string | null };
       } = {
         messages: messagesToSend.map(msg => ({
           role: msg.role,
@@ -207,17 +163,7 @@ export default function ChatInputDock({ position }: ChatInputDockProps) {
         mbti_type: mbtiType,
       };
 
-      // If sentiment analysis found negative sentiment (but not crisis), include it
-      // so the LLM can suggest the activity to the user
-      if (sentimentData && sentimentData.activity && sentimentData.score > -0.8) {
-        requestBody.sentiment = {
-          sentiment: sentimentData.sentiment,
-          score: sentimentData.score,
-          suggested_activity: sentimentData.activity,
-        };
-      }
-
-      const response = await fetch(resolveBackendUrl("/api/chat"), {
+      const response = await fetch(resolveBackendUrl("/api/chat/turn"), {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -226,11 +172,20 @@ export default function ChatInputDock({ position }: ChatInputDockProps) {
       });
 
       if (!response.ok) {
+        // Failed turns still carry the sentiment, so a crisis redirects even without a reply
+        const errorData = await response.json().catch(() => null);
+        if (errorData?.sentiment) {
+          applySentiment(errorData.sentiment, activeChat.id);
+        }
         throw new Error('Failed to get response from AI');
       }
 
       const data = await response.json();
       // Removed artificial delay - let the LLM be fast!
+
+      if (data.sentiment) {
+        sentimentData = applySentiment(data.sentiment, activeChat.id);
+      }
       
       // Always add the assistant's response with the chat ID to ensure it goes to the right chat
       const assistantMessage: ChatMessage = {
@@ -278,7 +233,7 @@ export default function ChatInputDock({ position }: ChatInputDockProps) {
       }
     } finally {
       setIsSending(false);
-      // Note: Sentiment analysis is now done BEFORE LLM call, not in finally block
+      // Note: Sentiment analysis now comes back with the LLM reply, not in finally block
     }
   };
 
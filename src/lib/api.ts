@@ -20,3 +20,32 @@ export function resolveBackendUrl(path: string) {
   return normalisedPath;
 }
 
+
+const JOB_POLL_INTERVAL_MS = 2000;
+
+/**
+ * Read a tool response body. When the backend is overloaded it answers 202 with a
+ * background job instead; poll the job until it finishes and return its result.
+ */
+export async function readToolResult<T = any>(response: Response): Promise<T> {
+  if (response.status !== 202) {
+    return response.json();
+  }
+
+  let job = await response.json();
+  const jobUrl = resolveBackendUrl(response.headers.get("Location") ?? `/api/jobs/${job.job_id}`);
+
+  while (job.status === "queued" || job.status === "running") {
+    await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    const jobResponse = await fetch(jobUrl);
+    if (!jobResponse.ok) {
+      throw new Error(`Job lookup failed with status ${jobResponse.status}`);
+    }
+    job = await jobResponse.json();
+  }
+
+  if (job.status !== "succeeded") {
+    throw new Error(job.error || `Generation ${job.status}`);
+  }
+  return job.result as T;
+}